@@ -0,0 +1,177 @@
+# Бенчмарк горячих запросов бота.
+#
+# Заполняет базу N пользователями и валентинками и меряет задержку запросов
+# get_user (регистрация, блокировка и кулдаун по user.last_valentine_at в
+# ticket_handler), /block и /who, печатая их план выполнения.
+# С --seasons валентинки раскладываются по нескольким сезонам, и в плане /who в
+# Postgres видно, что читается только секция текущего (partitions.py).
+# База берется из DB_URL или DB_* переменных, например:
+#
+#   DB_URL=sqlite:///bench.db python -m benchmarks.queries --users 10000 --valentines 300000
+#   DB_NAME=bench python -m benchmarks.queries --no-indexes
+#   DB_NAME=bench python -m benchmarks.queries --seasons 5
+import argparse
+import datetime
+import random
+import statistics
+import time
+
+from sqlalchemy import insert, select, text
+
+from db_sqlalchemy import DEFAULT_TENANT, User, Valentine, ensure_schema, get_engine
+from partitions import create_partition, in_current_season
+from repository import USER_COLUMNS
+
+INDEXES = [
+    ("user", "ix_user_tenant_user_id"),
+    ("valentine", "ix_valentine_admin_message_id"),
+]
+
+
+def seed(conn, users: int, valentines: int, seasons: int = 1, batch: int = 10_000) -> None:
+    conn.execute(text("DELETE FROM valentine"))
+    conn.execute(text('DELETE FROM "user"'))
+
+    for start in range(0, users, batch):
+        conn.execute(
+            insert(User),
+            [
+                {
+                    "id": i + 1,
+                    "tenant": DEFAULT_TENANT,
+                    "user_id": 10**9 + i,
+                    "full_name": f"User {i}",
+                    "user_name": f"user{i}",
+                    "phone": str(996_000_000_000 + i),
+                    "blocked": False,
+                    "blocked_reason": "",
+                }
+                for i in range(start, min(start + batch, users))
+            ],
+        )
+
+    now = datetime.datetime.utcnow()
+    # Каждая seasons-я валентинка в текущем сезоне, остальные - 14 февраля прошлых лет
+    dates = [now] + [
+        datetime.datetime(now.year - offset, 2, 14) for offset in range(1, seasons)
+    ]
+    if conn.dialect.name == "postgresql":
+        for date in dates:
+            create_partition(conn, date.year)
+    for start in range(0, valentines, batch):
+        conn.execute(
+            insert(Valentine),
+            [
+                {
+                    "id": i + 1,
+                    "tenant": DEFAULT_TENANT,
+                    "sender": random.randint(1, users),
+                    "recipient": f"@user{random.randrange(users)}",
+                    "text": "Ты лучше всех" * random.randint(1, 10),
+                    "date": dates[i % seasons]
+                    - datetime.timedelta(seconds=valentines - i),
+                    "admin_message_id": i + 1,
+                }
+                for i in range(start, min(start + batch, valentines))
+            ],
+        )
+
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT setval('user_id_seq', :n)"), {"n": users})
+        conn.execute(text("SELECT setval('valentine_id_seq', :n)"), {"n": valentines})
+        conn.execute(text('ANALYZE "user"'))
+        conn.execute(text("ANALYZE valentine"))
+
+
+def drop_indexes(conn) -> None:
+    for table, index in INDEXES:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(f'DROP INDEX IF EXISTS "{index}"'))
+        else:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+
+
+def hot_queries(users: int, valentines: int) -> dict:
+    return {
+        "user by telegram id": lambda: select(*USER_COLUMNS).where(
+            User.tenant == DEFAULT_TENANT,
+            User.user_id == 10**9 + random.randrange(users),
+        ),
+        "user by admin_message_id": lambda: select(User)
+        .join(Valentine)
+        .where(
+            Valentine.tenant == DEFAULT_TENANT,
+            in_current_season(Valentine.date),
+            Valentine.admin_message_id == random.randint(1, valentines),
+        ),
+    }
+
+
+def explain(conn, statement) -> str:
+    compiled = str(
+        statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+    )
+    if conn.dialect.name == "postgresql":
+        rows = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {compiled}"))
+        return "\n".join(row[0] for row in rows)
+    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+    return "\n".join(row[-1] for row in rows)
+
+
+def measure(conn, make_statement, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        statement = make_statement()
+        started = time.perf_counter()
+        conn.execute(statement).first()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк горячих запросов")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--valentines", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=500)
+    parser.add_argument(
+        "--seasons", type=int, default=1, help="по скольким сезонам разложить валентинки"
+    )
+    parser.add_argument(
+        "--no-indexes", action="store_true", help="удалить индексы перед замером"
+    )
+    parser.add_argument(
+        "--no-seed", action="store_true", help="не перезаполнять базу"
+    )
+    args = parser.parse_args()
+
+    engine = get_engine()
+    with engine.begin() as conn:
+        ensure_schema(conn)
+        if not args.no_seed:
+            started = time.perf_counter()
+            seed(conn, args.users, args.valentines, args.seasons)
+            print(
+                f"Seeded {args.users} users and {args.valentines} valentines "
+                f"in {time.perf_counter() - started:.1f}s"
+            )
+        if args.no_indexes:
+            drop_indexes(conn)
+
+        print(f"Database: {engine.url.render_as_string(hide_password=True)}\n")
+        for name, make_statement in hot_queries(args.users, args.valentines).items():
+            timings = measure(conn, make_statement, args.repeat)
+            quantiles = statistics.quantiles(timings, n=100)
+            print(
+                f"{name}: p50={quantiles[49]:.3f}ms p95={quantiles[94]:.3f}ms "
+                f"p99={quantiles[98]:.3f}ms max={max(timings):.3f}ms"
+            )
+            print(explain(conn, make_statement()))
+            print()
+
+        if args.no_indexes:
+            # Не оставляем базу без индексов после замера
+            conn.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Бенчмарк индекса похожих валентинок (spam.py) без базы:
+# время построения, p50/p95 поиска, доля найденных правленых копий и ложных срабатываний.
+#
+#   python -m benchmarks.spam --size 100000
+import argparse
+import random
+import statistics
+import time
+
+from spam import SpamIndex
+
+LETTERS = "абвгдеёжзийклмнопрстуфхцчшщыэюя"
+
+
+def make_text(rng: random.Random, vocabulary: list) -> str:
+    return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(6, 60)))
+
+
+# Небольшая правка: замена одного слова и пара лишних знаков
+def edit(rng: random.Random, text: str, vocabulary: list) -> str:
+    words = text.split()
+    words[rng.randrange(len(words))] = rng.choice(vocabulary)
+    return " ".join(words) + rng.choice(["!!", " :)", "...", " 💌"])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска похожих валентинок")
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    vocabulary = [
+        "".join(rng.choice(LETTERS) for _ in range(rng.randint(2, 9)))
+        for _ in range(5000)
+    ]
+    texts = [make_text(rng, vocabulary) for _ in range(args.size)]
+
+    index = SpamIndex(threshold=args.threshold, max_size=args.size)
+    started = time.perf_counter()
+    for sender_id, text in enumerate(texts):
+        index.add(text, sender_id)
+    elapsed = time.perf_counter() - started
+    print(f"build: {len(index)} texts in {elapsed:.1f}s, {elapsed / args.size * 1e6:.0f}us per text")
+
+    for name, queries in [
+        ("edited copies", [edit(rng, rng.choice(texts), vocabulary) for _ in range(args.queries)]),
+        ("new texts", [make_text(rng, vocabulary) for _ in range(args.queries)]),
+    ]:
+        timings = []
+        found = 0
+        for query in queries:
+            started = time.perf_counter()
+            match = index.find(query)
+            timings.append((time.perf_counter() - started) * 1000)
+            found += match is not None
+        quantiles = statistics.quantiles(timings, n=100)
+        print(
+            f"{name}: matched {found / len(queries):.1%}, "
+            f"p50 {quantiles[49]:.2f}ms, p95 {quantiles[94]:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
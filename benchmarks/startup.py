@@ -0,0 +1,84 @@
+# Бенчмарк старта бота: сколько проходит от запуска процесса до ответа на первый апдейт.
+# От этого зависит длительность rolling deploy: новая реплика должна успеть
+# импортироваться и взять аренду, пока старая дорабатывает, а затем проверить схему.
+# Бот запускается отдельным процессом против заглушки Bot API из loadtest,
+# /start кладется в очередь заранее, как апдейт, накопившийся за время деплоя:
+#
+#   DB_NAME=bench python -m benchmarks.startup --runs 5
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import sys
+import time
+
+from loadtest.fake_api import FakeBotAPI
+
+TOKEN = "123456:startup"
+USER_ID = 10**9
+
+# Код дочернего процесса: время импорта меряется внутри, чтобы не считать запуск интерпретатора
+CHILD = """
+import time
+started = time.perf_counter()
+import asyncio, sys
+import main
+print(f"import {time.perf_counter() - started:.6f}", flush=True)
+asyncio.run(main.run([main.env_tenant(sys.argv[1])], base_url=sys.argv[2]))
+"""
+
+
+async def measure(api: FakeBotAPI, base_url: str) -> dict:
+    api.push_message(USER_ID, "/start")
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", CHILD, TOKEN, base_url, stdout=asyncio.subprocess.PIPE
+    )
+    try:
+        line = await asyncio.wait_for(process.stdout.readline(), 60)
+        imported = time.perf_counter()
+        await api.next_reply(USER_ID, timeout=60)
+        replied = time.perf_counter()
+    finally:
+        process.send_signal(signal.SIGTERM)
+        await process.wait()
+
+    return {
+        "import": float(line.split()[1]),
+        "process_to_import": imported - started,
+        "import_to_first_update": replied - imported,
+        "total": replied - started,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк старта бота")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_MODE", "polling")
+    os.environ.setdefault("ADMIN_GROUP", "-1")
+    os.environ.setdefault("CHANNEL_ID", "-2")
+
+    api = FakeBotAPI()
+    port = await api.start()
+    base_url = f"http://127.0.0.1:{port}/bot"
+
+    runs = []
+    try:
+        for _ in range(args.runs):
+            runs.append(await measure(api, base_url))
+    finally:
+        await api.stop()
+
+    for name in runs[0]:
+        timings = [run[name] * 1000 for run in runs]
+        print(
+            f"{name}: median {statistics.median(timings):.0f}ms, "
+            f"min {min(timings):.0f}ms, max {max(timings):.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+# Бенчмарк арендаторов: сколько памяти добавляет каждый бот в процессе и сколько
+# соединений с базой держит процесс. Боты запускаются в одном event loop против
+# заглушки Bot API из loadtest, после старта каждый отвечает на /start и проходит
+# регистрацию, чтобы прогреть хендлеры, кэш и пул соединений:
+#
+#   DB_URL=postgresql://postgres@localhost/bench python -m benchmarks.tenants --tenants 1 10 50
+import argparse
+import asyncio
+import gc
+import os
+import time
+
+from sqlalchemy import text
+
+from loadtest.fake_api import FakeBotAPI
+
+ADMIN_GROUP = -1001
+CHANNEL_ID = -1002
+USER_ID = 10**9
+
+
+def rss() -> int:
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+async def connections(engine) -> tuple[int, int | None]:
+    pool = engine.pool
+    opened = pool.checkedin() + pool.checkedout() if hasattr(pool, "checkedin") else 0
+    if engine.dialect.name != "postgresql":
+        return opened, None
+    async with engine.connect() as conn:
+        server = await conn.scalar(
+            text("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()")
+        )
+    return opened, server
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк арендаторов")
+    parser.add_argument("--tenants", type=int, nargs="+", default=[1, 10, 50])
+    args = parser.parse_args()
+
+    import main as bot_main
+    from db_sqlalchemy import get_async_engine, prepare_database
+    from tenants import Tenant
+
+    await prepare_database()
+    api = FakeBotAPI()
+    port = await api.start()
+    base_url = f"http://127.0.0.1:{port}/bot"
+
+    gc.collect()
+    baseline = rss()
+    applications = []
+    try:
+        for count in sorted(args.tenants):
+            started = time.perf_counter()
+            while len(applications) < count:
+                index = len(applications)
+                tenant = Tenant(f"bench{index}", f"{index + 1}:bench", ADMIN_GROUP, CHANNEL_ID)
+                application = bot_main.build_application(tenant, base_url)
+                await application.initialize()
+                await application.post_init(application)
+                await application.updater.start_polling(poll_interval=0, timeout=10)
+                await application.start()
+                applications.append(application)
+            startup = time.perf_counter() - started
+
+            # Один и тот же пользователь пишет каждому боту: у ботов разные строки User
+            for index, application in enumerate(applications):
+                user_id = USER_ID + index
+                api.push_message(user_id, "/start", token=application.bot.token)
+                api.push_message(
+                    user_id,
+                    token=application.bot.token,
+                    contact={"phone_number": "996", "first_name": "Bench", "user_id": user_id},
+                )
+            for index in range(len(applications)):
+                for _ in range(2):
+                    await api.next_reply(USER_ID + index, timeout=60)
+
+            gc.collect()
+            used = rss() - baseline
+            opened, server = await connections(get_async_engine())
+            print(
+                f"{count} tenants: rss +{used / 2**20:.1f} MB "
+                f"({used / count / 2**20:.2f} MB per tenant), "
+                f"db connections: pool {opened}"
+                + (f", server {server}" if server is not None else "")
+                + f", startup {startup * 1000:.0f}ms"
+            )
+    finally:
+        for application in applications:
+            await application.updater.stop()
+            await application.stop()
+            await application.post_shutdown(application)
+            await application.shutdown()
+        await api.stop()
+        await get_async_engine().dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+# Бенчмарк записи валентинок: коммит на каждую строку против пачек из write_behind.py.
+# Пишет в базу из DB_URL или DB_* переменных, таблицы valentine и outbox очищаются:
+#
+#   DB_NAME=bench python -m benchmarks.write_behind --rows 5000 --batch 100
+import argparse
+import asyncio
+import datetime
+import time
+
+from sqlalchemy import delete, insert, text
+
+from db_sqlalchemy import (
+    OutboxMessage,
+    RecipientStats,
+    User,
+    Valentine,
+    ValentineStats,
+    async_session,
+    get_async_engine,
+    prepare_database,
+)
+from outbox import Outbox
+from repository import PendingValentine, add_valentines
+from write_behind import ValentineWriteBuffer
+
+SENDERS = 100
+
+
+def make_rows(count: int) -> list:
+    now = datetime.datetime.utcnow()
+    return [
+        PendingValentine(
+            telegram_id=10**9 + i % SENDERS + 1,
+            recipient=f"@user{i}",
+            text="Ты лучше всех",
+            date=now,
+            anonymous=i % 2 == 0,
+            channel_id=-1,
+            channel_text="Ты лучше всех",
+            admin_group=-2,
+            admin_text="Ты лучше всех",
+        )
+        for i in range(count)
+    ]
+
+
+async def reset() -> None:
+    async with async_session() as session:
+        await session.execute(delete(OutboxMessage))
+        await session.execute(delete(ValentineStats))
+        await session.execute(delete(RecipientStats))
+        await session.execute(delete(Valentine))
+        await session.execute(delete(User))
+        await session.execute(
+            insert(User),
+            [{"id": i, "user_id": 10**9 + i, "blocked": False} for i in range(1, SENDERS + 1)],
+        )
+        await session.commit()
+
+
+async def per_row(outbox: Outbox, rows: list, concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def write(row: PendingValentine) -> None:
+        async with semaphore:
+            async with async_session() as session:
+                await add_valentines(session, outbox, [row])
+                await session.commit()
+
+    await asyncio.gather(*(write(row) for row in rows))
+
+
+async def batched(outbox: Outbox, rows: list, batch: int, delay_ms: float) -> None:
+    buffer = ValentineWriteBuffer(outbox, max_rows=batch, max_delay=delay_ms / 1000)
+    for row in rows:
+        await buffer.add(row)
+    await buffer.flush()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк отложенной записи")
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--delay-ms", type=float, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    await prepare_database()
+    outbox = Outbox(bot=None)
+    rows = make_rows(args.rows)
+
+    for name, run in [
+        ("per-row commit", lambda: per_row(outbox, rows, args.concurrency)),
+        (f"batched x{args.batch}", lambda: batched(outbox, rows, args.batch, args.delay_ms)),
+    ]:
+        await reset()
+        started = time.perf_counter()
+        await run()
+        elapsed = time.perf_counter() - started
+        async with async_session() as session:
+            written = await session.scalar(text("SELECT count(*) FROM valentine"))
+        print(
+            f"{name}: {written} rows in {elapsed:.2f}s, {written / elapsed:.0f} rows/s, "
+            f"{elapsed / written * 1000:.2f}ms per row"
+        )
+
+    await get_async_engine().dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
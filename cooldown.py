@@ -0,0 +1,72 @@
+import datetime
+import heapq
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_sqlalchemy import User
+
+
+def to_timestamp(at: datetime.datetime) -> float:
+    # В базе даты хранятся в UTC без таймзоны
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=datetime.timezone.utc)
+    return at.timestamp()
+
+
+# Кулдаун отправки валентинок в памяти: user_id -> момент окончания кулдауна.
+# Куча по моменту окончания нужна, чтобы выбрасывать истекшие записи и не расти бесконечно
+class CooldownEngine:
+    def __init__(self, cooldown: datetime.timedelta) -> None:
+        self.cooldown = cooldown.total_seconds()
+        self._expires: dict[int, float] = {}
+        self._heap: list[tuple[float, int]] = []
+
+    def __len__(self) -> int:
+        self._prune(time.time())
+        return len(self._expires)
+
+    def touch(self, user_id: int, at: datetime.datetime) -> None:
+        expires = to_timestamp(at) + self.cooldown
+        if expires <= time.time():
+            return
+        self._expires[user_id] = expires
+        heapq.heappush(self._heap, (expires, user_id))
+
+    # Сколько секунд осталось до следующей валентинки, 0 если можно отправлять
+    def remaining(self, user_id: int) -> float:
+        now = time.time()
+        self._prune(now)
+        expires = self._expires.get(user_id)
+        if expires is None:
+            return 0.0
+        return max(0.0, expires - now)
+
+    def _prune(self, now: float) -> None:
+        while self._heap and self._heap[0][0] <= now:
+            expires, user_id = heapq.heappop(self._heap)
+            if self._expires.get(user_id) == expires:
+                del self._expires[user_id]
+
+    async def warm(self, session: AsyncSession, tenant: str) -> int:
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.cooldown)
+        rows = await session.execute(
+            select(User.user_id, User.last_valentine_at).where(
+                User.tenant == tenant, User.last_valentine_at > since
+            )
+        )
+        count = 0
+        for user_id, last_valentine_at in rows:
+            self.touch(user_id, last_valentine_at)
+            count += 1
+        return count
+
+
+def format_wait(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds + 0.999), 60)
+    if minutes and seconds:
+        return f"{minutes} мин {seconds} сек"
+    if minutes:
+        return f"{minutes} мин"
+    return f"{seconds} сек"
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+
+from sqlalchemy import delete, insert, select, tuple_
+from telegram.ext import BasePersistence, PersistenceInput
+
+from db_sqlalchemy import (
+    DEFAULT_TENANT,
+    ConversationState,
+    ValentineDraftRow,
+    async_session,
+)
+from draft import DRAFT, ValentineDraft
+
+logger = logging.getLogger(__name__)
+
+
+# Хранит состояния диалогов и черновики валентинок в Postgres, чтобы рестарт
+# или деплой не терял пользователей посреди /valentine. PTB отдает изменения
+# раз в update_interval, а мы копим их и пишем одной транзакцией через flush_delay.
+# Таблицы общие, у каждого арендатора свой экземпляр со своим tenant
+class DBPersistence(BasePersistence):
+    def __init__(
+        self,
+        update_interval: float = 10,
+        flush_delay: float = 1,
+        tenant: str = DEFAULT_TENANT,
+    ) -> None:
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+        self.flush_delay = flush_delay
+        self.tenant = tenant
+        # None означает удаление записи
+        self._drafts: dict[int, tuple | None] = {}
+        self._states: dict[tuple[str, str], int | None] = {}
+        self._write_task: asyncio.Task | None = None
+
+    async def get_user_data(self) -> dict:
+        async with async_session() as session:
+            rows = await session.scalars(
+                select(ValentineDraftRow).where(ValentineDraftRow.tenant == self.tenant)
+            )
+            return {
+                row.user_id: {
+                    DRAFT: ValentineDraft(
+                        text=row.text,
+                        recipient=row.recipient,
+                        anonymous=row.anonymous,
+                        media_type=row.media_type,
+                        file_id=row.file_id,
+                        file_unique_id=row.file_unique_id,
+                    )
+                }
+                for row in rows
+            }
+
+    async def get_conversations(self, name: str) -> dict:
+        async with async_session() as session:
+            rows = await session.execute(
+                select(ConversationState.key, ConversationState.state).where(
+                    ConversationState.tenant == self.tenant, ConversationState.name == name
+                )
+            )
+            return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object) -> None:
+        self._states[(name, json.dumps(key))] = (
+            new_state if isinstance(new_state, int) else None
+        )
+        self._schedule_write()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        draft = data.get(DRAFT)
+        self._drafts[user_id] = (
+            (
+                draft.text,
+                draft.recipient,
+                draft.anonymous,
+                draft.media_type,
+                draft.file_id,
+                draft.file_unique_id,
+            )
+            if draft
+            else None
+        )
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._drafts[user_id] = None
+        self._schedule_write()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    def _schedule_write(self) -> None:
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_later())
+
+    async def _write_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self._write()
+        except Exception as e:
+            logger.warning(e)
+
+    async def _write(self) -> None:
+        drafts, self._drafts = self._drafts, {}
+        states, self._states = self._states, {}
+        if not drafts and not states:
+            return
+
+        try:
+            async with async_session() as session:
+                if drafts:
+                    await session.execute(
+                        delete(ValentineDraftRow).where(
+                            ValentineDraftRow.tenant == self.tenant,
+                            ValentineDraftRow.user_id.in_(drafts),
+                        )
+                    )
+                    rows = [
+                        {
+                            "tenant": self.tenant,
+                            "user_id": user_id,
+                            "text": draft[0],
+                            "recipient": draft[1],
+                            "anonymous": draft[2],
+                            "media_type": draft[3],
+                            "file_id": draft[4],
+                            "file_unique_id": draft[5],
+                        }
+                        for user_id, draft in drafts.items()
+                        if draft
+                    ]
+                    if rows:
+                        await session.execute(insert(ValentineDraftRow), rows)
+
+                if states:
+                    await session.execute(
+                        delete(ConversationState).where(
+                            ConversationState.tenant == self.tenant,
+                            tuple_(ConversationState.name, ConversationState.key).in_(
+                                list(states)
+                            ),
+                        )
+                    )
+                    rows = [
+                        {"tenant": self.tenant, "name": name, "key": key, "state": state}
+                        for (name, key), state in states.items()
+                        if state is not None
+                    ]
+                    if rows:
+                        await session.execute(insert(ConversationState), rows)
+
+                await session.commit()
+        except BaseException:
+            # Не теряем изменения, если база моргнула: более свежие значения важнее
+            self._drafts = {**drafts, **self._drafts}
+            self._states = {**states, **self._states}
+            raise
+
+    async def flush(self) -> None:
+        if self._write_task and not self._write_task.done():
+            self._write_task.cancel()
+            await asyncio.gather(self._write_task, return_exceptions=True)
+        await self._write()
+
+    # Остальные данные бот не хранит
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: object) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
@@ -1,5 +1,7 @@
+import asyncio
+import logging
 import os
-from datetime import datetime, timezone
+from datetime import datetime
 
 from sqlalchemy import (
     BigInteger,
@@ -7,50 +9,334 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
     create_engine,
+    event,
+    text,
+)
+from sqlalchemy.engine import URL, Connection, Engine, make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
 )
-from sqlalchemy.engine import URL
 from sqlalchemy.orm import declarative_base
 
-url = URL.create(
-    drivername="postgresql+psycopg2",
-    username=os.environ.get("DB_USER", "postgres"),
-    password=os.environ.get("DB_PASS", "12345"),
-    host=os.environ.get("DB_HOST", "localhost"),
-    database=os.environ.get("DB_NAME", "postgres"),
-)
+from leader import LeaderLease
+from migrations import SCHEMA_VERSION, migrate, schema_version
+from partitions import ensure_partitions
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 30))
+
+# Движки создаются при первом обращении, а не при импорте: импорт модулей бота не
+# ходит в базу и не падает, если она недоступна
+_engine: Engine | None = None
+_async_engine: AsyncEngine | None = None
+_async_sessionmaker: async_sessionmaker | None = None
+
+
+# DB_URL перекрывает DB_* переменные. Нужен для бенчмарков и локального запуска на SQLite
+def get_url() -> URL:
+    if os.environ.get("DB_URL"):
+        return make_url(os.environ["DB_URL"])
+    return URL.create(
+        drivername="postgresql+psycopg2",
+        username=os.environ.get("DB_USER", "postgres"),
+        password=os.environ.get("DB_PASS", "12345"),
+        host=os.environ.get("DB_HOST", "localhost"),
+        database=os.environ.get("DB_NAME", "postgres"),
+    )
+
+
+# Синхронный движок нужен только для создания схемы из консоли и бенчмарков
+def get_engine() -> Engine:
+    global _engine
+    if _engine is None:
+        _engine = create_engine(get_url())
+    return _engine
+
+
+# Асинхронный движок для хендлеров бота. Размер пула настраивается через DB_POOL_SIZE и DB_MAX_OVERFLOW
+def get_async_engine() -> AsyncEngine:
+    global _async_engine
+    if _async_engine is None:
+        url = get_url()
+        pool_options = (
+            {
+                "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+                "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+                "pool_pre_ping": True,
+            }
+            if url.get_backend_name() == "postgresql"
+            else {"connect_args": {"timeout": SQLITE_BUSY_TIMEOUT}}
+        )
+        _async_engine = create_async_engine(
+            url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]), **pool_options
+        )
+        if url.get_backend_name() == "sqlite":
+            event.listen(_async_engine.sync_engine, "connect", _sqlite_wal)
+    return _async_engine
+
+
+# SQLite пишет по одной транзакции за раз. WAL, чтобы чтения не ждали запись, а
+# запись ждет блокировку до SQLITE_BUSY_TIMEOUT секунд (у sqlite3 по умолчанию 5):
+# под нагрузкой loadtest очередь транзакций записи бывает длиннее
+def _sqlite_wal(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+
+# Одна сессия на апдейт: async with async_session() as session
+def async_session() -> AsyncSession:
+    global _async_sessionmaker
+    if _async_sessionmaker is None:
+        _async_sessionmaker = async_sessionmaker(
+            get_async_engine(), expire_on_commit=False
+        )
+    return _async_sessionmaker()
+
 
-engine = create_engine(url)
 Base = declarative_base()
 
+# Арендатор (бот одной школы), см. tenants.py. Один бот из env переменных - "default"
+DEFAULT_TENANT = "default"
+
 
 class User(Base):
     __tablename__ = "user"
 
     id = Column(Integer(), primary_key=True)
+    tenant = Column(String(), nullable=False, server_default=DEFAULT_TENANT)
     user_id = Column(BigInteger(), nullable=False)
     full_name = Column(String())
     user_name = Column(String())
     phone = Column(String())
     blocked = Column(Boolean(), default=False)
     blocked_reason = Column(String(), default="")
+    # Дублирует дату последней валентинки, чтобы кулдаун не требовал запроса к valentine
+    last_valentine_at = Column(DateTime())
+
+
+# Медиа из валентинок, по строке на файл: повторная отправка того же фото или стикера
+# находится по file_unique_id и уходит с уже известным file_id, см. media.py
+class Media(Base):
+    __tablename__ = "media"
+
+    id = Column(Integer(), primary_key=True)
+    tenant = Column(String(), nullable=False, server_default=DEFAULT_TENANT)
+    file_unique_id = Column(String(), nullable=False)
+    # file_id действует только для бота, который его получил, поэтому строки по арендаторам
+    file_id = Column(String(), nullable=False)
+    type = Column(String(), nullable=False)
+    # Telegram id того, кто прислал файл первым
+    sender = Column(BigInteger(), nullable=False)
+    uses = Column(Integer(), nullable=False, default=1)
+    created_at = Column(DateTime(), nullable=False)
+
+
+Index("ix_media_tenant_file_unique_id", Media.tenant, Media.file_unique_id, unique=True)
 
 
 class Valentine(Base):
     __tablename__ = "valentine"
 
     id = Column(Integer(), primary_key=True)
+    tenant = Column(String(), nullable=False, server_default=DEFAULT_TENANT)
     sender = Column(Integer(), ForeignKey("user.id"))
     recipient = Column(String())
     text = Column(Text(), nullable=False)
-    # Возможно могут быть траблы с date из-за таймзоны. Если так и будет, то нужно будет везде убрать timezone.utc
-    date = Column(DateTime(), default=datetime.now(timezone.utc))
-    admin_message_id = Column(Integer())
+    # UTC без таймзоны. Ключ секций в Postgres (partitions.py), поэтому там первичный
+    # ключ (id, date), а уникальность id держит valentine_id_seq
+    date = Column(DateTime(), nullable=False, default=datetime.utcnow)
+    admin_message_id = Column(Integer(), index=True)
+    # NULL у валентинок, отправленных до того, как выбор стал сохраняться
+    anonymous = Column(Boolean())
+    # Получатель после recipients.parse_recipient: ник без @ и имя латиницей.
+    # По recipient_name в Postgres есть триграммный GIN индекс (миграция 4)
+    recipient_username = Column(String())
+    recipient_name = Column(String())
+    media_id = Column(Integer(), ForeignKey("media.id"))
+    # Стикер уходит в админ группу отдельным сообщением после текста, /who и /block
+    # работают в ответ на любое из двух
+    admin_media_message_id = Column(Integer(), index=True)
+
+
+# Один пользователь Telegram может писать ботам нескольких школ
+Index("ix_user_tenant_user_id", User.tenant, User.user_id, unique=True)
+# Валентинки отправителя по внешнему ключу на user: без индекса удаление пользователя
+# сканирует valentine. Кулдаун в valentine не ходит, см. User.last_valentine_at
+Index("ix_valentine_sender_id", Valentine.sender, Valentine.id.desc())
+# /find по нику, сразу в порядке от новых к старым
+Index(
+    "ix_valentine_recipient_username",
+    Valentine.recipient_username,
+    Valentine.id.desc(),
+)
+
+
+# Счетчики для /stats, обновляются вместе с записью валентинки, см. rollups.py
+class ValentineStats(Base):
+    __tablename__ = "valentine_stats"
+
+    tenant = Column(String(), primary_key=True, server_default=DEFAULT_TENANT)
+    hour = Column(DateTime(), primary_key=True)
+    # Час разбит на rollups.STATS_BUCKETS строк: одновременные записи валентинок
+    # обновляют разные строки и не ждут блокировку одной. /stats суммирует их
+    bucket = Column(Integer(), primary_key=True, server_default="0")
+    total = Column(Integer(), nullable=False, default=0)
+    anonymous = Column(Integer(), nullable=False, default=0)
+    signed = Column(Integer(), nullable=False, default=0)
+
+
+class RecipientStats(Base):
+    __tablename__ = "recipient_stats"
+
+    tenant = Column(String(), primary_key=True, server_default=DEFAULT_TENANT)
+    recipient = Column(String(), primary_key=True)
+    count = Column(Integer(), nullable=False, default=0)
+
+
+Index(
+    "ix_recipient_stats_count",
+    RecipientStats.tenant,
+    RecipientStats.count.desc(),
+    RecipientStats.recipient,
+)
+
+
+# Получатели сезонов, которые retention отсоединил от valentine. Пишутся вместе с
+# отсоединением, rollups --rebuild прибавляет их к пересчету по подключенным сезонам
+class ArchivedRecipientStats(Base):
+    __tablename__ = "archived_recipient_stats"
+
+    tenant = Column(String(), primary_key=True, server_default=DEFAULT_TENANT)
+    season = Column(Integer(), primary_key=True)
+    recipient = Column(String(), primary_key=True)
+    count = Column(Integer(), nullable=False, default=0)
+
+
+# Очередь исходящих сообщений в канал и админ группу, см. outbox.py
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+
+    id = Column(Integer(), primary_key=True)
+    # Чей бот отправляет сообщение
+    tenant = Column(String(), nullable=False, server_default=DEFAULT_TENANT)
+    chat_id = Column(BigInteger(), nullable=False)
+    text = Column(Text(), nullable=False)
+    parse_mode = Column(String())
+    # Если задан, то после доставки message_id записывается в valentine.admin_message_id
+    admin_copy_of = Column(Integer())
+    status = Column(String(), nullable=False, default="pending")
+    attempts = Column(Integer(), nullable=False, default=0)
+    created_at = Column(DateTime(), nullable=False)
+    next_attempt_at = Column(DateTime(), nullable=False)
+    sent_at = Column(DateTime())
+    message_id = Column(Integer())
+    # Для отложенных сообщений (status = "scheduled"): когда их можно отправлять
+    release_at = Column(DateTime())
+    # Медиа отправляется по file_id, text становится подписью
+    media_type = Column(String())
+    file_id = Column(String())
+
+
+Index(
+    "ix_outbox_pending",
+    OutboxMessage.tenant,
+    OutboxMessage.id,
+    postgresql_where=OutboxMessage.status == "pending",
+    sqlite_where=OutboxMessage.status == "pending",
+)
+Index(
+    "ix_outbox_scheduled",
+    OutboxMessage.chat_id,
+    OutboxMessage.release_at,
+    OutboxMessage.id,
+    postgresql_where=OutboxMessage.status == "scheduled",
+    sqlite_where=OutboxMessage.status == "scheduled",
+)
+
+
+# Состояние ConversationHandler и черновики валентинок, см. db_persistence.py
+class ConversationState(Base):
+    __tablename__ = "conversation_state"
+
+    tenant = Column(String(), primary_key=True, server_default=DEFAULT_TENANT)
+    name = Column(String(), primary_key=True)
+    key = Column(String(), primary_key=True)
+    state = Column(Integer(), nullable=False)
+
+
+class ValentineDraftRow(Base):
+    __tablename__ = "valentine_draft"
+
+    tenant = Column(String(), primary_key=True, server_default=DEFAULT_TENANT)
+    user_id = Column(BigInteger(), primary_key=True)
+    text = Column(Text())
+    recipient = Column(String())
+    anonymous = Column(Boolean())
+    media_type = Column(String())
+    file_id = Column(String())
+    file_unique_id = Column(String())
+
+
+# Схема создается явно: при старте бота (prepare_database) или командой
+# python db_sqlalchemy.py, оба под арендой лидера. Если версия схемы в базе уже
+# последняя, это один SELECT
+def ensure_schema(conn: Connection) -> None:
+    if conn.dialect.name != "postgresql":
+        # SQLite используется только для бенчмарков, там схему целиком создает create_all
+        Base.metadata.create_all(conn)
+        return
+
+    if schema_version(conn) < SCHEMA_VERSION:
+        # Несколько реплик могут стартовать одновременно
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('schema_version'))"))
+        Base.metadata.create_all(conn)
+        migrate(conn)
+    ensure_partitions(conn)
+
+
+# Миграции только под арендой лидера, см. main.run
+async def prepare_database() -> None:
+    async with get_async_engine().begin() as conn:
+        await conn.run_sync(ensure_schema)
+
+
+# Консольные команды (export, rollups, retention) схему не мигрируют: аренда у
+# работающего бота, а миграции под его запросами меняли бы индексы и брали бы
+# блокировки его таблиц. Отстающая схема - ошибка, ее доводит бот или python db_sqlalchemy.py
+async def check_schema() -> None:
+    async with get_async_engine().begin() as conn:
+        if conn.dialect.name != "postgresql":
+            await conn.run_sync(Base.metadata.create_all)
+            return
+        version = await conn.run_sync(schema_version)
+    if version < SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema is at version {version}, expected {SCHEMA_VERSION}. "
+            "Start the bot or run python db_sqlalchemy.py to migrate it"
+        )
+
 
+# Создание схемы из консоли. Ждет аренду лидера, как бот при старте: пока работает
+# бот, миграции не применяются
+async def migrate_with_lease() -> None:
+    lease = LeaderLease(get_async_engine())
+    await lease.acquire()
+    try:
+        await prepare_database()
+    finally:
+        await lease.release()
+        await get_async_engine().dispose()
 
-# Base.metadata.drop_all(engine)
 
-Base.metadata.create_all(engine)
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(migrate_with_lease())
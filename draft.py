@@ -0,0 +1,42 @@
+# Ключ черновика валентинки в context.user_data
+DRAFT = "draft"
+
+
+# Черновик валентинки, который живет в context.user_data между шагами диалога.
+# Хранит только то, что нужно для отправки, вместо целых объектов Message.
+# У медиа валентинки text - подпись, а сам файл - media_type и file_id
+class ValentineDraft:
+    __slots__ = (
+        "text",
+        "recipient",
+        "anonymous",
+        "media_type",
+        "file_id",
+        "file_unique_id",
+        "repeats",
+    )
+
+    def __init__(
+        self,
+        text: str | None = None,
+        recipient: str | None = None,
+        anonymous: bool | None = None,
+        media_type: str | None = None,
+        file_id: str | None = None,
+        file_unique_id: str | None = None,
+    ) -> None:
+        self.text = text
+        self.recipient = recipient
+        self.anonymous = anonymous
+        self.media_type = media_type
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        # Сколько раз этот файл уже отправляли, для пометки в админ группе.
+        # В базе не хранится: после рестарта пометки просто не будет
+        self.repeats = 0
+
+    def __repr__(self) -> str:
+        return (
+            f"ValentineDraft(text={self.text!r}, recipient={self.recipient!r}, "
+            f"anonymous={self.anonymous!r}, media_type={self.media_type!r})"
+        )
@@ -0,0 +1,137 @@
+# Выгрузка валентинок вместе с отправителями в CSV или JSONL.
+# Строки идут из базы серверным курсором пачками по CHUNK_SIZE и сразу пишутся в файл,
+# поэтому память не зависит от размера таблицы:
+#
+#   python -m export --format jsonl --gzip -o valentines.jsonl.gz
+#   python -m export > valentines.csv
+#   python -m export --tenant school42 > school42.csv
+import argparse
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import json
+import sys
+from typing import AsyncIterator, BinaryIO
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_sqlalchemy import (
+    DEFAULT_TENANT,
+    Media,
+    User,
+    Valentine,
+    async_session,
+    check_schema,
+    get_async_engine,
+)
+
+CHUNK_SIZE = 1000
+
+FORMATS = ("csv", "jsonl")
+
+COLUMNS = {
+    "id": Valentine.id,
+    "date": Valentine.date,
+    "recipient": Valentine.recipient,
+    "text": Valentine.text,
+    "admin_message_id": Valentine.admin_message_id,
+    # Сам файл не выгружается: по file_id его можно получить через этого же бота
+    "media_type": Media.type,
+    "media_file_id": Media.file_id,
+    "sender_user_id": User.user_id,
+    "sender_full_name": User.full_name,
+    "sender_user_name": User.user_name,
+    "sender_phone": User.phone,
+    "sender_blocked": User.blocked,
+}
+
+
+async def export_chunks(session: AsyncSession, tenant: str) -> AsyncIterator[list]:
+    result = await session.stream(
+        select(*COLUMNS.values())
+        .join(User, User.id == Valentine.sender)
+        .outerjoin(Media, Media.id == Valentine.media_id)
+        .where(Valentine.tenant == tenant)
+        .order_by(Valentine.id),
+        execution_options={"yield_per": CHUNK_SIZE},
+    )
+    async for chunk in result.partitions():
+        yield chunk
+
+
+def _json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+# Пишет выгрузку в бинарный файл, возвращает число строк
+async def write_export(
+    session: AsyncSession,
+    tenant: str,
+    file: BinaryIO,
+    format: str = "csv",
+    compress: bool = False,
+) -> int:
+    if compress:
+        file = gzip.GzipFile(fileobj=file, mode="wb")
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="", write_through=True)
+
+    if format == "csv":
+        writer = csv.writer(text)
+        writer.writerow(COLUMNS)
+
+    count = 0
+    async for chunk in export_chunks(session, tenant):
+        if format == "csv":
+            writer.writerows(chunk)
+        else:
+            text.write(
+                "".join(
+                    json.dumps(
+                        dict(zip(COLUMNS, map(_json_value, row))), ensure_ascii=False
+                    )
+                    + "\n"
+                    for row in chunk
+                )
+            )
+        count += len(chunk)
+
+    text.flush()
+    # Закрываем только gzip поверх файла, сам файл остается открытым у вызывающего
+    text.detach()
+    if compress:
+        file.close()
+    return count
+
+
+def export_filename(format: str, compress: bool) -> str:
+    date = datetime.date.today().isoformat()
+    return f"valentines-{date}.{format}" + (".gz" if compress else "")
+
+
+async def main(args: argparse.Namespace) -> None:
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        await check_schema()
+        async with async_session() as session:
+            count = await write_export(
+                session, args.tenant, output, args.format, args.gzip
+            )
+    finally:
+        if args.output:
+            output.close()
+        await get_async_engine().dispose()
+    print(f"Exported {count} valentines", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Выгрузка валентинок")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("-o", "--output", help="файл, по умолчанию stdout")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT, help="чьи валентинки выгрузить")
+    asyncio.run(main(parser.parse_args()))
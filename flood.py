@@ -0,0 +1,108 @@
+import time
+from collections import OrderedDict
+
+
+# Состояние одного пользователя. С __slots__ сто тысяч записей занимают около 20 МБ
+class _Bucket:
+    __slots__ = ("tokens", "updated", "muted_until", "strikes")
+
+    def __init__(self, tokens: float, now: float) -> None:
+        self.tokens = tokens
+        self.updated = now
+        self.muted_until = 0.0
+        self.strikes = 0
+
+
+# Защита от флуда до хендлеров: token bucket на пользователя (rate апдейтов в секунду,
+# запас burst). Кто исчерпал запас, попадает в мьют, и каждый следующий мьют вдвое
+# длиннее предыдущего, до max_mute. Если пользователь max_mute секунд ведет себя
+# спокойно, счетчик мьютов сбрасывается. Записей не больше maxsize, старые вытесняются по LRU
+class FloodGuard:
+    def __init__(
+        self,
+        rate: float = 1 / 3,
+        burst: int = 10,
+        mute: float = 60.0,
+        max_mute: float = 3600.0,
+        maxsize: int = 100_000,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.mute = mute
+        self.max_mute = max_mute
+        self.maxsize = maxsize
+
+        self.allowed = 0
+        self.dropped = 0
+        self.mutes = 0
+        self._buckets: OrderedDict[int, _Bucket] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = _Bucket(self.burst, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+
+        if now < bucket.muted_until:
+            self.dropped += 1
+            return False
+
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            self.allowed += 1
+            return True
+
+        if bucket.strikes and now - bucket.muted_until > self.max_mute:
+            bucket.strikes = 0
+        bucket.muted_until = now + min(self.mute * 2**bucket.strikes, self.max_mute)
+        bucket.strikes += 1
+        self.mutes += 1
+        self.dropped += 1
+        return False
+
+    # Сколько секунд осталось до конца мьюта, 0 если пользователь не в мьюте
+    def muted_for(self, user_id: int) -> float:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            return 0.0
+        return max(0.0, bucket.muted_until - time.monotonic())
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "size": len(self._buckets),
+            "allowed": self.allowed,
+            "dropped": self.dropped,
+            "mutes": self.mutes,
+            "muted": sum(now < bucket.muted_until for bucket in self._buckets.values()),
+        }
+
+
+# Уведомления о флуде в админ группу: не чаще одного за interval секунд. Мьюты между
+# уведомлениями не теряются, их число попадает в следующее уведомление
+class FloodNotices:
+    def __init__(self, interval: float = 300.0) -> None:
+        self.interval = interval
+        self.pending = 0
+        self.sent = 0
+        self._sent_at: float | None = None
+
+    # Учитывает новый мьют. Возвращает, о скольких мьютах сообщить сейчас, 0 если рано
+    def record(self) -> int:
+        self.pending += 1
+        now = time.monotonic()
+        if self._sent_at is not None and now - self._sent_at < self.interval:
+            return 0
+        self._sent_at = now
+        self.sent += 1
+        count, self.pending = self.pending, 0
+        return count
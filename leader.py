@@ -0,0 +1,106 @@
+import asyncio
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+
+# Аренда лидерства через advisory lock в Postgres. Лок живет, пока жива отдельная
+# сессия, поэтому при падении лидера Postgres сам отпускает его, как только заметит
+# разрыв соединения (tcp keepalive ниже), а при штатной остановке лок отпускается сразу.
+# Остальные реплики пробуют взять лок каждые retry_interval секунд
+class LeaderLease:
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        name: str = "valentine_bot",
+        retry_interval: float = 1.0,
+        heartbeat_interval: float = 2.0,
+    ) -> None:
+        self.engine = engine
+        self.name = name
+        self.retry_interval = retry_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.is_leader = False
+        self._conn: AsyncConnection | None = None
+
+    @property
+    def enabled(self) -> bool:
+        # На SQLite (локальный запуск, бенчмарки) реплика всегда одна
+        return self.engine.dialect.name == "postgresql"
+
+    async def _try_acquire(self) -> bool:
+        conn = await self.engine.connect()
+        try:
+            # Мертвый лидер должен отпустить лок за секунды, а не за часы tcp по умолчанию
+            await conn.execute(text("SET tcp_keepalives_idle = 5"))
+            await conn.execute(text("SET tcp_keepalives_interval = 2"))
+            await conn.execute(text("SET tcp_keepalives_count = 3"))
+            acquired = await conn.scalar(
+                text("SELECT pg_try_advisory_lock(hashtext(:name))"), {"name": self.name}
+            )
+            # Сессионный лок не зависит от транзакции, а открытая транзакция держала бы снапшот
+            await conn.commit()
+        except BaseException:
+            await conn.invalidate()
+            raise
+
+        if not acquired:
+            await conn.close()
+            return False
+        self._conn = conn
+        return True
+
+    async def acquire(self) -> None:
+        if self.enabled:
+            logged = False
+            while True:
+                try:
+                    if await self._try_acquire():
+                        break
+                except Exception as e:
+                    logger.warning(e)
+                if not logged:
+                    logger.info("Another replica is the leader, waiting for the lease")
+                    logged = True
+                await asyncio.sleep(self.retry_interval)
+
+        self.is_leader = True
+        logger.info("Leader lease acquired")
+
+    # Возвращается, когда аренда потеряна (соединение с базой оборвалось)
+    async def watch(self) -> None:
+        if not self.enabled:
+            await asyncio.Event().wait()
+
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await asyncio.wait_for(
+                    self._conn.execute(text("SELECT 1")), self.heartbeat_interval
+                )
+                await self._conn.commit()
+            except Exception as e:
+                logger.error(f"Leader lease lost: {e}")
+                self.is_leader = False
+                return
+
+    async def release(self) -> None:
+        self.is_leader = False
+        if self._conn is None:
+            return
+        try:
+            await self._conn.execute(
+                text("SELECT pg_advisory_unlock(hashtext(:name))"), {"name": self.name}
+            )
+            await self._conn.commit()
+            await self._conn.close()
+        except Exception as e:
+            logger.warning(e)
+            # Соединение с локом не должно вернуться в пул
+            await self._conn.invalidate()
+        finally:
+            self._conn = None
+        logger.info("Leader lease released")
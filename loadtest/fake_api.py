@@ -0,0 +1,189 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict, deque
+
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Cupid",
+    "username": "loadtest_cupidbot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+
+# Заглушка Bot API для нагрузочного теста. Отдает апдейты через getUpdates,
+# принимает sendMessage и, как настоящий Telegram, отвечает 429 (RetryAfter),
+# если в группу или канал пишут чаще chat_limit сообщений в минуту
+class FakeBotAPI:
+    def __init__(
+        self,
+        chat_limit: int = 20,
+        retry_after_probability: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.chat_limit = chat_limit
+        self.retry_after_probability = retry_after_probability
+        self.random = random.Random(seed)
+
+        self.calls: Counter = Counter()
+        self.retry_afters = 0
+        self.delivered_at: dict[int, float] = {}
+
+        self._updates: deque[dict] = deque()
+        # Апдейты для ботов с отдельной очередью (benchmarks/tenants.py), остальные боты
+        # читают общую _updates
+        self._bot_updates: dict[str, deque[dict]] = {}
+        self._new_updates = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        self._replies: dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self._chat_sends: dict[int, deque] = defaultdict(deque)
+        self._server: tornado.httpserver.HTTPServer | None = None
+
+    def push_message(
+        self, user_id: int, text: str | None = None, token: str | None = None, **extra
+    ) -> int:
+        self._update_id += 1
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {
+                "id": user_id,
+                "is_bot": False,
+                "first_name": f"User{user_id}",
+                "username": f"user{user_id}",
+            },
+            **extra,
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                command = text.split()[0]
+                message["entities"] = [
+                    {"type": "bot_command", "offset": 0, "length": len(command)}
+                ]
+        updates = self._updates
+        if token is not None:
+            updates = self._bot_updates.setdefault(token, deque())
+        updates.append({"update_id": self._update_id, "message": message})
+        self._new_updates.set()
+        return self._update_id
+
+    async def next_reply(self, chat_id: int, timeout: float = 30) -> dict:
+        return await asyncio.wait_for(self._replies[chat_id].get(), timeout)
+
+    async def start(self, port: int = 0) -> int:
+        app = tornado.web.Application(
+            [(r"/bot(?P<token>[^/]+)/(?P<method>\w+)", _MethodHandler, {"api": self})]
+        )
+        self._server = tornado.httpserver.HTTPServer(app)
+        sockets = tornado.netutil.bind_sockets(port, "127.0.0.1")
+        self._server.add_sockets(sockets)
+        return sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        # Отпускаем висящие long polling запросы
+        self._new_updates.set()
+        if self._server:
+            self._server.stop()
+            await self._server.close_all_connections()
+
+    async def call(self, method: str, params: dict, token: str = "") -> tuple[int, dict]:
+        self.calls[method] += 1
+        if method.lower() == "getupdates":
+            return await self.api_getupdates(params, self._bot_updates.get(token, self._updates))
+        handler = getattr(self, f"api_{method.lower()}", None)
+        if handler is None:
+            return 200, {"ok": True, "result": True}
+        return await handler(params)
+
+    async def api_getme(self, params: dict) -> tuple[int, dict]:
+        return 200, {"ok": True, "result": BOT_USER}
+
+    async def api_getupdates(self, params: dict, updates: deque) -> tuple[int, dict]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+
+        while updates and updates[0]["update_id"] < offset:
+            updates.popleft()
+        if not updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        result = list(updates)[:limit]
+        now = time.perf_counter()
+        for update in result:
+            self.delivered_at.setdefault(update["update_id"], now)
+        return 200, {"ok": True, "result": result}
+
+    async def api_sendmessage(self, params: dict) -> tuple[int, dict]:
+        chat_id = int(params["chat_id"])
+
+        retry_after = self._retry_after(chat_id)
+        if retry_after:
+            self.retry_afters += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }
+
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {
+                "id": chat_id,
+                "type": "private" if chat_id > 0 else "supergroup",
+            },
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+        self._replies[chat_id].put_nowait(message)
+        return 200, {"ok": True, "result": message}
+
+    def _retry_after(self, chat_id: int) -> int:
+        if self.retry_after_probability and self.random.random() < self.retry_after_probability:
+            return 1
+        if chat_id > 0:
+            return 0
+
+        now = time.monotonic()
+        sends = self._chat_sends[chat_id]
+        while sends and sends[0] <= now - 60:
+            sends.popleft()
+        if len(sends) >= self.chat_limit:
+            return max(1, int(sends[0] + 60 - now + 1))
+        sends.append(now)
+        return 0
+
+
+class _MethodHandler(tornado.web.RequestHandler):
+    def initialize(self, api: FakeBotAPI) -> None:
+        self.api = api
+
+    async def post(self, token: str, method: str) -> None:
+        params = {key: values[-1].decode() for key, values in self.request.body_arguments.items()}
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(self.request.body or b"{}")
+        status, payload = await self.api.call(method, params, token)
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(payload))
+
+    get = post
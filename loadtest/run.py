@@ -0,0 +1,289 @@
+# Нагрузочный тест бота.
+#
+# Поднимает заглушку Bot API (loadtest/fake_api.py), запускает настоящее
+# приложение из main.build_application и прогоняет N пользователей через
+# /start -> контакт -> /valentine -> текст -> получатель -> анонимность -> отправка.
+# Печатает пропускную способность, p50/p95/p99 по каждому хендлеру и число
+# запросов к БД на апдейт.
+#
+# БД берется только из DB_URL и перед прогоном очищается, поэтому это должна быть
+# отдельная база:
+#
+#   DB_URL=postgresql://postgres@localhost/loadtest python -m loadtest.run --users 2000
+#   DB_URL=sqlite:///loadtest.db python -m loadtest.run --users 500 --json result.json
+#   DB_URL=... python -m loadtest.run --compare result.json
+#
+# На Postgres каждый хендлер должен укладываться в --query-budget запросов к БД
+# на апдейт (по умолчанию один round trip), иначе прогон падает
+# На SQLite запись идет по одной транзакции (WAL и SQLITE_BUSY_TIMEOUT, см.
+# db_sqlalchemy), поэтому задержки записи там растут с --concurrency
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+
+TOKEN = "123456:LOADTEST"
+ADMIN_GROUP = -1001
+CHANNEL_ID = -1002
+
+STEPS = [
+    "start",
+    "contact_handler",
+    "ticket_handler",
+    "valentine",
+    "recipient",
+    "anonimity",
+    "confirmation",
+]
+
+current_step = contextvars.ContextVar("current_step", default="background")
+
+
+def percentile(values: list, q: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[int(q) - 1]
+
+
+class LoadTest:
+    def __init__(self, api, users: int, concurrency: int, timeout: float, seed: int):
+        self.api = api
+        self.users = users
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.random = random.Random(seed)
+
+        self.latencies: dict[str, list] = defaultdict(list)
+        self.step_of_update: dict[int, str] = {}
+        self.updates_per_step: Counter = Counter()
+        self.queries: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.completed = 0
+
+    def count_query(self, *args) -> None:
+        self.queries[current_step.get()] += 1
+
+    # Самый первый обработчик: помечает контекст апдейта шагом сценария,
+    # чтобы запросы к БД можно было разнести по хендлерам
+    async def mark_update(self, update, context) -> None:
+        current_step.set(self.step_of_update.get(update.update_id, "other"))
+
+    async def step(self, user_id: int, step: str, replies: int = 1, **message) -> None:
+        update_id = self.api.push_message(user_id, **message)
+        self.step_of_update[update_id] = step
+        self.updates_per_step[step] += 1
+        for _ in range(replies):
+            await self.api.next_reply(user_id, self.timeout)
+        delivered_at = self.api.delivered_at.get(update_id, time.perf_counter())
+        self.latencies[step].append((time.perf_counter() - delivered_at) * 1000)
+
+    async def user(self, user_id: int, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            try:
+                await self.step(user_id, "start", text="/start")
+                await self.step(
+                    user_id,
+                    "contact_handler",
+                    contact={
+                        "phone_number": f"996{user_id}",
+                        "first_name": f"User{user_id}",
+                        "user_id": user_id,
+                    },
+                )
+                await self.step(user_id, "ticket_handler", text="/valentine")
+                await self.step(
+                    user_id,
+                    "valentine",
+                    text=f"С днем святого Валентина! {self.random.random()}",
+                )
+                await self.step(user_id, "recipient", text=f"@friend{user_id} Друг")
+                await self.step(
+                    user_id, "anonimity", replies=2, text=self.random.choice(["Да", "Нет"])
+                )
+                await self.step(user_id, "confirmation", text="Отправить")
+                self.completed += 1
+            except asyncio.TimeoutError:
+                self.errors["timeout"] += 1
+
+    async def run(self) -> float:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(self.user(10**9 + i, semaphore) for i in range(self.users))
+        )
+        return time.perf_counter() - started
+
+
+async def reset_database(engine, metadata) -> None:
+    async with engine.begin() as conn:
+        for table in reversed(metadata.sorted_tables):
+            await conn.execute(table.delete())
+
+
+async def main(args: argparse.Namespace) -> dict:
+    if not os.environ.get("DB_URL"):
+        sys.exit("DB_URL is not set. Use a throwaway database, it is wiped before the run")
+
+    os.environ.setdefault("ADMIN_GROUP", str(ADMIN_GROUP))
+    os.environ.setdefault("CHANNEL_ID", str(CHANNEL_ID))
+    os.environ.setdefault("OUTBOX_PER_MINUTE", str(args.chat_limit))
+
+    from sqlalchemy import event
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    import db_sqlalchemy
+    import main as bot_main
+    from loadtest.fake_api import FakeBotAPI
+
+    await db_sqlalchemy.prepare_database()
+    await reset_database(db_sqlalchemy.get_async_engine(), db_sqlalchemy.Base.metadata)
+
+    api = FakeBotAPI(
+        chat_limit=args.chat_limit,
+        retry_after_probability=args.retry_after_probability,
+        seed=args.seed,
+    )
+    port = await api.start()
+    test = LoadTest(api, args.users, args.concurrency, args.timeout, args.seed)
+
+    application = bot_main.build_application(
+        bot_main.env_tenant(TOKEN), base_url=f"http://127.0.0.1:{port}/bot"
+    )
+    application.add_handler(TypeHandler(Update, test.mark_update), group=-100)
+    event.listen(
+        db_sqlalchemy.get_async_engine().sync_engine, "before_cursor_execute", test.count_query
+    )
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling(poll_interval=0, timeout=10)
+    await application.start()
+    try:
+        elapsed = await test.run()
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+        await api.stop()
+
+    updates = sum(test.updates_per_step.values())
+    result = {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "completed": test.completed,
+        "errors": dict(test.errors),
+        "elapsed_s": elapsed,
+        "conversations_per_s": test.completed / elapsed,
+        "updates_per_s": updates / elapsed,
+        "retry_after": api.retry_afters,
+        "api_calls": dict(api.calls),
+        "background_queries": test.queries["background"],
+        "handlers": {
+            step: {
+                "p50_ms": percentile(test.latencies[step], 50),
+                "p95_ms": percentile(test.latencies[step], 95),
+                "p99_ms": percentile(test.latencies[step], 99),
+                "queries_per_update": test.queries[step]
+                / max(1, test.updates_per_step[step]),
+            }
+            for step in STEPS
+        },
+    }
+    return result
+
+
+def report(result: dict) -> None:
+    print(
+        f"{result['completed']}/{result['users']} conversations in {result['elapsed_s']:.1f}s: "
+        f"{result['conversations_per_s']:.1f} conv/s, {result['updates_per_s']:.1f} updates/s"
+    )
+    print(f"Errors: {result['errors'] or 'none'}, RetryAfter from fake API: {result['retry_after']}")
+    print(f"Background DB queries (outbox, persistence): {result['background_queries']}")
+    print()
+    print(f"{'handler':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}")
+    for step, stats in result["handlers"].items():
+        print(
+            f"{step:<16}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+            f"{stats['p99_ms']:>10.1f}{stats['queries_per_update']:>10.2f}"
+        )
+
+
+# Сравнение с прошлым прогоном: падаем, если p95 или пропускная способность
+# ухудшились больше чем на tolerance, или хендлеру понадобилось больше запросов к БД
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    if result["conversations_per_s"] < baseline["conversations_per_s"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {result['conversations_per_s']:.1f} < {baseline['conversations_per_s']:.1f} conv/s"
+        )
+    for step, stats in result["handlers"].items():
+        old = baseline["handlers"].get(step)
+        if not old:
+            continue
+        if stats["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{step} p95 {stats['p95_ms']:.1f} > {old['p95_ms']:.1f} ms")
+        if stats["queries_per_update"] > old["queries_per_update"] + 0.01:
+            regressions.append(
+                f"{step} queries {stats['queries_per_update']:.2f} > {old['queries_per_update']:.2f}"
+            )
+    return regressions
+
+
+# Хендлеры, которым понадобилось больше запросов к БД, чем разрешено
+def over_budget(result: dict, budget: float) -> list:
+    return [
+        f"{step} queries {stats['queries_per_update']:.2f} > budget {budget:g}"
+        for step, stats in result["handlers"].items()
+        if stats["queries_per_update"] > budget + 0.01
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chat-limit", type=int, default=20, help="лимит сообщений в минуту на группу/канал")
+    parser.add_argument("--retry-after-probability", type=float, default=0.0)
+    parser.add_argument("--json", help="сохранить результат в файл")
+    parser.add_argument("--compare", help="сравнить с результатом прошлого прогона")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--query-budget",
+        type=float,
+        help="максимум запросов к БД на апдейт, по умолчанию 1 для Postgres",
+    )
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    report(result)
+
+    budget = args.query_budget
+    if budget is None and os.environ["DB_URL"].startswith("postgresql"):
+        budget = 1
+    failures = over_budget(result, budget) if budget is not None else []
+    for failure in failures:
+        print(f"OVER BUDGET: {failure}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        failures += regressions
+
+    if failures:
+        sys.exit(1)
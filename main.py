@@ -1,25 +1,76 @@
+import asyncio
+import contextlib
 import datetime
 import logging
 import os
-
-from sqlalchemy.orm import sessionmaker
-from telegram import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+import signal
+import tempfile
+
+from telegram import (
+    KeyboardButton,
+    Message,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+    Update,
+    User,
+)
 from telegram.constants import ParseMode
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
+    ApplicationHandlerStop,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 from telegram.helpers import escape_markdown
 
-from db_sqlalchemy import User, Valentine, engine
-
-Session = sessionmaker(bind=engine)
-session = Session()
-
+from cooldown import format_wait
+from db_sqlalchemy import DEFAULT_TENANT, async_session, get_async_engine, prepare_database
+from db_persistence import DBPersistence
+from draft import DRAFT, ValentineDraft
+from export import FORMATS, export_filename, write_export
+from flood import FloodGuard
+from leader import LeaderLease
+from media import (
+    CAPTIONLESS,
+    MAX_CAPTION,
+    MEDIA,
+    MEDIA_NAMES,
+    Attachment,
+    attachment_of,
+    send_media,
+)
+from metrics import (
+    InstrumentedRequest,
+    add_counter,
+    add_gauge,
+    install_db_metrics,
+    instrument,
+    serve,
+    summary,
+)
+from outbox import Outbox
+import retention
+import rollups
+from update_processor import PerUserUpdateProcessor
+from repository import (
+    PendingValentine,
+    add_valentines,
+    block_sender,
+    find_sender,
+    find_media,
+    find_valentines,
+    register_user,
+)
+from repository import get_user as db_get_user
+from tenants import TENANT, Tenant, load_tenants
+from webhook import start_webhooks, stop_webhooks
+from write_behind import ValentineWriteBuffer
+from user_cache import CachedUser
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -31,72 +82,197 @@ VALENTINE, RECIPIENT, ANONIMITY, CONFIRMATION = range(4)
 
 VALENTINE_COOLDOWN = 20
 
+# Несколько ботов (арендаторов) в одном процессе, см. tenants.py. Если файл не задан,
+# бот один, с токеном и чатами из env переменных ниже
+TENANTS_FILE = os.environ.get("TENANTS_FILE")
+tenants: list[Tenant] = []
+
 # Группа администраторов
 ADMIN_GROUP = os.environ.get("ADMIN_GROUP")
 # Канал куда будут приходит валентинки
 CHANNEL_ID = os.environ.get("CHANNEL_ID")
 
+# Дайджест: валентинки, подтвержденные за DIGEST_WINDOW секунд, выходят в канале
+# одним постом (не больше DIGEST_SIZE штук), см. Outbox._digest
+DIGEST = os.environ.get("DIGEST", "0") == "1"
 
-def db_add_valentine(
-    sender: User,
-    recipient: str,
-    text: str,
-    date: datetime,
-    admin_message_id: int,
-) -> None:
-    valentine = Valentine(
-        sender=sender.id,
-        recipient=recipient,
-        text=str(text),
-        date=date,
-        admin_message_id=admin_message_id,
-    )
+# Отложенная запись валентинок пачками, см. write_behind.py
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "0") == "1"
+
+# Порт для метрик в формате Prometheus, если не задан - метрики доступны только через /stats
+METRICS_PORT = os.environ.get("METRICS_PORT")
 
-    session.add(valentine)
-    session.commit()
+# polling или webhook. Для webhook нужен WEBHOOK_URL - публичный адрес приложения
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
 
+# Похожие валентинки (спам одним текстом разным адресатам): flag - пометить копию
+# в админ группе, reject - не принимать
+SPAM_ACTION = os.environ.get("SPAM_ACTION", "flag")
 
-def db_create_user(user_id: int, full_name: str, user_name: str, phone: str) -> None:
-    user = User(
-        user_id=int(user_id),
-        full_name=str(full_name),
-        user_name=str(user_name),
-        phone=str(phone),
+# Отложенная публикация: валентинки с кнопкой SCHEDULE_BUTTON появятся в канале в
+# RELEASE_AT (ISO формат с таймзоной), по умолчанию в полночь 14 февраля по Бишкеку.
+# Отложенные сообщения каждые RELEASE_INTERVAL секунд отпускаются в очередь отправки
+# пачками по лимиту канала, см. Outbox.release
+SCHEDULE_BUTTON = "Отправить 14 февраля"
+RELEASE_AT = datetime.datetime.fromisoformat(
+    os.environ.get(
+        "RELEASE_AT", f"{datetime.date.today().year}-02-14T00:00:00+06:00"
     )
+)
+RELEASE_INTERVAL = 15
 
-    session.add(user)
-    session.commit()
+# Сколько последних сезонов держать в valentine, более старые раз в сутки уходят в
+# холодные таблицы, см. retention.py. Без переменной старые сезоны не трогаются
+RETENTION_SEASONS = os.environ.get("RETENTION_SEASONS")
 
 
-# Проверка на то, что пользователь может отправить валентинку. Кулдаун настраивается в VALENTINE_COOLDOWN
-def can_post(user_id: int) -> bool:
-    try:
-        user = session.query(User).filter(User.user_id == user_id).first()
+def scheduling_open() -> bool:
+    return RELEASE_AT > datetime.datetime.now(datetime.timezone.utc)
+
+
+# Защита от флуда: не больше FLOOD_PER_MINUTE апдейтов в минуту с запасом FLOOD_BURST,
+# мьют от FLOOD_MUTE секунд, удваивается с каждым повтором. Одна на процесс: флудящий
+# в нескольких ботах пользователь тратит один запас
+flood = FloodGuard(
+    rate=float(os.environ.get("FLOOD_PER_MINUTE", 20)) / 60,
+    burst=int(os.environ.get("FLOOD_BURST", 10)),
+    mute=float(os.environ.get("FLOOD_MUTE", 60)),
+)
+
+
+# Бот из env переменных. Проверка на то, что пользователь может отправить валентинку:
+# кулдаун настраивается в VALENTINE_COOLDOWN, у арендаторов из файла - в их cooldown
+def env_tenant(bot_token: str) -> Tenant:
+    return Tenant(
+        DEFAULT_TENANT,
+        bot_token,
+        ADMIN_GROUP,
+        CHANNEL_ID,
+        cooldown=VALENTINE_COOLDOWN,
+        digest=DIGEST,
+    )
 
-        last_valentine = (
-            session.query(Valentine)
-            .filter(Valentine.sender == user.id)
-            .order_by(Valentine.id.desc())
-            .first()
-        )
-    except Exception as e:
-        logger.warning(e)
-        session.rollback()
-        return False
-    finally:
-        session.close()
 
-    now_utc = datetime.datetime.now(datetime.timezone.utc)
+def is_admin_chat(update: Update, tenant: Tenant) -> bool:
+    return str(update.effective_chat.id) == tenant.admin_group
 
-    if last_valentine is None:
-        return True
 
-    if now_utc.replace(tzinfo=None) - last_valentine.date > datetime.timedelta(
-        minutes=VALENTINE_COOLDOWN
+# Возвращает False, если валентинка не записана: отправитель заблокирован или не найден
+async def db_add_valentine(
+    tenant: Tenant,
+    telegram_id: int,
+    recipient: str,
+    text: str,
+    date: datetime,
+    anonymous: bool,
+    channel_text: str,
+    admin_text: str,
+    release_at: datetime.datetime | None = None,
+    attachment: Attachment | None = None,
+) -> bool:
+    valentine = PendingValentine(
+        telegram_id=telegram_id,
+        recipient=recipient,
+        text=str(text),
+        # asyncpg не принимает datetime с таймзоной для колонки без таймзоны
+        date=date.astimezone(datetime.timezone.utc).replace(tzinfo=None),
+        anonymous=anonymous,
+        channel_id=tenant.channel_id,
+        channel_text=channel_text,
+        admin_group=tenant.admin_group,
+        admin_text=admin_text,
+        release_at=(
+            release_at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            if release_at
+            else None
+        ),
+        media_type=attachment.type if attachment else None,
+        file_id=attachment.file_id if attachment else None,
+        file_unique_id=attachment.file_unique_id if attachment else None,
+    )
+
+    if tenant.write_buffer:
+        # Буфер пишет позже, поэтому блокировку проверяем по кэшу
+        sender = await get_user(tenant, telegram_id)
+        if not sender or sender.blocked:
+            return False
+        await tenant.write_buffer.add(valentine)
+    else:
+        # Отправитель ищется и проверяется в том же запросе, что и вставка
+        async with async_session() as session:
+            written = await add_valentines(session, tenant.outbox, [valentine])
+            await session.commit()
+        if not written:
+            tenant.user_cache.invalidate(telegram_id)
+            return False
+        tenant.outbox.notify()
+
+    tenant.cooldowns.touch(telegram_id, valentine.date)
+    tenant.user_cache.update(telegram_id, last_valentine_at=valentine.date)
+    return True
+
+
+# Пользователь одним запросом, дальше из кэша
+async def get_user(tenant: Tenant, user_id: int) -> CachedUser | None:
+    cached = tenant.user_cache.get(user_id)
+    if cached:
+        return cached
+
+    async with async_session() as session:
+        cached = await db_get_user(session, tenant.name, user_id)
+
+    if cached:
+        tenant.user_cache.put(cached)
+    return cached
+
+
+# Первая группа хендлеров: апдейты сверх лимита отбрасываются до запросов в базу и
+# ответов. Админ группа не ограничивается
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if user is None or (
+        update.effective_chat and is_admin_chat(update, context.bot_data[TENANT])
     ):
-        return True
+        return
 
+    mutes = flood.mutes
+    if not flood.allow(user.id):
+        if flood.mutes != mutes:
+            muted_for = flood.muted_for(user.id)
+            logger.warning(f"Flood from {user.id}, muted for {muted_for:.0f}s")
+            tenant = context.bot_data[TENANT]
+            count = tenant.flood_notices.record()
+            if count and tenant.admin_group:
+                context.application.create_task(
+                    notify_flood(tenant, user, muted_for, count - 1), update=update
+                )
+        raise ApplicationHandlerStop
 
+
+# Уведомление о мьюте в админ группу через очередь отправки, в фоне, чтобы не
+# задерживать отброс апдейтов. Частоту ограничивает tenant.flood_notices
+async def notify_flood(
+    tenant: Tenant, user: User, muted_for: float, suppressed: int
+) -> None:
+    text = (
+        f"Флуд: {user.full_name} (@{user.username or '-'}, id {user.id}) "
+        f"в мьюте на {muted_for:.0f}с"
+    )
+    if suppressed:
+        text += f"\nЕще мьютов с прошлого уведомления: {suppressed}"
+    async with async_session() as session:
+        try:
+            tenant.outbox.enqueue(session, tenant.admin_group, text)
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            logger.warning(e)
+            return
+    tenant.outbox.notify()
+
+
+@instrument
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     reply_keyboard = ReplyKeyboardMarkup(
         [[KeyboardButton("Отправить номер телефона", request_contact=True)]],
@@ -111,25 +287,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+@instrument
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
-        "/start - Запустить бота\n/help - Помощь и информация о боте\n/valentine - Отправить валентинку \n\nПросто отправьте нужную команду и Вам будут показаны дальнейшие инструкции. Не бойтесь, перед отправкой валентинки Вас попросят подтвердить отправку. Отправлять можно только текст каждые 20 минут.\n\nДИСКЛЕЙМЕР:\nМы собираем следующую информацию о Вас: имя и фамилия, юзернейм, номер телефона, информация о валентинках(текст, получатель). Эта информация необходима для того, чтобы мы могли связаться с Вами в случае каких-либо проблем.",
+        "/start - Запустить бота\n/help - Помощь и информация о боте\n/valentine - Отправить валентинку \n\nПросто отправьте нужную команду и Вам будут показаны дальнейшие инструкции. Не бойтесь, перед отправкой валентинки Вас попросят подтвердить отправку. Отправлять можно текст, фото, стикеры, голосовые, видео и гифки каждые 20 минут.\n\nДИСКЛЕЙМЕР:\nМы собираем следующую информацию о Вас: имя и фамилия, юзернейм, номер телефона, информация о валентинках(текст, получатель). Эта информация необходима для того, чтобы мы могли связаться с Вами в случае каких-либо проблем.",
         reply_markup=ReplyKeyboardRemove(),
     )
 
 
+@instrument
 async def ticket_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tenant = context.bot_data[TENANT]
     try:
-        user = (
-            session.query(User)
-            .filter(User.user_id == update.message.from_user.id)
-            .first()
-        )
+        user = await get_user(tenant, update.message.from_user.id)
     except Exception as e:
-        session.rollback()
         logger.warning(e)
-    finally:
-        session.close()
+        user = None
 
     if not user:
         await update.message.reply_text(
@@ -149,9 +322,10 @@ async def ticket_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    if not can_post(update.message.from_user.id):
+    wait = tenant.cooldowns.remaining(user.user_id)
+    if wait:
         await update.message.reply_text(
-            "Не торопитесь, вы уже отправили валентинку💌\n\nПопробуйте позже",
+            f"Не торопитесь, вы уже отправили валентинку💌\n\nСледующую можно отправить через {format_wait(wait)}",
             reply_markup=ReplyKeyboardRemove(),
         )
         return ConversationHandler.END
@@ -163,6 +337,7 @@ async def ticket_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return VALENTINE
 
 
+@instrument
 async def valentine(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message:
         return ConversationHandler.END
@@ -178,14 +353,45 @@ async def valentine(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return VALENTINE
 
-    if len(update.message.text) > 500:
+    # У медиа валентинки текст - подпись, ее может и не быть
+    attachment = attachment_of(update.message)
+    text = (update.message.caption or "") if attachment else update.message.text
+    limit = MAX_CAPTION if attachment else 500
+
+    tenant = context.bot_data[TENANT]
+    repeats = None
+    if attachment:
+        try:
+            async with async_session() as session:
+                repeats = await find_media(session, tenant.name, attachment.file_unique_id)
+        except Exception as e:
+            logger.warning(e)
+    # Повтор - файл, который уже присылал кто-то другой. Стикеры не в счет:
+    # популярные шлют все подряд
+    repeated = (
+        repeats
+        and attachment.type not in CAPTIONLESS
+        and repeats[1] != update.message.from_user.id
+    )
+
+    if len(text) > limit:
         await update.message.reply_text(
-            "Ваше послание слишком длинное. Пожалуйста, введите сообщение короче 500 символов",
+            f"Ваше послание слишком длинное. Пожалуйста, введите сообщение короче {limit} символов",
+            reply_markup=ReplyKeyboardRemove(),
+        )
+        return VALENTINE
+    elif SPAM_ACTION == "reject" and (repeated or tenant.spam_index.find(text)):
+        tenant.spam_index.rejected += 1
+        await update.message.reply_text(
+            "Очень похожая валентинка уже была отправлена. Пожалуйста, напишите свой текст",
             reply_markup=ReplyKeyboardRemove(),
         )
         return VALENTINE
     else:
-        context.user_data[VALENTINE] = update.message
+        draft = context.user_data[DRAFT] = ValentineDraft(text=text)
+        if attachment:
+            draft.media_type, draft.file_id, draft.file_unique_id = attachment
+            draft.repeats = repeats[0] if repeated else 0
         try:
             await update.message.reply_text(
                 text="Кто получит валентинку? \n\nPS: Вы можете ввести имя пользователя и имя\nПример: @Barnacle Арстан",
@@ -200,6 +406,7 @@ async def valentine(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return RECIPIENT
 
 
+@instrument
 async def recipient(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message:
         return ConversationHandler.END
@@ -224,7 +431,7 @@ async def recipient(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return RECIPIENT
 
-    context.user_data[RECIPIENT] = update.message
+    context.user_data[DRAFT].recipient = update.message.text
 
     await update.message.reply_text(
         text="Отправить анонимно? \n\n",
@@ -239,6 +446,25 @@ async def recipient(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     return ANONIMITY
 
 
+# Превью валентинки в том виде, в каком она выйдет в канале
+async def reply_preview(
+    context: ContextTypes.DEFAULT_TYPE, message: Message, text: str
+) -> None:
+    draft = context.user_data[DRAFT]
+    if not draft.file_id or draft.media_type in CAPTIONLESS:
+        await message.reply_text(text=text, parse_mode=ParseMode.MARKDOWN_V2)
+    if draft.file_id:
+        await send_media(
+            context.bot,
+            message.chat_id,
+            draft.media_type,
+            draft.file_id,
+            caption=text,
+            parse_mode=ParseMode.MARKDOWN_V2,
+        )
+
+
+@instrument
 async def anonimity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message:
         return ConversationHandler.END
@@ -247,8 +473,11 @@ async def anonimity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Отмена", reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
-    context.user_data[ANONIMITY] = update.message.text
+    draft = context.user_data[DRAFT]
+    draft.anonymous = update.message.text.lower() == "да"
     reply_keyboard = [["Отправить", "Отменить"]]
+    if scheduling_open():
+        reply_keyboard.append([SCHEDULE_BUTTON])
     if update.message.text.lower() == "да":
         msg = await update.message.reply_text(
             "Окей, никто не увидит Ваше имя. \n\nВалентинка будет выглядеть так: \n\n",
@@ -259,9 +488,10 @@ async def anonimity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 input_field_placeholder="Отправить?",
             ),
         )
-        await msg.reply_text(
-            text=f"*От:* Анонима \n*Кому:* {escape_markdown(context.user_data[RECIPIENT].text, version=2)} \n\n{escape_markdown(context.user_data[VALENTINE].text, version=2)}",
-            parse_mode=ParseMode.MARKDOWN_V2,
+        await reply_preview(
+            context,
+            msg,
+            f"*От:* Анонима \n*Кому:* {escape_markdown(draft.recipient, version=2)} \n\n{escape_markdown(draft.text, version=2)}",
         )
 
     elif update.message.text.lower() == "нет":
@@ -277,67 +507,83 @@ async def anonimity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         first_name = update.message.from_user.first_name or "Нет имени"
         user_name = update.message.from_user.username or "Нет ника"
 
-        await msg.reply_text(
-            text=f"*От:* {escape_markdown(first_name, version=2)} \| @{escape_markdown(user_name, version=2)}\n*Кому:* {escape_markdown(context.user_data[RECIPIENT].text, version=2)} \n\n{escape_markdown(context.user_data[VALENTINE].text, version=2)}",
-            parse_mode=ParseMode.MARKDOWN_V2,
+        await reply_preview(
+            context,
+            msg,
+            f"*От:* {escape_markdown(first_name, version=2)} \| @{escape_markdown(user_name, version=2)}\n*Кому:* {escape_markdown(draft.recipient, version=2)} \n\n{escape_markdown(draft.text, version=2)}",
         )
 
     return CONFIRMATION
 
 
+@instrument
 async def confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message:
         return ConversationHandler.END
 
-    if update.message.text.lower() == "отправить":
+    if update.message.text.lower() in ("отправить", SCHEDULE_BUTTON.lower()):
+        tenant = context.bot_data[TENANT]
+        scheduled = update.message.text == SCHEDULE_BUTTON and scheduling_open()
         first_name = update.message.from_user.first_name or "Нет имени"
         user_name = update.message.from_user.username or "Нет ника"
-        sender = (
-            "Анонима"
-            if context.user_data[ANONIMITY] == "Да"
-            else f"{first_name} | @{user_name}"
-        )
-
-        await bot.send_message(
-            chat_id=CHANNEL_ID,
-            text=f"*От:* {escape_markdown(sender, version=2)}\n*Кому:* {escape_markdown(context.user_data[RECIPIENT].text, version=2)} \n\n{escape_markdown(context.user_data[VALENTINE].text, version=2)}\n\n@bilimkana\_cupidbot",
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
-
-        admin_message_id = await bot.send_message(
-            chat_id=ADMIN_GROUP,
-            text=f"От: {sender} \nКому: {context.user_data[RECIPIENT].text} \n\n{context.user_data[VALENTINE].text}",
-        )
-
-        await update.message.reply_text(
-            "Ваша валентинка отправлена\!📫 Найти ее можно [тут](https://t.me/bk_valentines)💌",
-            reply_markup=ReplyKeyboardRemove(),
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
+        draft = context.user_data[DRAFT]
+        sender = "Анонима" if draft.anonymous else f"{first_name} | @{user_name}"
+
+        admin_text = f"От: {sender} \nКому: {draft.recipient} \n\n{draft.text}"
+        match = tenant.spam_index.find(draft.text)
+        if match:
+            tenant.spam_index.flagged += 1
+            author = (
+                "того же отправителя"
+                if match.sender_id == update.message.from_user.id
+                else "другого отправителя"
+            )
+            admin_text = f"⚠️ Похожа на валентинку от {author} ({match.similarity:.0%})\n\n{admin_text}"
+        if draft.repeats:
+            admin_text = f"⚠️ Это {MEDIA_NAMES[draft.media_type]} уже отправляли {draft.repeats} раз\n\n{admin_text}"
 
         try:
-            user = (
-                session.query(User)
-                .filter(User.user_id == update.message.from_user.id)
-                .first()
+            written = await db_add_valentine(
+                tenant,
+                telegram_id=update.message.from_user.id,
+                recipient=draft.recipient,
+                text=draft.text,
+                date=datetime.datetime.now(datetime.timezone.utc),
+                anonymous=bool(draft.anonymous),
+                channel_text=f"*От:* {escape_markdown(sender, version=2)}\n*Кому:* {escape_markdown(draft.recipient, version=2)} \n\n{escape_markdown(draft.text, version=2)}\n\n{escape_markdown('@' + context.bot.username, version=2)}",
+                admin_text=admin_text,
+                release_at=RELEASE_AT if scheduled else None,
+                attachment=(
+                    Attachment(draft.media_type, draft.file_id, draft.file_unique_id)
+                    if draft.file_id
+                    else None
+                ),
             )
-            if user:
-                db_add_valentine(
-                    sender=user,
-                    recipient=context.user_data[RECIPIENT].text,
-                    text=context.user_data[VALENTINE].text,
-                    date=datetime.datetime.now(datetime.timezone.utc),
-                    admin_message_id=admin_message_id.message_id,
-                )
         except Exception as e:
-            session.rollback()
             logger.warning(e)
             await update.message.reply_text(
                 "Ошибка базы данных! Обратитесь к @Barnacle",
                 reply_markup=ReplyKeyboardRemove(),
             )
-        finally:
-            session.close()
+            return ConversationHandler.END
+
+        if not written:
+            context.user_data.pop(DRAFT, None)
+            await update.message.reply_text(
+                "Вы заблокированы. Обратитесь к администрации.",
+                reply_markup=ReplyKeyboardRemove(),
+            )
+            return ConversationHandler.END
+
+        tenant.spam_index.add(draft.text, update.message.from_user.id)
+
+        # Сама отправка в канал идет через очередь и может занять немного времени
+        when = "появится 14 февраля" if scheduled else "скоро появится"
+        await update.message.reply_text(
+            f"Ваша валентинка принята и {when} [в канале]({tenant.channel_url})\!📫💌",
+            reply_markup=ReplyKeyboardRemove(),
+            parse_mode=ParseMode.MARKDOWN_V2,
+        )
 
     elif update.message.text.lower() == "отменить":
         await update.message.reply_text(
@@ -345,37 +591,29 @@ async def confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             reply_markup=ReplyKeyboardRemove(),
         )
 
+    context.user_data.pop(DRAFT, None)
     return ConversationHandler.END
 
 
+@instrument
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data.pop(DRAFT, None)
     await update.message.reply_text("Отмена", reply_markup=ReplyKeyboardRemove())
 
     return ConversationHandler.END
 
 
+@instrument
 async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    try:
-        user = (
-            session.query(User)
-            .filter(User.user_id == update.message.from_user.id)
-            .first()
-        )
-        if user:
-            await update.message.reply_text(
-                "Вы уже подтвердили свой номер телефона!\n\nОтправьте /valentine",
-                reply_markup=ReplyKeyboardRemove(),
-            )
-            return
-    except Exception as e:
-        session.rollback()
-        logger.warning(e)
+    tenant = context.bot_data[TENANT]
+    already_registered = (
+        "Вы уже подтвердили свой номер телефона!\n\nОтправьте /valentine"
+    )
+    if tenant.user_cache.get(update.message.from_user.id):
         await update.message.reply_text(
-            "Ошибка базы данных! Обратитесь к @Barnacle",
-            reply_markup=ReplyKeyboardRemove(),
+            already_registered, reply_markup=ReplyKeyboardRemove()
         )
-    finally:
-        session.close()
+        return
 
     try:
         contact = update.message.contact
@@ -387,29 +625,41 @@ async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     except Exception as e:
         logger.warning(e)
 
-    try:
-        db_create_user(
-            user_id=contact.user_id,
-            full_name=full_name,
-            user_name=update.message.from_user.username,
-            phone=contact.phone_number,
-        )
-    except Exception as e:
-        logger.warning(e)
-        await update.message.reply_text(
-            "Пожалуйста, отправьте свой контакт с помощью кнопки ниже",
-            reply_markup=ReplyKeyboardMarkup(
-                [
+    # Проверка "уже зарегистрирован" и регистрация - один INSERT ... ON CONFLICT
+    async with async_session() as session:
+        try:
+            user, created = await register_user(
+                session,
+                tenant.name,
+                telegram_id=contact.user_id,
+                full_name=full_name,
+                user_name=update.message.from_user.username,
+                phone=contact.phone_number,
+            )
+        except Exception as e:
+            await session.rollback()
+            logger.warning(e)
+            await update.message.reply_text(
+                "Пожалуйста, отправьте свой контакт с помощью кнопки ниже",
+                reply_markup=ReplyKeyboardMarkup(
                     [
-                        KeyboardButton(
-                            "Отправить номер телефона",
-                            request_contact=True,
-                        )
-                    ]
-                ],
-                resize_keyboard=True,
-                one_time_keyboard=True,
-            ),
+                        [
+                            KeyboardButton(
+                                "Отправить номер телефона",
+                                request_contact=True,
+                            )
+                        ]
+                    ],
+                    resize_keyboard=True,
+                    one_time_keyboard=True,
+                ),
+            )
+            return
+
+    tenant.user_cache.put(user)
+    if not created:
+        await update.message.reply_text(
+            already_registered, reply_markup=ReplyKeyboardRemove()
         )
         return
 
@@ -419,124 +669,449 @@ async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
 
 
+@instrument
 async def block(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if str(update.message.chat_id) != str(ADMIN_GROUP):
+    tenant = context.bot_data[TENANT]
+    if not is_admin_chat(update, tenant):
         return
 
     if update.message.reply_to_message:
         message_id = update.message.reply_to_message.message_id
 
-        try:
-            user = (
-                session.query(User)
-                .join(Valentine)
-                .filter(Valentine.admin_message_id == message_id)
-                .first()
-            )
-        except Exception as e:
-            session.rollback()
-            logger.warning(e)
-            await update.message.reply_text("Что-то пошло не так!")
+        reason = update.effective_message.text.split(maxsplit=1)[-1]
+        if reason == "/block" or reason == "" or reason == " ":
+            reason = "Причина не указана"
+
+        async with async_session() as session:
+            try:
+                user_id = await block_sender(session, tenant.name, message_id, reason)
+            except Exception as e:
+                await session.rollback()
+                logger.warning(e)
+                await update.message.reply_text("Что-то пошло не так!")
+                return
+
+        if user_id is None:
+            await update.message.reply_text("Пользователь не найден!")
             return
-        finally:
-            session.close()
 
-        try:
-            reason = update.effective_message.text.split(maxsplit=1)[-1]
-            if reason == "/block" or reason == "" or reason == " ":
-                reason = "Причина не указана"
+        # Блокировка должна сработать уже на следующем сообщении
+        tenant.user_cache.invalidate(user_id)
+        await update.message.reply_text("Пользователь заблокирован!")
+
+
+@instrument
+async def who(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tenant = context.bot_data[TENANT]
+    if not is_admin_chat(update, tenant):
+        return
 
-            user = session.query(User).filter(User.user_id == user.user_id).first()
-            user.blocked = True
-            user.blocked_reason = reason
-            session.commit()
+    if update.message.reply_to_message:
+        message_id = update.message.reply_to_message.message_id
 
-            await update.message.reply_text("Пользователь заблокирован!")
+        async with async_session() as session:
+            try:
+                user = await find_sender(session, tenant.name, message_id)
+            except Exception as e:
+                await session.rollback()
+                logger.warning(e)
+                await update.message.reply_text("Что-то пошло не так!")
+                return
+
+        try:
+            await update.message.reply_text(
+                f"Username: {'@' + str(user.user_name) if user.user_name != 'None' else 'Нет ника'}\nИмя: {user.full_name or 'Нет имени'}\nНомер: https://t.me/+{user.phone}\nЗаблокирован: {user.blocked or 'Не заблокирован'}\nПричина: {user.blocked_reason or 'Не заблокирован'}"
+            )
             return
 
         except Exception as e:
-            session.rollback()
             logger.warning(e)
             await update.message.reply_text("Пользователь не найден!")
             return
-        finally:
-            session.close()
 
 
-async def who(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if str(update.message.chat_id) != str(ADMIN_GROUP):
+@instrument
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tenant = context.bot_data[TENANT]
+    if not is_admin_chat(update, tenant):
         return
 
-    if update.message.reply_to_message:
-        message_id = update.message.reply_to_message.message_id
+    # Валентинки по часам и получатели из счетчиков, без GROUP BY по valentine
+    async with async_session() as session:
+        try:
+            lines = rollups.render(await rollups.dashboard(session, tenant.name)) + [""]
+        except Exception as e:
+            logger.warning(e)
+            lines = []
+
+    outbox_stats = tenant.outbox.stats()
+    cache_stats = tenant.user_cache.stats()
+    spam_stats = tenant.spam_index.stats()
+    flood_stats = flood.stats()
+    lines += summary() + [
+        f"Очередь отправки: {outbox_stats['depth']}, отправлено {outbox_stats['sent']}, "
+        f"дайджестов {outbox_stats['digests']}, "
+        f"ошибок {outbox_stats['failed']}, повторов {outbox_stats['retries']}, "
+        f"запланировано {outbox_stats['scheduled']}, "
+        f"задержка p95 {outbox_stats['latency_p95']:.1f}с",
+        f"Кэш пользователей: {cache_stats['size']}, попаданий {cache_stats['hit_ratio']:.0%}",
+        f"Пользователей на кулдауне: {len(tenant.cooldowns)}",
+        f"Индекс похожих валентинок: {spam_stats['size']}, помечено {spam_stats['flagged']}, "
+        f"отклонено {spam_stats['rejected']}",
+        f"Флуд: отброшено {flood_stats['dropped']}, мьютов {flood_stats['mutes']}, "
+        f"сейчас в мьюте {flood_stats['muted']}, "
+        f"уведомлений в админ группу {tenant.flood_notices.sent}",
+    ]
+    if tenant.write_buffer:
+        lines.append(
+            f"Буфер записи: {len(tenant.write_buffer)}, сбросов {tenant.write_buffer.flushes}, "
+            f"синхронных записей {tenant.write_buffer.sync_writes}"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+
+# /find <имя или @ник> - валентинки получателю
+@instrument
+async def find(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tenant = context.bot_data[TENANT]
+    if not is_admin_chat(update, tenant):
+        return
+
+    if not context.args:
+        await update.message.reply_text("Использование: /find <имя или @ник>")
+        return
 
+    async with async_session() as session:
         try:
-            user = (
-                session.query(User)
-                .join(Valentine)
-                .filter(Valentine.admin_message_id == message_id)
-                .first()
-            )
+            found = await find_valentines(session, tenant.name, " ".join(context.args))
         except Exception as e:
-            session.rollback()
             logger.warning(e)
             await update.message.reply_text("Что-то пошло не так!")
             return
-        finally:
-            session.close()
 
+    if not found:
+        await update.message.reply_text("Ничего не найдено")
+        return
+
+    lines = []
+    for valentine, user in found:
+        anonymous = " (анонимно)" if valentine.anonymous else ""
+        text = valentine.text if len(valentine.text) <= 80 else valentine.text[:80] + "…"
+        if valentine.media_id:
+            text = f"📎 {text}"
+        lines.append(
+            f"{valentine.date:%d.%m %H:%M} Кому: {valentine.recipient}\n"
+            f"От: {user.full_name or 'Нет имени'} @{user.user_name}{anonymous}\n{text}"
+        )
+    await update.message.reply_text("\n\n".join(lines)[:4096])
+
+
+# /export [csv|jsonl] - выгрузка валентинок файлом в админ группу. Выгрузка пишется
+# во временный файл на диске пачками, gzip, чтобы не держать таблицу в памяти
+@instrument
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tenant = context.bot_data[TENANT]
+    if not is_admin_chat(update, tenant):
+        return
+
+    format = context.args[0].lower() if context.args else "csv"
+    if format not in FORMATS:
+        await update.message.reply_text("Формат: /export csv или /export jsonl")
+        return
+
+    with tempfile.TemporaryFile() as file:
+        async with async_session() as session:
+            try:
+                count = await write_export(
+                    session, tenant.name, file, format, compress=True
+                )
+            except Exception as e:
+                logger.warning(e)
+                await update.message.reply_text("Что-то пошло не так!")
+                return
+
+        file.seek(0)
+        await update.message.reply_document(
+            document=file,
+            filename=export_filename(format, compress=True),
+            caption=f"Валентинок: {count}",
+            write_timeout=120,
+        )
+
+
+# У каждого бота свой индекс: тексты одной школы не должны помечать или отклонять
+# валентинки другой
+async def warm_spam_index() -> None:
+    for tenant in tenants:
         try:
-            await update.message.reply_text(
-                f"Username: {'@' + str(user.user_name) if user.user_name != 'None' else 'Нет ника'}\nИмя: {user.full_name or 'Нет имени'}\nНомер: https://t.me/+{user.phone}\nЗаблокирован: {user.blocked or 'Не заблокирован'}\nПричина: {user.blocked_reason or 'Не заблокирован'}"
-            )
-            return
+            async with async_session() as session:
+                warmed = await tenant.spam_index.warm(session, tenant.name)
+            logger.info(f"Spam index of {tenant.name} built from {warmed} valentines")
+        except Exception as e:
+            logger.warning(e)
 
+
+async def post_init(application: Application) -> None:
+    tenant = application.bot_data[TENANT]
+    async with async_session() as session:
+        warmed = await tenant.cooldowns.warm(session, tenant.name)
+    logger.info(f"Cooldowns of {tenant.name} warmed for {warmed} users")
+    if tenant.write_buffer:
+        try:
+            await tenant.write_buffer.restore()
         except Exception as e:
-            session.rollback()
             logger.warning(e)
-            await update.message.reply_text("Пользователь не найден!")
-            return
-        finally:
-            session.close()
 
+    application.bot_data["outbox_task"] = asyncio.create_task(tenant.outbox.run())
+    if tenant.channel_id:
+        application.job_queue.run_repeating(
+            release_scheduled, interval=RELEASE_INTERVAL, first=1
+        )
 
-def main() -> None:
-    assert (bot_token := os.environ.get("TOKEN"))
 
-    application = ApplicationBuilder().token(bot_token).build()
-    global bot
-    bot = application.bot
+# Отпускает отложенные валентинки, время которых пришло, по лимиту канала
+async def release_scheduled(context: ContextTypes.DEFAULT_TYPE) -> None:
+    tenant = context.bot_data[TENANT]
+    try:
+        await tenant.outbox.release(tenant.channel_id, RELEASE_INTERVAL)
+    except Exception as e:
+        logger.warning(e)
+
+
+async def post_shutdown(application: Application) -> None:
+    tenant = application.bot_data[TENANT]
+    # SIGINT при деплое: сначала дописываем буфер, потом останавливаем очередь
+    if tenant.write_buffer:
+        await tenant.write_buffer.drain(
+            timeout=float(os.environ.get("WRITE_BEHIND_DRAIN_TIMEOUT", 10))
+        )
+
+    # Очередь дожидается текущей отправки, чтобы после перезапуска ничего не ушло дважды
+    task = application.bot_data.get("outbox_task")
+    if task:
+        await tenant.outbox.stop(task)
+
+
+# base_url позволяет направить бота на другой Bot API сервер, например на заглушку из loadtest
+def build_application(tenant: Tenant, base_url: str | None = None) -> Application:
+    builder = (
+        ApplicationBuilder()
+        .token(tenant.token)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest())
+        .persistence(
+            DBPersistence(
+                update_interval=float(os.environ.get("PERSISTENCE_INTERVAL", 10)),
+                tenant=tenant.name,
+            )
+        )
+        .concurrent_updates(
+            PerUserUpdateProcessor(int(os.environ.get("CONCURRENT_UPDATES", 32)))
+        )
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    application.bot_data[TENANT] = tenant
+
+    tenant.outbox = Outbox(
+        application.bot,
+        per_minute=int(os.environ.get("OUTBOX_PER_MINUTE", 20)),
+        digest_chats={int(tenant.channel_id)} if tenant.digest and tenant.channel_id else set(),
+        digest_window=float(os.environ.get("DIGEST_WINDOW", 10)),
+        digest_size=int(os.environ.get("DIGEST_SIZE", 10)),
+        tenant=tenant.name,
+    )
+    if WRITE_BEHIND:
+        tenant.write_buffer = ValentineWriteBuffer(
+            tenant.outbox,
+            max_rows=int(os.environ.get("WRITE_BEHIND_ROWS", 100)),
+            max_delay=float(os.environ.get("WRITE_BEHIND_MS", 50)) / 1000,
+            dump_path=os.path.join(
+                os.environ.get("WRITE_BEHIND_DUMP_DIR", "."),
+                f"write_behind-{tenant.name}.jsonl",
+            ),
+        )
+    tenants.append(tenant)
+
+    application.add_handler(TypeHandler(Update, flood_guard), group=-1)
+
     application.add_handler(CommandHandler("start", start, filters.ChatType.PRIVATE))
     application.add_handler(
         CommandHandler("help", help_command, filters.ChatType.PRIVATE)
     )
     application.add_handler(CommandHandler("block", block, filters.ChatType.GROUPS))
     application.add_handler(CommandHandler("who", who, filters.ChatType.GROUPS))
+    application.add_handler(CommandHandler("stats", stats, filters.ChatType.GROUPS))
+    application.add_handler(CommandHandler("export", export, filters.ChatType.GROUPS))
+    application.add_handler(CommandHandler("find", find, filters.ChatType.GROUPS))
 
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("valentine", ticket_handler, filters.ChatType.PRIVATE)
         ],
         states={
-            VALENTINE: [MessageHandler(filters.TEXT, valentine)],
+            VALENTINE: [MessageHandler(filters.TEXT | MEDIA, valentine)],
             RECIPIENT: [MessageHandler(filters.TEXT, recipient)],
             ANONIMITY: [MessageHandler(filters.Regex("^(Да|Нет)$"), anonimity)],
             CONFIRMATION: [
-                MessageHandler(filters.Regex("^(Отправить|Отменить)$"), confirmation)
+                MessageHandler(
+                    filters.Regex(f"^(Отправить|Отменить|{SCHEDULE_BUTTON})$"),
+                    confirmation,
+                )
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="valentine",
+        persistent=True,
     )
     application.add_handler(MessageHandler(filters.CONTACT, contact_handler))
     application.add_handler(conv_handler)
-    application.run_polling()
+    return application
+
+
+# Метрики процесса: счетчики суммируются по всем арендаторам
+def install_metrics() -> None:
+    install_db_metrics(get_async_engine().sync_engine)
+    add_gauge("bot_tenants", "Ботов в процессе", lambda: len(tenants))
+    add_gauge(
+        "bot_outbox_depth",
+        "Сообщений в очереди отправки",
+        lambda: sum(tenant.outbox.depth for tenant in tenants),
+    )
+    add_counter(
+        "bot_outbox_sent_total",
+        "Отправлено из очереди",
+        lambda: sum(tenant.outbox.sent for tenant in tenants),
+    )
+    add_gauge(
+        "bot_outbox_latency_p95_seconds",
+        "p95 времени от постановки в очередь до доставки, худший из ботов",
+        lambda: max(
+            (tenant.outbox.stats()["latency_p95"] for tenant in tenants), default=0.0
+        ),
+    )
+    add_counter(
+        "bot_user_cache_hits_total",
+        "Попадания в кэш",
+        lambda: sum(tenant.user_cache.hits for tenant in tenants),
+    )
+    add_counter(
+        "bot_user_cache_misses_total",
+        "Промахи кэша",
+        lambda: sum(tenant.user_cache.misses for tenant in tenants),
+    )
+    add_gauge(
+        "bot_cooldown_users",
+        "Пользователей на кулдауне",
+        lambda: sum(len(tenant.cooldowns) for tenant in tenants),
+    )
+    add_counter("bot_flood_dropped_total", "Отброшено апдейтов от флуда", lambda: flood.dropped)
+    add_counter("bot_flood_mutes_total", "Мьютов за флуд", lambda: flood.mutes)
+
+
+# Реплик может быть несколько (rolling deploy на fly.io): апдейты получает только
+# лидер, остальные ждут аренду в leader.py. Все состояние (диалоги, черновики,
+# кулдауны, очередь отправки) лежит в базе, поэтому новый лидер продолжает с того же
+# места. При SIGINT/SIGTERM лидер дорабатывает текущие апдейты, сохраняет состояние
+# и только потом отпускает аренду. Все арендаторы работают в одном event loop с
+# общим пулом соединений и одной арендой на процесс
+async def run(bot_tenants: list[Tenant], base_url: str | None = None) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    lease = LeaderLease(get_async_engine())
+    acquire = asyncio.create_task(lease.acquire())
+    stopped = asyncio.create_task(stop.wait())
+    await asyncio.wait([acquire, stopped], return_when=asyncio.FIRST_COMPLETED)
+    if not acquire.done():
+        acquire.cancel()
+        return
+
+    # Схема доводится до текущей версии только после аренды: пока старый лидер
+    # работает на старом коде, миграции не должны менять индексы под его запросами
+    # и брать эксклюзивные блокировки его таблиц. Если версия уже текущая, это
+    # одна проверка
+    try:
+        await prepare_database()
+    except BaseException:
+        await lease.release()
+        raise
+
+    applications = {
+        tenant.name: build_application(tenant, base_url) for tenant in bot_tenants
+    }
+    install_metrics()
+    # Индекс похожих валентинок строится в фоне, бот отвечает сразу
+    spam_task = asyncio.create_task(warm_spam_index())
+    maintenance_task = asyncio.create_task(
+        retention.maintain(int(RETENTION_SEASONS) if RETENTION_SEASONS else None)
+    )
+    metrics_server = await serve(int(METRICS_PORT)) if METRICS_PORT else None
+    lost = None
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            for application in applications.values():
+                await stack.enter_async_context(application)
+                await application.post_init(application)
+                if BOT_MODE != "webhook":
+                    await application.updater.start_polling()
+                await application.start()
+
+            webhooks = None
+            if BOT_MODE == "webhook":
+                webhooks = await start_webhooks(
+                    applications,
+                    port=int(os.environ.get("PORT", 8080)),
+                    url=WEBHOOK_URL,
+                    secret_token=os.environ.get("WEBHOOK_SECRET"),
+                )
+
+            lost = asyncio.create_task(lease.watch())
+            await asyncio.wait([lost, stopped], return_when=asyncio.FIRST_COMPLETED)
+
+            if webhooks:
+                await stop_webhooks(webhooks)
+            for application in applications.values():
+                if application.updater.running:
+                    await application.updater.stop()
+                await application.stop()
+                await application.post_shutdown(application)
+    finally:
+        spam_task.cancel()
+        maintenance_task.cancel()
+        if metrics_server:
+            metrics_server.close()
+        await lease.release()
+
+    # Аренду мог забрать другой экземпляр, состояние в памяти уже не актуально.
+    # Выходим с ошибкой, чтобы fly.io перезапустил машину как резервную
+    if lost.done() and not stopped.done():
+        raise SystemExit(1)
+    lost.cancel()
+
+
+def main() -> None:
+    if TENANTS_FILE:
+        bot_tenants = load_tenants(TENANTS_FILE)
+    else:
+        assert (bot_token := os.environ.get("TOKEN"))
+        bot_tenants = [env_tenant(bot_token)]
+    asyncio.run(run(bot_tenants))
 
 
 if __name__ == "__main__":
-    if ADMIN_GROUP is None:
+    if TENANTS_FILE is None and ADMIN_GROUP is None:
         print("ADMIN_GROUP is not set!")
         exit(1)
-    if CHANNEL_ID is None:
+    if TENANTS_FILE is None and CHANNEL_ID is None:
         print("CHANNEL_ID is not set!")
         exit(1)
+    if BOT_MODE == "webhook" and WEBHOOK_URL is None:
+        print("WEBHOOK_URL is not set!")
+        exit(1)
     main()
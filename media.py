@@ -0,0 +1,58 @@
+from typing import NamedTuple
+
+from telegram import Bot, Message
+from telegram.ext import filters
+
+# Медиа валентинки: фото, стикеры, голосовые, видео и гифки. В канал и админ группу
+# они уходят по file_id, сам файл бот не скачивает и не загружает заново
+MEDIA = (
+    filters.PHOTO | filters.Sticker.ALL | filters.VOICE | filters.VIDEO | filters.ANIMATION
+)
+
+MEDIA_NAMES = {
+    "photo": "фото",
+    "sticker": "стикер",
+    "voice": "голосовое",
+    "video": "видео",
+    "animation": "гифку",
+}
+
+# У стикера нет подписи: текст валентинки уходит отдельным сообщением перед ним
+CAPTIONLESS = frozenset({"sticker"})
+
+# Лимит Telegram на подпись 1024 символа, оставляем место под "От", "Кому" и экранирование
+MAX_CAPTION = 300
+
+
+class Attachment(NamedTuple):
+    type: str
+    file_id: str
+    # Одинаков у одного файла для всех ботов и всех пересылок, по нему ищутся повторы
+    file_unique_id: str
+
+
+def attachment_of(message: Message) -> Attachment | None:
+    if message.photo:
+        # Telegram присылает несколько размеров, последний - самый большой
+        photo = message.photo[-1]
+        return Attachment("photo", photo.file_id, photo.file_unique_id)
+    for type in ("sticker", "voice", "video", "animation"):
+        file = getattr(message, type)
+        if file:
+            return Attachment(type, file.file_id, file.file_unique_id)
+    return None
+
+
+async def send_media(
+    bot: Bot,
+    chat_id: int,
+    type: str,
+    file_id: str,
+    caption: str | None = None,
+    parse_mode: str | None = None,
+) -> Message:
+    if type in CAPTIONLESS:
+        return await getattr(bot, f"send_{type}")(chat_id, file_id)
+    return await getattr(bot, f"send_{type}")(
+        chat_id, file_id, caption=caption or None, parse_mode=parse_mode
+    )
@@ -0,0 +1,280 @@
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import time
+from typing import Any, Callable
+
+import httpx
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telegram import Update
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Пороги, после которых в лог пишется предупреждение с запросом или апдейтом
+SLOW_HANDLER_MS = float(os.environ.get("SLOW_HANDLER_MS", 1000))
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, callback: Callable[[], float]) -> None:
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def render(self) -> list:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+            f"{self.name} {self.callback()}",
+        ]
+
+
+# Счетчик, который уже ведет сам объект (outbox.sent, flood.dropped): значение
+# читается при отдаче метрик, как у Gauge, но только растет, поэтому тип counter
+class CallbackCounter(Gauge):
+    type = "counter"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [счетчики по бакетам (+Inf последним), сумма, количество]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry = self.values[key]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    # Оценка квантиля по бакетам, как histogram_quantile в Prometheus
+    def quantile(self, q: float, **labels: str) -> float:
+        entry = self.values.get(_labels(labels))
+        if not entry or not entry[2]:
+            return 0.0
+        rank = q * entry[2]
+        seen = 0
+        for index, count in enumerate(entry[0]):
+            if seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+handler_seconds = Histogram("bot_handler_seconds", "Время обработки апдейта хендлером")
+handler_errors = Counter("bot_handler_errors_total", "Исключения в хендлерах")
+db_query_seconds = Histogram("bot_db_query_seconds", "Время выполнения запроса к БД")
+db_errors = Counter("bot_db_errors_total", "Ошибки запросов к БД")
+api_seconds = Histogram("bot_telegram_api_seconds", "Время запроса к Telegram Bot API")
+api_errors = Counter("bot_telegram_api_errors_total", "Ошибки запросов к Telegram Bot API")
+
+registry: list = [
+    handler_seconds,
+    handler_errors,
+    db_query_seconds,
+    db_errors,
+    api_seconds,
+    api_errors,
+]
+
+
+def add_gauge(name: str, help: str, callback: Callable[[], float]) -> None:
+    registry.append(Gauge(name, help, callback))
+
+
+def add_counter(name: str, help: str, callback: Callable[[], float]) -> None:
+    registry.append(CallbackCounter(name, help, callback))
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _describe(update: object) -> str:
+    if isinstance(update, Update) and update.effective_message:
+        text = (update.effective_message.text or "")[:50]
+        return f"update {update.update_id} from {update.effective_user and update.effective_user.id}: {text!r}"
+    return repr(update)[:100]
+
+
+# Короткая сводка для команды /stats в админ группе
+def summary() -> list:
+    lines = ["Хендлеры (кол-во / p95):"]
+    for labels, (_, _, count) in sorted(handler_seconds.values.items()):
+        name = dict(labels)["handler"]
+        p95 = handler_seconds.quantile(0.95, handler=name) * 1000
+        errors = handler_errors.values.get(labels, 0)
+        lines.append(f"  {name}: {count} / {p95:.0f}ms, ошибок {errors:.0f}")
+
+    queries = sum(entry[2] for entry in db_query_seconds.values.values())
+    lines.append(f"Запросы к БД: {queries}, ошибок {sum(db_errors.values.values()):.0f}")
+    for labels, (_, _, count) in sorted(db_query_seconds.values.items()):
+        kind = dict(labels)["statement"]
+        p95 = db_query_seconds.quantile(0.95, statement=kind) * 1000
+        lines.append(f"  {kind}: {count} / {p95:.0f}ms")
+
+    calls = sum(entry[2] for entry in api_seconds.values.values())
+    lines.append(
+        f"Запросы к Telegram: {calls}, ошибок {sum(api_errors.values.values()):.0f}"
+    )
+    return lines
+
+
+# Декоратор для хендлеров: гистограмма времени, счетчик ошибок и предупреждение о медленных апдейтах
+def instrument(handler: Callable) -> Callable:
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update: object, context: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            handler_seconds.observe(elapsed, handler=name)
+            if elapsed * 1000 > SLOW_HANDLER_MS:
+                logger.warning(
+                    f"Slow handler {name}: {elapsed * 1000:.0f}ms, {_describe(update)}"
+                )
+
+    return wrapper
+
+
+def install_db_metrics(engine: Engine) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_started
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        db_query_seconds.observe(elapsed, statement=kind)
+        if elapsed * 1000 > SLOW_QUERY_MS:
+            logger.warning(f"Slow query {elapsed * 1000:.0f}ms: {statement}")
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        db_errors.inc()
+
+
+# HTTPXRequest с замером времени и ошибок каждого метода Bot API
+# Один SSL контекст на процесс. httpx по умолчанию грузит корневые сертификаты в
+# каждый клиент заново, это почти мегабайт на клиента, а у каждого бота их два
+@functools.cache
+def ssl_context():
+    return httpx.create_ssl_context()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    def _build_client(self) -> httpx.AsyncClient:
+        self._client_kwargs["verify"] = ssl_context()
+        return super()._build_client()
+
+    async def do_request(self, url: str, method: str, *args: Any, **kwargs: Any) -> tuple:
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            api_errors.inc(method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            # getUpdates висит в long polling, его время ничего не говорит
+            if api_method != "getUpdates":
+                api_seconds.observe(time.perf_counter() - started, method=api_method)
+        if status >= 400:
+            api_errors.inc(method=api_method, error=str(status))
+        return status, payload
+
+
+# Отдает метрики в формате Prometheus на METRICS_PORT
+async def serve(port: int) -> asyncio.AbstractServer:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            path = request_line.split()[1] if len(request_line.split()) > 1 else b"/"
+            if path == b"/metrics":
+                body = render().encode()
+                status = "200 OK"
+            else:
+                body = b"Not found\n"
+                status = "404 Not Found"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, "0.0.0.0", port)
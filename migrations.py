@@ -0,0 +1,321 @@
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from partitions import create_partition, season_start
+from recipients import parse_recipient
+
+logger = logging.getLogger(__name__)
+
+# Версионированные миграции схемы. Каждая версия применяется один раз, номер
+# последней примененной хранится в таблице schema_version. Новые таблицы и
+# колонки создает create_all, поэтому миграции должны быть идемпотентными
+# (IF NOT EXISTS) и только доводить старые базы до текущей схемы.
+# При старте create_all запускается, только если версия в базе меньше последней,
+# поэтому любое изменение схемы, даже новая таблица, требует новой версии
+# (можно с пустым списком).
+# Шаг миграции - SQL строка или функция от соединения, если без питона не обойтись
+
+
+# Нормализованный получатель для уже отправленных валентинок, пачками
+def backfill_recipients(conn: Connection) -> None:
+    update = text(
+        "UPDATE valentine SET recipient_username = :username, recipient_name = :name "
+        "WHERE id = :id"
+    )
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            text(
+                "SELECT id, recipient FROM valentine WHERE id > :last_id "
+                "ORDER BY id LIMIT 5000"
+            ),
+            {"last_id": last_id},
+        ).all()
+        if not rows:
+            return
+        conn.execute(
+            update,
+            [
+                {"id": valentine_id, **parse_recipient(recipient)._asdict()}
+                for valentine_id, recipient in rows
+            ],
+        )
+        last_id = rows[-1][0]
+
+
+# pg_trgm есть почти везде, но это contrib модуль. Без него /find работает через LIKE
+def create_trigram_index(conn: Connection) -> None:
+    available = conn.scalar(
+        text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    )
+    if not available:
+        logger.warning("pg_trgm is not available, /find will use sequential scans")
+        return
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_valentine_recipient_name_trgm "
+            "ON valentine USING gin (recipient_name gin_trgm_ops)"
+        )
+    )
+
+
+# Получатели из холодных таблиц valentine_archive_<год>, тем же выражением, что
+# rollups.recipient_key
+def archive_cold_recipients(conn: Connection) -> None:
+    tables = conn.scalars(
+        text(
+            "SELECT tablename FROM pg_tables "
+            "WHERE tablename ~ '^valentine_archive_[0-9]{4}$' ORDER BY tablename"
+        )
+    ).all()
+    for table in tables:
+        conn.execute(
+            text(
+                "INSERT INTO archived_recipient_stats (tenant, season, recipient, count) "
+                f"SELECT tenant, :season, lower(trim(recipient)), count(*) FROM {table} "
+                "WHERE recipient IS NOT NULL GROUP BY tenant, lower(trim(recipient)) "
+                "ON CONFLICT DO NOTHING"
+            ),
+            {"season": int(table.rsplit("_", 1)[1])},
+        )
+
+
+# Переносит valentine в таблицу, секционированную по date (см. partitions.py).
+# Первичный ключ секционированной таблицы обязан содержать ключ секций, поэтому он
+# (id, date), а уникальность id по-прежнему дает valentine_id_seq. На свежей базе
+# create_all создает обычную таблицу, и она так же переносится здесь, пустой
+def partition_valentine(conn: Connection) -> None:
+    kind = conn.scalar(text("SELECT relkind FROM pg_class WHERE oid = 'valentine'::regclass"))
+    if kind == "p":
+        return
+
+    conn.execute(text("ALTER TABLE valentine RENAME TO valentine_unpartitioned"))
+    # Иначе последовательность удалится вместе со старой таблицей
+    conn.execute(text("ALTER SEQUENCE valentine_id_seq OWNED BY NONE"))
+    # date раньше могла быть пустой, а строку без ключа некуда положить
+    conn.execute(
+        text(
+            "UPDATE valentine_unpartitioned SET date = coalesce("
+            "(SELECT min(date) FROM valentine_unpartitioned), :now) WHERE date IS NULL"
+        ),
+        {"now": season_start()},
+    )
+    conn.execute(
+        text(
+            "CREATE TABLE valentine (LIKE valentine_unpartitioned INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (date)"
+        )
+    )
+    conn.execute(text("ALTER TABLE valentine ALTER COLUMN date SET NOT NULL"))
+
+    seasons = set(
+        conn.scalars(
+            text("SELECT DISTINCT extract(year FROM date)::int FROM valentine_unpartitioned")
+        )
+    )
+    current = season_start().year
+    for season in sorted(seasons | {current, current + 1}):
+        create_partition(conn, season)
+
+    conn.execute(text("INSERT INTO valentine SELECT * FROM valentine_unpartitioned"))
+    conn.execute(text("DROP TABLE valentine_unpartitioned"))
+    conn.execute(text("ALTER SEQUENCE valentine_id_seq OWNED BY valentine.id"))
+
+    # Ключ, внешние ключи и индексы создаются на родителе и сами появляются в секциях
+    conn.execute(text("ALTER TABLE valentine ADD PRIMARY KEY (id, date)"))
+    conn.execute(
+        text(
+            'ALTER TABLE valentine ADD FOREIGN KEY (sender) REFERENCES "user" (id), '
+            "ADD FOREIGN KEY (media_id) REFERENCES media (id)"
+        )
+    )
+    for statement in (
+        "CREATE INDEX ix_valentine_sender_id ON valentine (sender, id DESC)",
+        "CREATE INDEX ix_valentine_admin_message_id ON valentine (admin_message_id)",
+        "CREATE INDEX ix_valentine_admin_media_message_id ON valentine (admin_media_message_id)",
+        "CREATE INDEX ix_valentine_recipient_username ON valentine (recipient_username, id DESC)",
+    ):
+        conn.execute(text(statement))
+    create_trigram_index(conn)
+    conn.execute(text("ANALYZE valentine"))
+
+
+MIGRATIONS = {
+    # Индексы для поиска пользователя, кулдауна и /block, /who.
+    # Перед уникальным индексом склеиваем дубликаты пользователей,
+    # которые могли появиться из-за гонки в contact_handler
+    1: [
+        """
+        UPDATE "user" AS keep SET blocked = TRUE
+        FROM "user" AS dup
+        WHERE dup.user_id = keep.user_id AND dup.id <> keep.id AND dup.blocked
+        """,
+        """
+        UPDATE valentine SET sender = dup.keep_id
+        FROM (
+            SELECT id, min(id) OVER (PARTITION BY user_id) AS keep_id FROM "user"
+        ) AS dup
+        WHERE valentine.sender = dup.id AND dup.id <> dup.keep_id
+        """,
+        """
+        DELETE FROM "user" AS dup USING "user" AS keep
+        WHERE dup.user_id = keep.user_id AND dup.id > keep.id
+        """,
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_user_user_id ON "user" (user_id)',
+        "CREATE INDEX IF NOT EXISTS ix_valentine_sender_id ON valentine (sender, id DESC)",
+        "CREATE INDEX IF NOT EXISTS ix_valentine_admin_message_id ON valentine (admin_message_id)",
+    ],
+    # Дата последней валентинки прямо в user для кулдауна
+    2: [
+        'ALTER TABLE "user" ADD COLUMN IF NOT EXISTS last_valentine_at TIMESTAMP',
+        """
+        UPDATE "user" SET last_valentine_at = last.date
+        FROM (SELECT sender, max(date) AS date FROM valentine GROUP BY sender) AS last
+        WHERE "user".id = last.sender
+        """,
+    ],
+    # Выбор анонимности в valentine и счетчики для /stats по уже отправленным валентинкам.
+    # Те же выражения, что в rollups.py. У старых строк date бывает пустой, их час неизвестен
+    3: [
+        "ALTER TABLE valentine ADD COLUMN IF NOT EXISTS anonymous BOOLEAN",
+        "DELETE FROM valentine_stats",
+        """
+        INSERT INTO valentine_stats (hour, total, anonymous, signed)
+        SELECT date_trunc('hour', date), count(*),
+               count(*) FILTER (WHERE anonymous), count(*) FILTER (WHERE NOT anonymous)
+        FROM valentine WHERE date IS NOT NULL GROUP BY 1
+        """,
+        "DELETE FROM recipient_stats",
+        """
+        INSERT INTO recipient_stats (recipient, count)
+        SELECT lower(trim(recipient)), count(*) FROM valentine
+        WHERE recipient IS NOT NULL GROUP BY 1
+        """,
+    ],
+    # Нормализованный получатель и индексы для /find
+    4: [
+        "ALTER TABLE valentine ADD COLUMN IF NOT EXISTS recipient_username VARCHAR",
+        "ALTER TABLE valentine ADD COLUMN IF NOT EXISTS recipient_name VARCHAR",
+        backfill_recipients,
+        """
+        CREATE INDEX IF NOT EXISTS ix_valentine_recipient_username
+        ON valentine (recipient_username, id DESC)
+        """,
+        create_trigram_index,
+        "ANALYZE valentine",
+    ],
+    # Отложенная публикация: время выхода сообщения из outbox
+    5: [
+        "ALTER TABLE outbox ADD COLUMN IF NOT EXISTS release_at TIMESTAMP WITHOUT TIME ZONE",
+        """
+        CREATE INDEX IF NOT EXISTS ix_outbox_scheduled
+        ON outbox (chat_id, release_at, id) WHERE status = 'scheduled'
+        """,
+    ],
+    # Несколько ботов в одном процессе (tenants.py): арендатор во всех таблицах,
+    # существующие строки принадлежат боту "default"
+    6: [
+        *(
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS tenant VARCHAR NOT NULL DEFAULT 'default'"
+            for table in (
+                '"user"',
+                "valentine",
+                "outbox",
+                "valentine_stats",
+                "recipient_stats",
+                "conversation_state",
+                "valentine_draft",
+            )
+        ),
+        "DROP INDEX IF EXISTS ix_user_user_id",
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_user_tenant_user_id ON "user" (tenant, user_id)',
+        "DROP INDEX IF EXISTS ix_outbox_pending",
+        "CREATE INDEX ix_outbox_pending ON outbox (tenant, id) WHERE status = 'pending'",
+        "DROP INDEX IF EXISTS ix_recipient_stats_count",
+        "CREATE INDEX ix_recipient_stats_count ON recipient_stats (tenant, count DESC, recipient)",
+        """
+        ALTER TABLE valentine_stats DROP CONSTRAINT valentine_stats_pkey,
+        ADD PRIMARY KEY (tenant, hour)
+        """,
+        """
+        ALTER TABLE recipient_stats DROP CONSTRAINT recipient_stats_pkey,
+        ADD PRIMARY KEY (tenant, recipient)
+        """,
+        """
+        ALTER TABLE conversation_state DROP CONSTRAINT conversation_state_pkey,
+        ADD PRIMARY KEY (tenant, name, key)
+        """,
+        """
+        ALTER TABLE valentine_draft DROP CONSTRAINT valentine_draft_pkey,
+        ADD PRIMARY KEY (tenant, user_id)
+        """,
+    ],
+    # Медиа валентинки. Таблицу media с индексом по file_unique_id создает create_all
+    7: [
+        "ALTER TABLE valentine ADD COLUMN IF NOT EXISTS media_id INTEGER REFERENCES media (id)",
+        "ALTER TABLE valentine ADD COLUMN IF NOT EXISTS admin_media_message_id INTEGER",
+        """
+        CREATE INDEX IF NOT EXISTS ix_valentine_admin_media_message_id
+        ON valentine (admin_media_message_id)
+        """,
+        "ALTER TABLE outbox ADD COLUMN IF NOT EXISTS media_type VARCHAR",
+        "ALTER TABLE outbox ADD COLUMN IF NOT EXISTS file_id VARCHAR",
+        "ALTER TABLE valentine_draft ADD COLUMN IF NOT EXISTS media_type VARCHAR",
+        "ALTER TABLE valentine_draft ADD COLUMN IF NOT EXISTS file_id VARCHAR",
+        "ALTER TABLE valentine_draft ADD COLUMN IF NOT EXISTS file_unique_id VARCHAR",
+    ],
+    # Горячие и холодные валентинки: valentine секционирована по сезонам, старые
+    # сезоны отсоединяет retention.py
+    8: [partition_valentine],
+    # Почасовые счетчики разбиты на корзины, чтобы записи валентинок не ждали
+    # блокировку одной строки часа. Существующие строки попадают в корзину 0
+    9: [
+        "ALTER TABLE valentine_stats ADD COLUMN IF NOT EXISTS bucket INTEGER NOT NULL DEFAULT 0",
+        """
+        ALTER TABLE valentine_stats DROP CONSTRAINT valentine_stats_pkey,
+        ADD PRIMARY KEY (tenant, hour, bucket)
+        """,
+    ],
+    # Счетчики получателей отсоединенных сезонов. Таблицу archived_recipient_stats
+    # создает create_all, сюда попадают холодные таблицы, еще не выгруженные в файлы
+    10: [archive_cold_recipients],
+}
+
+
+SCHEMA_VERSION = max(MIGRATIONS)
+
+
+# Версия схемы одним запросом, 0 для пустой базы
+def schema_version(conn: Connection) -> int:
+    if not conn.scalar(text("SELECT to_regclass('schema_version') IS NOT NULL")):
+        return 0
+    return conn.scalar(text("SELECT max(version) FROM schema_version")) or 0
+
+
+# Применяет недостающие миграции. Вызывается из db_sqlalchemy.ensure_schema под
+# advisory lock, в одной транзакции с create_all
+def migrate(conn: Connection) -> int:
+    conn.execute(
+        text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    )
+    current = conn.scalar(text("SELECT max(version) FROM schema_version")) or 0
+
+    for version in sorted(MIGRATIONS):
+        if version <= current:
+            continue
+        for statement in MIGRATIONS[version]:
+            if callable(statement):
+                statement(conn)
+            else:
+                conn.execute(text(statement))
+        conn.execute(
+            text("INSERT INTO schema_version (version) VALUES (:version)"),
+            {"version": version},
+        )
+        logger.info(f"Applied schema migration {version}")
+        current = version
+
+    return current
@@ -0,0 +1,408 @@
+import asyncio
+import datetime
+import logging
+import statistics
+import time
+from collections import deque
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from db_sqlalchemy import DEFAULT_TENANT, OutboxMessage, Valentine, async_session
+from media import CAPTIONLESS, send_media
+from partitions import season_start
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram на длину сообщения. Считается по тексту с экранированием, то есть с запасом
+MAX_MESSAGE_LENGTH = 4096
+DIGEST_SEPARATOR = "\n\n💌\n\n"
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.utcnow()
+
+
+# Token bucket на один чат. Telegram пускает примерно 20 сообщений в минуту в группу или канал
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    # Через сколько секунд появится токен, 0 если уже есть
+    def delay(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    # RetryAfter от Telegram: чат закрыт на указанное время, накопленные токены сгорают
+    def block(self, seconds: float) -> None:
+        self.blocked_until = time.monotonic() + seconds
+        self.tokens = 0
+
+
+# Постоянная очередь исходящих сообщений. Сообщения пишутся в таблицу outbox в той же
+# транзакции, что и валентинка, а отправляет их фоновая задача run() с учетом лимитов
+# Telegram, RetryAfter и повторов с экспоненциальной задержкой
+class Outbox:
+    def __init__(
+        self,
+        bot: Bot,
+        per_minute: int = 20,
+        burst: int = 3,
+        max_attempts: int = 5,
+        batch_size: int = 50,
+        idle_interval: float = 30.0,
+        digest_chats: set[int] = frozenset(),
+        digest_window: float = 10.0,
+        digest_size: int = 10,
+        tenant: str = DEFAULT_TENANT,
+    ) -> None:
+        self.bot = bot
+        # Очередь общая для всех арендаторов, каждый Outbox видит только свои строки
+        self.tenant = tenant
+        self.per_minute = per_minute
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        # Дайджест: в этих чатах подряд идущие сообщения, набранные за digest_window
+        # секунд, склеиваются в один пост (не больше digest_size и MAX_MESSAGE_LENGTH)
+        self.digest_chats = {int(chat_id) for chat_id in digest_chats}
+        self.digest_window = digest_window
+        self.digest_size = digest_size
+
+        self.depth = 0
+        self.scheduled = 0
+        self.sent = 0
+        self.digests = 0
+        self.failed = 0
+        self.retries = 0
+        self._latencies: deque[float] = deque(maxlen=1000)
+        self._buckets: dict[int, TokenBucket] = {}
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        # Сообщения, из-за которых Telegram отклонил дайджест, дальше уходят по одному
+        self._single: set[int] = set()
+
+    def enqueue(
+        self,
+        session: AsyncSession,
+        chat_id: int | str,
+        text: str,
+        parse_mode: str | None = None,
+        admin_copy_of: int | None = None,
+        release_at: datetime.datetime | None = None,
+        media_type: str | None = None,
+        file_id: str | None = None,
+    ) -> OutboxMessage:
+        now = utcnow()
+        message = OutboxMessage(
+            tenant=self.tenant,
+            chat_id=int(chat_id),
+            text=text,
+            parse_mode=parse_mode,
+            admin_copy_of=admin_copy_of,
+            # Отложенное сообщение ждет release_at, его отпускает release()
+            status="scheduled" if release_at else "pending",
+            attempts=0,
+            created_at=now,
+            next_attempt_at=now,
+            release_at=release_at,
+            media_type=media_type,
+            file_id=file_id,
+        )
+        session.add(message)
+        return message
+
+    # Вызывается после коммита, чтобы не ждать следующего опроса таблицы
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            "depth": self.depth,
+            "scheduled": self.scheduled,
+            "sent": self.sent,
+            "digests": self.digests,
+            "failed": self.failed,
+            "retries": self.retries,
+            "latency_p50": statistics.median(latencies) if latencies else 0.0,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        }
+
+    # Отпускает в очередь отложенные сообщения чата, время которых пришло: столько,
+    # сколько чат пропустит за interval секунд, вместе с уже ждущими отправки.
+    # Вызывается по расписанию из JobQueue раз в interval, поэтому пик в момент
+    # release_at растягивается по лимиту чата, а в памяти никогда не больше одной пачки.
+    # Порядок отправки - по id, то есть по времени подтверждения
+    async def release(self, chat_id: int | str, interval: float) -> int:
+        chat_id = int(chat_id)
+        limit = max(1, int(self.per_minute * interval / 60))
+        if chat_id in self.digest_chats:
+            limit *= self.digest_size
+        now = utcnow()
+        async with async_session() as session:
+            pending = await session.scalar(
+                select(func.count())
+                .select_from(OutboxMessage)
+                .where(
+                    OutboxMessage.tenant == self.tenant,
+                    OutboxMessage.status == "pending",
+                    OutboxMessage.chat_id == chat_id,
+                )
+            )
+            released = []
+            if pending < limit:
+                due = (
+                    select(OutboxMessage.id)
+                    .where(
+                        OutboxMessage.tenant == self.tenant,
+                        OutboxMessage.status == "scheduled",
+                        OutboxMessage.chat_id == chat_id,
+                        OutboxMessage.release_at <= now,
+                    )
+                    .order_by(OutboxMessage.release_at, OutboxMessage.id)
+                    .limit(limit - pending)
+                    .with_for_update(skip_locked=True)
+                )
+                released = (
+                    await session.scalars(
+                        update(OutboxMessage)
+                        .where(OutboxMessage.id.in_(due.scalar_subquery()))
+                        .values(status="pending", next_attempt_at=now)
+                        .returning(OutboxMessage.id)
+                    )
+                ).all()
+            self.scheduled = await session.scalar(
+                select(func.count())
+                .select_from(OutboxMessage)
+                .where(OutboxMessage.tenant == self.tenant, OutboxMessage.status == "scheduled")
+            )
+            await session.commit()
+
+        if released:
+            self.notify()
+        return len(released)
+
+    # Дожидается отправки текущего сообщения и останавливает run(). Отмена задачи
+    # посреди send_message могла бы отправить сообщение, не отметив его, и после
+    # перезапуска оно ушло бы второй раз
+    async def stop(self, task: asyncio.Task, timeout: float = 10.0) -> None:
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            task.cancel()
+
+    async def run(self) -> None:
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                delay = await self._dispatch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(e)
+                delay = 5.0
+
+            if delay <= 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self._buckets:
+            self._buckets[chat_id] = TokenBucket(self.per_minute / 60, self.burst)
+        return self._buckets[chat_id]
+
+    # Отправляет все, что можно отправить сейчас, и возвращает сколько ждать до следующего прохода
+    async def _dispatch(self) -> float:
+        now = utcnow()
+        async with async_session() as session:
+            pending = (OutboxMessage.tenant == self.tenant) & (OutboxMessage.status == "pending")
+            self.depth = await session.scalar(
+                select(func.count()).select_from(OutboxMessage).where(pending)
+            )
+            messages = (
+                await session.scalars(
+                    select(OutboxMessage)
+                    .where(pending)
+                    .order_by(OutboxMessage.id)
+                    .limit(self.batch_size)
+                )
+            ).all()
+
+        # Сообщения одного чата уходят строго по порядку: если чат упёрся в лимит
+        # или первое сообщение ждет повтора, остальные его сообщения ждут следующего прохода
+        delay = self.idle_interval
+        waiting_chats = set()
+        sent = set()
+        for position, message in enumerate(messages):
+            if self._stopping:
+                return 0.0
+            if message.chat_id in waiting_chats or message.id in sent:
+                continue
+            if message.next_attempt_at > now:
+                waiting_chats.add(message.chat_id)
+                delay = min(delay, (message.next_attempt_at - now).total_seconds())
+                continue
+
+            batch = [message]
+            if message.chat_id in self.digest_chats:
+                batch, full = self._digest(messages, position, now)
+                # Неполный дайджест ждет, пока не наберется окно с первого сообщения
+                ready_at = message.created_at + datetime.timedelta(seconds=self.digest_window)
+                if not full and ready_at > now:
+                    waiting_chats.add(message.chat_id)
+                    delay = min(delay, (ready_at - now).total_seconds())
+                    continue
+
+            bucket = self._bucket(message.chat_id)
+            wait = bucket.delay()
+            if wait:
+                waiting_chats.add(message.chat_id)
+                delay = min(delay, wait)
+                continue
+            bucket.take()
+            sent.update(batch_message.id for batch_message in batch)
+            await self._send(batch)
+
+        if len(messages) == self.batch_size and not waiting_chats:
+            return 0.0
+        return delay
+
+    # Подряд идущие сообщения того же чата, начиная с messages[start], которые влезают
+    # в один пост. Второе значение - True, если дайджест заполнен и ждать окно не нужно
+    def _digest(
+        self, messages: list[OutboxMessage], start: int, now: datetime.datetime
+    ) -> tuple[list[OutboxMessage], bool]:
+        first = messages[start]
+        batch = [first]
+        # Медиа и копии в админ группу всегда уходят отдельными сообщениями
+        if first.id in self._single or first.admin_copy_of or first.file_id:
+            return batch, True
+
+        length = len(first.text)
+        for message in messages[start + 1 :]:
+            if message.chat_id != first.chat_id:
+                continue
+            if (
+                message.parse_mode != first.parse_mode
+                or message.admin_copy_of
+                or message.file_id
+                or message.next_attempt_at > now
+                or message.id in self._single
+            ):
+                return batch, True
+            length += len(DIGEST_SEPARATOR) + len(message.text)
+            if length > MAX_MESSAGE_LENGTH:
+                return batch, True
+            batch.append(message)
+            if len(batch) == self.digest_size:
+                return batch, True
+        return batch, False
+
+    async def _send(self, messages: list[OutboxMessage]) -> None:
+        message = messages[0]
+        values = {}
+        try:
+            if message.file_id:
+                sent = await send_media(
+                    self.bot,
+                    message.chat_id,
+                    message.media_type,
+                    message.file_id,
+                    caption=message.text,
+                    parse_mode=message.parse_mode,
+                )
+            else:
+                sent = await self.bot.send_message(
+                    chat_id=message.chat_id,
+                    text=DIGEST_SEPARATOR.join(message.text for message in messages),
+                    parse_mode=message.parse_mode,
+                )
+        except RetryAfter as e:
+            logger.warning(f"Chat {message.chat_id} is rate limited for {e.retry_after}s")
+            self._bucket(message.chat_id).block(float(e.retry_after))
+            self.retries += 1
+            return
+        except (BadRequest, Forbidden) as e:
+            if isinstance(e, BadRequest) and len(messages) > 1:
+                # Разбираться, какое из сообщений битое, будем по одному
+                logger.warning(f"Digest of {len(messages)} messages rejected: {e}")
+                self._single.update(message.id for message in messages)
+                return
+            # Повтор не поможет: битая разметка, бота выгнали из чата и т.п.
+            logger.warning(f"Outbox message {message.id} rejected: {e}")
+            values = {"status": "failed", "attempts": message.attempts + 1}
+            self.failed += len(messages)
+        except TelegramError as e:
+            attempts = message.attempts + 1
+            if attempts >= self.max_attempts:
+                logger.warning(f"Outbox message {message.id} failed: {e}")
+                values = {"status": "failed", "attempts": attempts}
+                self.failed += len(messages)
+            else:
+                values = {
+                    "attempts": attempts,
+                    "next_attempt_at": utcnow()
+                    + datetime.timedelta(seconds=2**attempts),
+                }
+                self.retries += 1
+        else:
+            sent_at = utcnow()
+            values = {
+                "status": "sent",
+                "sent_at": sent_at,
+                "message_id": sent.message_id,
+            }
+            self.sent += len(messages)
+            self.digests += len(messages) > 1
+            self._latencies.extend(
+                (sent_at - message.created_at).total_seconds() for message in messages
+            )
+            self._single.difference_update(message.id for message in messages)
+
+        async with async_session() as session:
+            await session.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id.in_([message.id for message in messages]))
+                .values(**values)
+            )
+            if values.get("status") == "sent" and message.admin_copy_of:
+                column = (
+                    "admin_media_message_id"
+                    if message.media_type in CAPTIONLESS
+                    else "admin_message_id"
+                )
+                # Валентинка датирована не позже постановки сообщения в очередь, день
+                # запаса на случай Нового года между ними. Так id ищется в одной секции
+                await session.execute(
+                    update(Valentine)
+                    .where(
+                        Valentine.id == message.admin_copy_of,
+                        Valentine.date
+                        >= season_start(message.created_at - datetime.timedelta(days=1)),
+                        Valentine.date <= message.created_at,
+                    )
+                    .values({column: values["message_id"]})
+                )
+            await session.commit()
@@ -0,0 +1,90 @@
+import datetime
+import logging
+import re
+
+from sqlalchemy import and_, text
+from sqlalchemy.engine import Connection
+
+logger = logging.getLogger(__name__)
+
+# В Postgres valentine секционирована по date (миграция 8), по секции valentine_<год>
+# на сезон. Сезон - календарный год UTC: валентинки пишут в феврале, и граница
+# секций приходится на время, когда бот простаивает.
+# Горячие запросы (/block, /who, номер копии в админ группе из outbox) ограничены
+# текущим сезоном, и Postgres читает только его секцию. Прошлые сезоны
+# отсоединяет retention.py. В SQLite таблица обычная, там условие по дате - просто фильтр
+
+_PARTITION = re.compile(r"^valentine_(\d{4})$")
+
+
+def season_of(at: datetime.datetime) -> int:
+    return at.year
+
+
+# Начало сезона, в котором лежит at (по умолчанию текущего), без таймзоны, как date в базе
+def season_start(at: datetime.datetime | None = None) -> datetime.datetime:
+    at = at or datetime.datetime.utcnow()
+    return datetime.datetime(season_of(at), 1, 1)
+
+
+# Условие на колонку date: Postgres по нему оставляет ровно одну секцию текущего сезона
+def in_current_season(column):
+    start = season_start()
+    return and_(column >= start, column < start.replace(year=start.year + 1))
+
+
+def partition_name(season: int) -> str:
+    return f"valentine_{season}"
+
+
+def create_partition(conn: Connection, season: int) -> None:
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(season)} PARTITION OF valentine "
+            f"FOR VALUES FROM ('{season}-01-01') TO ('{season + 1}-01-01')"
+        )
+    )
+
+
+# Секции текущего и следующего сезона, чтобы вставка не упала после Нового года.
+# Вызывается из ensure_schema при каждом старте и раз в сутки из retention.maintain,
+# поэтому сначала одна проверка без блокировок
+def ensure_partitions(conn: Connection, now: datetime.datetime | None = None) -> None:
+    season = season_of(now or datetime.datetime.utcnow())
+    seasons = (season, season + 1)
+    present = conn.execute(
+        text("SELECT to_regclass(:current) IS NOT NULL, to_regclass(:next) IS NOT NULL"),
+        {"current": partition_name(seasons[0]), "next": partition_name(seasons[1])},
+    ).one()
+    if all(present):
+        return
+    # Реплики стартуют одновременно, секции создает одна из них
+    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('valentine_partitions'))"))
+    for season in seasons:
+        create_partition(conn, season)
+        logger.info(f"Partition {partition_name(season)} is ready")
+
+
+# Сезоны, секции которых сейчас подключены к valentine
+def attached_seasons(conn: Connection) -> list[int]:
+    names = conn.scalars(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = 'valentine'::regclass"
+        )
+    )
+    return sorted(
+        int(match.group(1)) for name in names if (match := _PARTITION.match(name))
+    )
+
+
+# Отсоединяет секцию сезона и переименовывает ее в холодную таблицу
+# valentine_archive_<год>. Возвращает имя холодной таблицы.
+# DETACH без CONCURRENTLY берет эксклюзивную блокировку valentine, но только на время
+# правки каталога, поэтому каждую секцию отсоединяем в своей короткой транзакции
+def detach_season(conn: Connection, season: int) -> str:
+    archive = f"valentine_archive_{season}"
+    conn.execute(text(f"ALTER TABLE valentine DETACH PARTITION {partition_name(season)}"))
+    conn.execute(text(f"ALTER TABLE {partition_name(season)} RENAME TO {archive}"))
+    return archive
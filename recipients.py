@@ -0,0 +1,40 @@
+import re
+from typing import NamedTuple
+
+# Транслитерация кириллицы (русский и кыргызский алфавиты) в латиницу, чтобы
+# "Арстан" и "Arstan" давали один и тот же ключ
+# fmt: off
+TRANSLIT = str.maketrans(
+    {
+        "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e",
+        "ж": "zh", "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m",
+        "н": "n", "ң": "n", "о": "o", "ө": "o", "п": "p", "р": "r", "с": "s",
+        "т": "t", "у": "u", "ү": "u", "ф": "f", "х": "h", "ц": "ts", "ч": "ch",
+        "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu",
+        "я": "ya",
+    }
+)
+# fmt: on
+
+USERNAME = re.compile(r"@([A-Za-z0-9_]{3,32})")
+NOT_NAME = re.compile(r"[^a-z0-9]+")
+
+
+# Получатель в нормализованном виде: ник без @ и имя латиницей в нижнем регистре
+class Recipient(NamedTuple):
+    username: str | None
+    name: str
+
+
+def normalize_name(text: str) -> str:
+    return NOT_NAME.sub(" ", text.casefold().translate(TRANSLIT)).strip()
+
+
+# "@Barnacle Арстан" -> Recipient(username="barnacle", name="arstan")
+def parse_recipient(text: str | None) -> Recipient:
+    if not text:
+        return Recipient(None, "")
+    match = USERNAME.search(text)
+    username = match.group(1).casefold() if match else None
+    name = USERNAME.sub(" ", text)
+    return Recipient(username, normalize_name(name))
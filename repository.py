@@ -0,0 +1,622 @@
+import datetime
+from typing import NamedTuple
+
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    DateTime,
+    Integer,
+    String,
+    Text,
+    and_,
+    case,
+    cast,
+    column,
+    func,
+    insert,
+    literal,
+    literal_column,
+    null,
+    or_,
+    select,
+    text,
+    union_all,
+    update,
+    values,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram.constants import ParseMode
+
+import rollups
+from db_sqlalchemy import Media, OutboxMessage, User, Valentine
+from media import CAPTIONLESS
+from outbox import Outbox, utcnow
+from partitions import in_current_season
+from recipients import parse_recipient
+from user_cache import CachedUser
+
+# Запросы хендлеров. На Postgres каждая функция - ровно один запрос к базе,
+# чтобы хендлер укладывался в один round trip. SQLite (бенчмарки, нагрузочный тест)
+# не умеет DML в CTE, там используются обычные запросы по очереди
+
+
+# Валентинка, которая еще не записана в базу
+class PendingValentine(NamedTuple):
+    telegram_id: int
+    recipient: str
+    text: str
+    date: datetime.datetime
+    anonymous: bool
+    channel_id: int | str
+    channel_text: str
+    admin_group: int | str
+    admin_text: str
+    # Отложенная публикация в канал, UTC без таймзоны. Копия в админ группу уходит сразу
+    release_at: datetime.datetime | None = None
+    # Медиа валентинка, см. media.py. channel_text и admin_text становятся подписью
+    media_type: str | None = None
+    file_id: str | None = None
+    file_unique_id: str | None = None
+
+
+USER_COLUMNS = (User.id, User.user_id, User.blocked, User.last_valentine_at)
+
+
+def _cached_user(row) -> CachedUser:
+    return CachedUser(
+        id=row[0], user_id=row[1], blocked=bool(row[2]), last_valentine_at=row[3]
+    )
+
+
+# Все, что нужно для проверки "зарегистрирован, не заблокирован, не на кулдауне"
+async def get_user(
+    session: AsyncSession, tenant: str, telegram_id: int
+) -> CachedUser | None:
+    row = (
+        await session.execute(
+            select(*USER_COLUMNS).where(User.tenant == tenant, User.user_id == telegram_id)
+        )
+    ).first()
+    return _cached_user(row) if row else None
+
+
+# INSERT ... ON CONFLICT: два одновременных контакта не создадут дубликат, а уже
+# зарегистрированный пользователь вернется из того же запроса.
+# Возвращает (пользователь, создан ли он сейчас)
+async def register_user(
+    session: AsyncSession,
+    tenant: str,
+    telegram_id: int,
+    full_name: str,
+    user_name: str,
+    phone: str,
+) -> tuple[CachedUser, bool]:
+    row = {
+        "tenant": tenant,
+        "user_id": int(telegram_id),
+        "full_name": str(full_name),
+        "user_name": str(user_name),
+        "phone": str(phone),
+        "blocked": False,
+        "blocked_reason": "",
+    }
+
+    if session.bind.dialect.name == "postgresql":
+        # Пустой DO UPDATE нужен, чтобы RETURNING вернул и существующую строку.
+        # xmax = 0 только у только что вставленной строки
+        result = (
+            await session.execute(
+                postgresql.insert(User)
+                .values(row)
+                .on_conflict_do_update(
+                    index_elements=[User.tenant, User.user_id],
+                    set_={"user_id": User.user_id},
+                )
+                .returning(*USER_COLUMNS, literal_column("xmax = 0"))
+            )
+        ).first()
+        created = result[4]
+    else:
+        result = (
+            await session.execute(
+                sqlite.insert(User)
+                .values(row)
+                .on_conflict_do_nothing(index_elements=[User.tenant, User.user_id])
+                .returning(*USER_COLUMNS)
+            )
+        ).first()
+        created = result is not None
+        if not created:
+            result = (
+                await session.execute(
+                    select(*USER_COLUMNS).where(
+                        User.tenant == tenant, User.user_id == telegram_id
+                    )
+                )
+            ).first()
+
+    await session.commit()
+    return _cached_user(result), created
+
+
+# Повтор уже отправленного файла: (сколько раз отправляли, Telegram id первого отправителя)
+async def find_media(
+    session: AsyncSession, tenant: str, file_unique_id: str
+) -> tuple[int, int] | None:
+    row = (
+        await session.execute(
+            select(Media.uses, Media.sender).where(
+                Media.tenant == tenant, Media.file_unique_id == file_unique_id
+            )
+        )
+    ).first()
+    return tuple(row) if row else None
+
+
+# Файлы валентинок в media: новый файл добавляется, у повтора растет uses.
+# Возвращает file_unique_id -> (media.id, file_id), file_id берется уже известный
+async def _save_media(
+    session: AsyncSession, tenant: str, valentines: list[PendingValentine]
+) -> dict[str, tuple[int, str]]:
+    files = {}
+    for valentine in valentines:
+        if valentine.file_unique_id:
+            files.setdefault(valentine.file_unique_id, [valentine, 0])[1] += 1
+
+    saved = {}
+    for file_unique_id, (valentine, uses) in files.items():
+        media_insert = sqlite.insert(Media).values(
+            tenant=tenant,
+            file_unique_id=file_unique_id,
+            file_id=valentine.file_id,
+            type=valentine.media_type,
+            sender=valentine.telegram_id,
+            uses=uses,
+            created_at=utcnow(),
+        )
+        saved[file_unique_id] = tuple(
+            (
+                await session.execute(
+                    media_insert.on_conflict_do_update(
+                        index_elements=[Media.tenant, Media.file_unique_id],
+                        set_={"uses": Media.uses + media_insert.excluded.uses},
+                    ).returning(Media.id, Media.file_id)
+                )
+            ).one()
+        )
+    return saved
+
+
+def _recipient_columns(recipient: str) -> dict:
+    parsed = parse_recipient(recipient)
+    return {"recipient_username": parsed.username, "recipient_name": parsed.name}
+
+
+# Пишет валентинки вместе с сообщениями для outbox и last_valentine_at отправителей.
+# Отправитель ищется по Telegram id прямо в INSERT ... SELECT, заблокированные
+# пропускаются. Арендатор - тот, чья очередь отправки. Возвращает Telegram id тех,
+# чьи валентинки записаны. Коммит за вызывающим
+async def add_valentines(
+    session: AsyncSession, outbox: Outbox, valentines: list[PendingValentine]
+) -> set[int]:
+    if session.bind.dialect.name == "postgresql":
+        return await _add_valentines_single_statement(session, outbox.tenant, valentines)
+
+    senders = dict(
+        (
+            await session.execute(
+                select(User.user_id, User.id).where(
+                    User.tenant == outbox.tenant,
+                    User.user_id.in_({valentine.telegram_id for valentine in valentines}),
+                    User.blocked.isnot(True),
+                )
+            )
+        ).all()
+    )
+    valentines = [valentine for valentine in valentines if valentine.telegram_id in senders]
+    if not valentines:
+        return set()
+    media = await _save_media(session, outbox.tenant, valentines)
+
+    ids = (
+        await session.scalars(
+            insert(Valentine).returning(Valentine.id, sort_by_parameter_order=True),
+            [
+                {
+                    "tenant": outbox.tenant,
+                    "sender": senders[valentine.telegram_id],
+                    "recipient": valentine.recipient,
+                    "text": valentine.text,
+                    "date": valentine.date,
+                    "anonymous": valentine.anonymous,
+                    **_recipient_columns(valentine.recipient),
+                    "media_id": (
+                        media[valentine.file_unique_id][0]
+                        if valentine.file_unique_id
+                        else None
+                    ),
+                }
+                for valentine in valentines
+            ],
+        )
+    ).all()
+
+    for valentine_id, valentine in zip(ids, valentines):
+        # Подпись к фото, видео и голосовым, стикер - отдельным сообщением после текста
+        file = {}
+        sticker = {}
+        if valentine.file_unique_id:
+            file = {
+                "media_type": valentine.media_type,
+                "file_id": media[valentine.file_unique_id][1],
+            }
+            if valentine.media_type in CAPTIONLESS:
+                file, sticker = {}, file
+
+        outbox.enqueue(
+            session,
+            valentine.channel_id,
+            valentine.channel_text,
+            parse_mode=ParseMode.MARKDOWN_V2,
+            release_at=valentine.release_at,
+            **file,
+        )
+        if sticker:
+            outbox.enqueue(
+                session, valentine.channel_id, "", release_at=valentine.release_at, **sticker
+            )
+        # admin_message_id проставит outbox, когда копия дойдет до админ группы
+        outbox.enqueue(
+            session,
+            valentine.admin_group,
+            valentine.admin_text,
+            admin_copy_of=valentine_id,
+            **file,
+        )
+        if sticker:
+            outbox.enqueue(
+                session, valentine.admin_group, "", admin_copy_of=valentine_id, **sticker
+            )
+
+    last_sent = {senders[valentine.telegram_id]: valentine.date for valentine in valentines}
+    await session.execute(
+        update(User),
+        [{"id": sender_id, "last_valentine_at": date} for sender_id, date in last_sent.items()],
+    )
+    await rollups.record(session, outbox.tenant, valentines)
+    return {valentine.telegram_id for valentine in valentines}
+
+
+# Один запрос из цепочки CTE:
+#   src        - входные строки с заранее выданными id валентинок
+#   media      - файлы медиа валентинок, то же, что _save_media
+#   valentine  - INSERT ... SELECT с отправителем по Telegram id
+#   last_sent  - UPDATE user.last_valentine_at
+#   outbox     - копии в канал и админ группу (то же, что Outbox.enqueue)
+#   stats      - счетчики для /stats, см. rollups.py
+async def _add_valentines_single_statement(
+    session: AsyncSession, tenant: str, valentines: list[PendingValentine]
+) -> set[int]:
+    rows = values(
+        column("telegram_id", BigInteger),
+        column("recipient", String),
+        column("text", Text),
+        column("date", DateTime),
+        column("anonymous", Boolean),
+        column("recipient_username", String),
+        column("recipient_name", String),
+        column("channel_id", BigInteger),
+        column("channel_text", Text),
+        column("admin_group", BigInteger),
+        column("admin_text", Text),
+        column("release_at", DateTime),
+        column("media_type", String),
+        column("file_id", String),
+        column("file_unique_id", String),
+        name="rows",
+    ).data(
+        [
+            (
+                valentine.telegram_id,
+                valentine.recipient,
+                valentine.text,
+                valentine.date,
+                valentine.anonymous,
+                *parse_recipient(valentine.recipient),
+                int(valentine.channel_id),
+                valentine.channel_text,
+                int(valentine.admin_group),
+                valentine.admin_text,
+                valentine.release_at,
+                valentine.media_type,
+                valentine.file_id,
+                valentine.file_unique_id,
+            )
+            for valentine in valentines
+        ]
+    )
+    src = select(
+        func.nextval("valentine_id_seq").label("id"), *rows.c
+    ).cte("src")
+
+    now = utcnow()
+    # Один файл может прийти в пачке несколько раз, а ON CONFLICT не обновляет строку дважды.
+    # Повторы от заблокированных отправителей тоже считаются
+    files = (
+        select(
+            src.c.file_unique_id,
+            func.min(src.c.file_id),
+            func.min(src.c.media_type),
+            func.min(src.c.telegram_id),
+            func.count(),
+        )
+        .where(src.c.file_unique_id.isnot(None))
+        .group_by(src.c.file_unique_id)
+        .subquery("files")
+    )
+    media_insert = postgresql.insert(Media).from_select(
+        ["tenant", "file_unique_id", "file_id", "type", "sender", "uses", "created_at"],
+        select(literal(tenant), *files.c, literal(now)),
+    )
+    media = (
+        media_insert.on_conflict_do_update(
+            index_elements=[Media.tenant, Media.file_unique_id],
+            set_={"uses": Media.uses + media_insert.excluded.uses},
+        )
+        .returning(Media.id, Media.file_unique_id, Media.file_id)
+        .cte("media")
+    )
+
+    new_valentine = (
+        insert(Valentine)
+        .from_select(
+            [
+                "id",
+                "tenant",
+                "sender",
+                "recipient",
+                "text",
+                "date",
+                "anonymous",
+                "recipient_username",
+                "recipient_name",
+                "media_id",
+            ],
+            select(
+                src.c.id,
+                literal(tenant),
+                User.id,
+                src.c.recipient,
+                src.c.text,
+                src.c.date,
+                src.c.anonymous,
+                src.c.recipient_username,
+                src.c.recipient_name,
+                media.c.id,
+            )
+            .join(User, (User.tenant == tenant) & (User.user_id == src.c.telegram_id))
+            .outerjoin(media, media.c.file_unique_id == src.c.file_unique_id)
+            .where(User.blocked.isnot(True)),
+        )
+        .returning(Valentine.id, Valentine.sender, Valentine.date)
+        .cte("new_valentine")
+    )
+
+    last_sent = (
+        select(new_valentine.c.sender, func.max(new_valentine.c.date).label("date"))
+        .group_by(new_valentine.c.sender)
+        .subquery("last_sent")
+    )
+    sender_update = (
+        update(User)
+        .where(User.id == last_sent.c.sender)
+        .values(last_valentine_at=last_sent.c.date)
+        .returning(User.id)
+        .cte("sender_update")
+    )
+
+    written = (
+        select(src, media.c.file_id.label("known_file_id"))
+        .join(new_valentine, new_valentine.c.id == src.c.id)
+        .outerjoin(media, media.c.file_unique_id == src.c.file_unique_id)
+        .subquery()
+    )
+    # Подпись к фото, видео и голосовым, стикер - отдельным сообщением после текста
+    sticker = written.c.media_type.in_(CAPTIONLESS)
+    caption_media = case((sticker, null()), else_=written.c.media_type)
+    caption_file = case((sticker, null()), else_=written.c.known_file_id)
+    # Пустой release_at во всех строках VALUES приходит как NULL без типа
+    release_at = cast(written.c.release_at, DateTime)
+    outbox_rows = union_all(
+        select(
+            written.c.channel_id,
+            written.c.channel_text,
+            literal(ParseMode.MARKDOWN_V2),
+            # Без типа Postgres выведет text из первых двух NULL и не сведет их с id
+            cast(null(), Integer),
+            written.c.id.label("valentine_id"),
+            literal(0).label("copy"),
+            release_at.label("release_at"),
+            caption_media.label("media_type"),
+            caption_file.label("file_id"),
+        ),
+        select(
+            written.c.channel_id,
+            literal(""),
+            null(),
+            null(),
+            written.c.id,
+            literal(1),
+            release_at,
+            written.c.media_type,
+            written.c.known_file_id,
+        ).where(sticker),
+        select(
+            written.c.admin_group,
+            written.c.admin_text,
+            null(),
+            written.c.id,
+            written.c.id,
+            literal(2),
+            null(),
+            caption_media,
+            caption_file,
+        ),
+        select(
+            written.c.admin_group,
+            literal(""),
+            null(),
+            written.c.id,
+            written.c.id,
+            literal(3),
+            null(),
+            written.c.media_type,
+            written.c.known_file_id,
+        ).where(sticker),
+    ).subquery("outbox_rows")
+    outbox_insert = (
+        insert(OutboxMessage)
+        .from_select(
+            [
+                "tenant",
+                "chat_id",
+                "text",
+                "parse_mode",
+                "admin_copy_of",
+                "status",
+                "attempts",
+                "created_at",
+                "next_attempt_at",
+                "release_at",
+                "media_type",
+                "file_id",
+            ],
+            select(
+                literal(tenant),
+                outbox_rows.c.channel_id,
+                outbox_rows.c.channel_text,
+                outbox_rows.c[2],
+                outbox_rows.c[3],
+                case(
+                    (outbox_rows.c.release_at.isnot(None), literal("scheduled")),
+                    else_=literal("pending"),
+                ),
+                literal(0),
+                literal(now),
+                literal(now),
+                outbox_rows.c.release_at,
+                outbox_rows.c.media_type,
+                outbox_rows.c.file_id,
+            ).order_by(outbox_rows.c.valentine_id, outbox_rows.c.copy),
+        )
+        .returning(OutboxMessage.id)
+        .cte("outbox_insert")
+    )
+
+    hourly_insert, recipient_insert = rollups.upsert_statements(written, tenant)
+    stats_ctes = (
+        hourly_insert.returning(literal(1)).cte("hourly_stats"),
+        recipient_insert.returning(literal(1)).cte("recipient_stats"),
+    )
+
+    statement = (
+        select(src.c.telegram_id)
+        .join(new_valentine, new_valentine.c.id == src.c.id)
+        .add_cte(media, sender_update, outbox_insert, *stats_ctes)
+    )
+    return set((await session.scalars(statement)).all())
+
+
+# Копия валентинки в админ группе: текст (или фото с подписью) либо стикер после текста.
+# Модерация касается только текущего сезона, условие по дате оставляет Postgres одну секцию
+def _admin_copy(admin_message_id: int):
+    return and_(
+        in_current_season(Valentine.date),
+        or_(
+            Valentine.admin_message_id == admin_message_id,
+            Valentine.admin_media_message_id == admin_message_id,
+        ),
+    )
+
+
+# /block: находит автора копии в админ группе и блокирует его одним UPDATE ... FROM.
+# Возвращает Telegram id заблокированного или None
+async def block_sender(
+    session: AsyncSession, tenant: str, admin_message_id: int, reason: str
+) -> int | None:
+    telegram_id = await session.scalar(
+        update(User)
+        .where(
+            User.id == Valentine.sender,
+            Valentine.tenant == tenant,
+            _admin_copy(admin_message_id),
+        )
+        .values(blocked=True, blocked_reason=reason)
+        .returning(User.user_id)
+    )
+    await session.commit()
+    return telegram_id
+
+
+# /who: автор копии в админ группе
+async def find_sender(
+    session: AsyncSession, tenant: str, admin_message_id: int
+) -> User | None:
+    return await session.scalar(
+        select(User)
+        .join(Valentine)
+        .where(Valentine.tenant == tenant, _admin_copy(admin_message_id))
+    )
+
+
+_trigram: bool | None = None
+
+
+async def _has_trigram(session: AsyncSession) -> bool:
+    global _trigram
+    if _trigram is None:
+        _trigram = session.bind.dialect.name == "postgresql" and bool(
+            await session.scalar(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            )
+        )
+    return _trigram
+
+
+# /find: валентинки получателю. "@ник" ищется точно по индексу, имя - по
+# триграммному индексу (подстрока или похожее написание), без pg_trgm - LIKE
+async def find_valentines(
+    session: AsyncSession, tenant: str, query: str, limit: int = 20
+) -> list[tuple[Valentine, User]]:
+    parsed = parse_recipient(query)
+    statement = (
+        select(Valentine, User)
+        .join(User, User.id == Valentine.sender)
+        .where(Valentine.tenant == tenant)
+    )
+
+    if parsed.username:
+        statement = statement.where(
+            Valentine.recipient_username == parsed.username
+        ).order_by(Valentine.id.desc())
+    elif parsed.name:
+        name = parsed.name
+        matches = [
+            Valentine.recipient_username == name.replace(" ", ""),
+            # % и _ из запроса админа ищутся как символы, а не как шаблон
+            Valentine.recipient_name.contains(name, autoescape=True),
+        ]
+        if await _has_trigram(session):
+            matches.append(Valentine.recipient_name.op("%")(name))
+            statement = statement.order_by(
+                func.similarity(Valentine.recipient_name, name).desc(),
+                Valentine.id.desc(),
+            )
+        else:
+            statement = statement.order_by(Valentine.id.desc())
+        statement = statement.where(or_(*matches))
+    else:
+        return []
+
+    return (await session.execute(statement.limit(limit))).all()
@@ -0,0 +1,161 @@
+# Хранение прошлых сезонов. В Postgres valentine разбита на секции по сезонам
+# (partitions.py), горячие запросы читают только текущий. Сезоны старше --keep
+# последних отсоединяются от valentine и остаются холодными таблицами
+# valentine_archive_<год>, а с --archive-dir выгружаются в valentine_<год>.jsonl.gz
+# и удаляются. Холодные таблицы не попадают в /find, /export и rollups --rebuild,
+# счетчики /stats за прошлые сезоны остаются в valentine_stats и
+# archived_recipient_stats, и --rebuild их не стирает:
+#
+#   python -m retention --keep 2
+#   python -m retention --keep 2 --archive-dir /data/archive
+#   python -m retention --archive-dir /data/archive  # только выгрузить холодные таблицы
+#
+# Бот раз в сутки создает секцию следующего сезона и, если задана RETENTION_SEASONS,
+# отсоединяет старые сезоны в холодные таблицы, см. maintain
+import argparse
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from db_sqlalchemy import check_schema, get_async_engine
+from export import CHUNK_SIZE
+from partitions import attached_seasons, detach_season, ensure_partitions, season_of
+from rollups import archive_recipients
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_INTERVAL = 24 * 3600
+
+
+# Отсоединяет сезоны старше keep последних, возвращает имена холодных таблиц
+async def detach_old_seasons(keep: int) -> list[str]:
+    engine = get_async_engine()
+    if engine.dialect.name != "postgresql":
+        return []
+
+    async with engine.begin() as conn:
+        await conn.run_sync(ensure_partitions)
+        seasons = await conn.run_sync(attached_seasons)
+
+    current = season_of(datetime.datetime.utcnow())
+    archived = []
+    for season in seasons:
+        if season > current - keep:
+            continue
+        # Получатели сезона сохраняются в той же транзакции, что и отсоединение
+        async with engine.begin() as conn:
+            await conn.execute(archive_recipients(season))
+            archived.append(await conn.run_sync(detach_season, season))
+        logger.info(f"Season {season} moved to {archived[-1]}")
+    return archived
+
+
+async def cold_tables(conn: AsyncConnection) -> list[str]:
+    return list(
+        await conn.scalars(
+            text(
+                "SELECT tablename FROM pg_tables "
+                "WHERE tablename ~ '^valentine_archive_[0-9]{4}$' ORDER BY tablename"
+            )
+        )
+    )
+
+
+# Выгружает холодную таблицу в gzip JSONL серверным курсором и удаляет ее. В холодную
+# таблицу никто не пишет, поэтому она удаляется отдельной транзакцией после того,
+# как файл записан целиком (курсор asyncpg держит таблицу до конца транзакции)
+async def archive_table(table: str, directory: str) -> int:
+    season = table.rsplit("_", 1)[1]
+    path = os.path.join(directory, f"valentine_{season}.jsonl.gz")
+    partial = path + ".partial"
+
+    engine = get_async_engine()
+    count = 0
+    async with engine.connect() as conn:
+        result = await conn.stream(
+            text(f"SELECT * FROM {table} ORDER BY id"),
+            execution_options={"yield_per": CHUNK_SIZE},
+        )
+        columns = list(result.keys())
+        with gzip.open(partial, "wb") as file:
+            output = io.TextIOWrapper(file, encoding="utf-8", newline="")
+            async for chunk in result.partitions():
+                output.write(
+                    "".join(
+                        json.dumps(
+                            dict(zip(columns, row)),
+                            ensure_ascii=False,
+                            default=datetime.datetime.isoformat,
+                        )
+                        + "\n"
+                        for row in chunk
+                    )
+                )
+                count += len(chunk)
+            output.flush()
+            output.detach()
+    os.replace(partial, path)
+
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP TABLE {table}"))
+    logger.info(f"Archived {count} valentines from {table} to {path}")
+    return count
+
+
+async def archive_cold_tables(directory: str) -> dict[str, int]:
+    os.makedirs(directory, exist_ok=True)
+    async with get_async_engine().connect() as conn:
+        tables = await cold_tables(conn)
+    return {table: await archive_table(table, directory) for table in tables}
+
+
+# Фоновая задача лидера: секции на следующий сезон и отсоединение старых
+async def maintain(keep: int | None, interval: float = MAINTENANCE_INTERVAL) -> None:
+    while True:
+        try:
+            if keep:
+                await detach_old_seasons(keep)
+            elif get_async_engine().dialect.name == "postgresql":
+                async with get_async_engine().begin() as conn:
+                    await conn.run_sync(ensure_partitions)
+        except Exception as e:
+            logger.warning(e)
+        await asyncio.sleep(interval)
+
+
+async def main(args: argparse.Namespace) -> None:
+    await check_schema()
+    try:
+        if get_async_engine().dialect.name != "postgresql":
+            print("valentine is partitioned only in Postgres, nothing to do")
+            return
+        if args.keep:
+            for table in await detach_old_seasons(args.keep):
+                print(f"Detached {table}")
+        if args.archive_dir:
+            for table, count in (await archive_cold_tables(args.archive_dir)).items():
+                print(f"Archived {count} valentines from {table}")
+    finally:
+        await get_async_engine().dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Архивация прошлых сезонов")
+    parser.add_argument(
+        "--keep", type=int, help="сколько последних сезонов оставить в valentine"
+    )
+    parser.add_argument(
+        "--archive-dir", help="выгрузить холодные таблицы в gzip JSONL и удалить их"
+    )
+    args = parser.parse_args()
+    if args.keep is not None and args.keep < 1:
+        parser.error("--keep must be at least 1")
+    asyncio.run(main(args))
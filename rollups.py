@@ -0,0 +1,310 @@
+# Счетчики для /stats: валентинки по часам (всего, анонимных, подписанных) и
+# получатели. Обновляются в той же транзакции, что и запись валентинки
+# (repository.add_valentines), поэтому /stats не делает GROUP BY по valentine.
+# Пересчитать с нуля по истории:
+#
+#   python -m rollups --rebuild
+import argparse
+import asyncio
+import datetime
+import random
+from collections import Counter
+
+from sqlalchemy import (
+    delete,
+    desc,
+    false,
+    func,
+    insert,
+    literal,
+    select,
+    true,
+    union_all,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_sqlalchemy import (
+    DEFAULT_TENANT,
+    ArchivedRecipientStats,
+    RecipientStats,
+    Valentine,
+    ValentineStats,
+    async_session,
+    check_schema,
+    get_async_engine,
+)
+from partitions import attached_seasons
+
+
+# На сколько строк разбит каждый час в valentine_stats. Запись валентинок выбирает
+# корзину случайно, поэтому в пик одновременные транзакции почти не ждут друг друга
+STATS_BUCKETS = 16
+
+
+def stats_bucket() -> int:
+    return random.randrange(STATS_BUCKETS)
+
+
+def hour_of(column, dialect: str):
+    if dialect == "postgresql":
+        return func.date_trunc("hour", column)
+    # Тот же формат, в котором SQLAlchemy хранит DateTime в SQLite
+    return func.strftime("%Y-%m-%d %H:00:00.000000", column)
+
+
+# В SQLite lower() меняет регистр только у латиницы, там пересчет может разойтись
+# с питоновским lower() из record для кириллицы
+def recipient_key(column):
+    return func.lower(func.trim(column))
+
+
+# Строки для счетчиков из выборки с колонками date, anonymous, recipient.
+# tenant - колонка выборки или константа, если все строки одного арендатора.
+# Старые строки без date в почасовые счетчики не попадают: их час неизвестен
+def rollup_selects(source, dialect: str, tenant, bucket: int = 0) -> tuple:
+    hour = hour_of(source.c.date, dialect)
+    hourly = (
+        select(
+            tenant,
+            hour,
+            literal(bucket),
+            func.count(),
+            func.count().filter(source.c.anonymous == true()),
+            func.count().filter(source.c.anonymous == false()),
+        )
+        .where(source.c.date.isnot(None))
+        .group_by(tenant, hour)
+    )
+
+    recipient = recipient_key(source.c.recipient)
+    recipients = (
+        select(tenant, recipient, func.count())
+        .where(source.c.recipient.isnot(None))
+        .group_by(tenant, recipient)
+    )
+    return hourly, recipients
+
+
+# INSERT ... SELECT ... ON CONFLICT для Postgres, прибавляет к существующим счетчикам
+def upsert_statements(source, tenant: str) -> tuple:
+    hourly, recipients = rollup_selects(
+        source, "postgresql", literal(tenant), stats_bucket()
+    )
+
+    hourly_insert = postgresql.insert(ValentineStats).from_select(
+        ["tenant", "hour", "bucket", "total", "anonymous", "signed"], hourly
+    )
+    hourly_insert = hourly_insert.on_conflict_do_update(
+        index_elements=[ValentineStats.tenant, ValentineStats.hour, ValentineStats.bucket],
+        set_={
+            "total": ValentineStats.total + hourly_insert.excluded.total,
+            "anonymous": ValentineStats.anonymous + hourly_insert.excluded.anonymous,
+            "signed": ValentineStats.signed + hourly_insert.excluded.signed,
+        },
+    )
+
+    recipient_insert = postgresql.insert(RecipientStats).from_select(
+        ["tenant", "recipient", "count"], recipients
+    )
+    recipient_insert = recipient_insert.on_conflict_do_update(
+        index_elements=[RecipientStats.tenant, RecipientStats.recipient],
+        set_={"count": RecipientStats.count + recipient_insert.excluded.count},
+    )
+    return hourly_insert, recipient_insert
+
+
+# То же для SQLite: счетчики считаются в питоне и пишутся upsert'ом
+async def record(session: AsyncSession, tenant: str, valentines: list) -> None:
+    hourly = {}
+    for valentine in valentines:
+        if valentine.date is None:
+            continue
+        hour = valentine.date.replace(minute=0, second=0, microsecond=0)
+        counts = hourly.setdefault(hour, Counter())
+        counts["total"] += 1
+        if valentine.anonymous is not None:
+            counts["anonymous" if valentine.anonymous else "signed"] += 1
+    recipients = Counter(
+        valentine.recipient.strip().lower()
+        for valentine in valentines
+        if valentine.recipient is not None
+    )
+
+    if hourly:
+        bucket = stats_bucket()
+        hourly_insert = sqlite.insert(ValentineStats)
+        await session.execute(
+            hourly_insert.on_conflict_do_update(
+                index_elements=[
+                    ValentineStats.tenant,
+                    ValentineStats.hour,
+                    ValentineStats.bucket,
+                ],
+                set_={
+                    "total": ValentineStats.total + hourly_insert.excluded.total,
+                    "anonymous": ValentineStats.anonymous + hourly_insert.excluded.anonymous,
+                    "signed": ValentineStats.signed + hourly_insert.excluded.signed,
+                },
+            ),
+            [
+                {
+                    "tenant": tenant,
+                    "hour": hour,
+                    "bucket": bucket,
+                    "total": counts["total"],
+                    "anonymous": counts["anonymous"],
+                    "signed": counts["signed"],
+                }
+                for hour, counts in hourly.items()
+            ],
+        )
+
+    if recipients:
+        recipient_insert = sqlite.insert(RecipientStats)
+        await session.execute(
+            recipient_insert.on_conflict_do_update(
+                index_elements=[RecipientStats.tenant, RecipientStats.recipient],
+                set_={"count": RecipientStats.count + recipient_insert.excluded.count},
+            ),
+            [
+                {"tenant": tenant, "recipient": key, "count": count}
+                for key, count in recipients.items()
+            ],
+        )
+
+
+# Счетчики получателей сезона перед тем, как retention отсоединит его от valentine.
+# Условие по дате оставляет Postgres одну секцию
+def archive_recipients(season: int):
+    start = datetime.datetime(season, 1, 1)
+    recipient = recipient_key(Valentine.recipient)
+    return insert(ArchivedRecipientStats).from_select(
+        ["tenant", "season", "recipient", "count"],
+        select(Valentine.tenant, literal(season), recipient, func.count())
+        .where(
+            Valentine.date >= start,
+            Valentine.date < start.replace(year=season + 1),
+            Valentine.recipient.isnot(None),
+        )
+        .group_by(Valentine.tenant, recipient),
+    )
+
+
+# Пересчет счетчиков по истории. Сезоны, отсоединенные retention, в valentine уже
+# нет: их часы в valentine_stats не трогаются, а получатели берутся из
+# archived_recipient_stats. Коммит за вызывающим
+async def rebuild(session: AsyncSession) -> None:
+    dialect = session.bind.dialect.name
+    source = select(
+        Valentine.tenant, Valentine.date, Valentine.anonymous, Valentine.recipient
+    ).subquery()
+    hourly, recipients = rollup_selects(source, dialect, source.c.tenant)
+
+    stale_hours = delete(ValentineStats)
+    if dialect == "postgresql":
+        seasons = await session.run_sync(
+            lambda sync_session: attached_seasons(sync_session.connection())
+        )
+        stale_hours = stale_hours.where(
+            ValentineStats.hour >= datetime.datetime(seasons[0], 1, 1)
+        )
+    await session.execute(stale_hours)
+    await session.execute(
+        insert(ValentineStats).from_select(
+            ["tenant", "hour", "bucket", "total", "anonymous", "signed"], hourly
+        )
+    )
+
+    archived = select(
+        ArchivedRecipientStats.tenant,
+        ArchivedRecipientStats.recipient,
+        ArchivedRecipientStats.count,
+    )
+    combined = union_all(recipients, archived).subquery()
+    tenant, recipient, count = combined.c
+    await session.execute(delete(RecipientStats))
+    await session.execute(
+        insert(RecipientStats).from_select(
+            ["tenant", "recipient", "count"],
+            select(tenant, recipient, func.sum(count)).group_by(tenant, recipient),
+        )
+    )
+
+
+# Данные для /stats: только чтение счетчиков. Строк в valentine_stats - по
+# STATS_BUCKETS на час праздника, топ получателей берется по индексу
+async def dashboard(
+    session: AsyncSession, tenant: str, hours: int = 12, top: int = 10
+) -> dict:
+    total, anonymous, signed = (
+        await session.execute(
+            select(
+                func.coalesce(func.sum(ValentineStats.total), 0),
+                func.coalesce(func.sum(ValentineStats.anonymous), 0),
+                func.coalesce(func.sum(ValentineStats.signed), 0),
+            ).where(ValentineStats.tenant == tenant)
+        )
+    ).one()
+
+    since = datetime.datetime.utcnow().replace(
+        minute=0, second=0, microsecond=0
+    ) - datetime.timedelta(hours=hours - 1)
+    per_hour = (
+        await session.execute(
+            select(ValentineStats.hour, func.sum(ValentineStats.total))
+            .where(ValentineStats.tenant == tenant, ValentineStats.hour >= since)
+            .group_by(ValentineStats.hour)
+            .order_by(ValentineStats.hour)
+        )
+    ).all()
+
+    recipients = (
+        await session.execute(
+            select(RecipientStats.recipient, RecipientStats.count)
+            .where(RecipientStats.tenant == tenant)
+            .order_by(desc(RecipientStats.count), RecipientStats.recipient)
+            .limit(top)
+        )
+    ).all()
+
+    return {
+        "total": total,
+        "anonymous": anonymous,
+        "signed": signed,
+        "per_hour": per_hour,
+        "top_recipients": recipients,
+    }
+
+
+def render(stats: dict) -> list[str]:
+    known = stats["anonymous"] + stats["signed"]
+    lines = [f"Валентинок: {stats['total']}"]
+    if known:
+        lines.append(
+            f"Анонимных {stats['anonymous'] / known:.0%}, подписанных {stats['signed'] / known:.0%}"
+        )
+    if stats["per_hour"]:
+        lines.append("По часам (UTC):")
+        lines += [f"  {hour:%d.%m %H:00}: {count}" for hour, count in stats["per_hour"]]
+    if stats["top_recipients"]:
+        lines.append("Топ получателей:")
+        lines += [f"  {recipient}: {count}" for recipient, count in stats["top_recipients"]]
+    return lines
+
+
+async def main(args: argparse.Namespace) -> None:
+    await check_schema()
+    async with async_session() as session:
+        if args.rebuild:
+            await rebuild(session)
+            await session.commit()
+        print("\n".join(render(await dashboard(session, args.tenant))))
+    await get_async_engine().dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Счетчики валентинок для /stats")
+    parser.add_argument("--rebuild", action="store_true", help="пересчитать по истории")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT, help="чьи счетчики показать")
+    asyncio.run(main(parser.parse_args()))
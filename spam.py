@@ -0,0 +1,169 @@
+import re
+from collections import defaultdict, deque
+from typing import NamedTuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db_sqlalchemy import User, Valentine
+from partitions import in_current_season
+
+EMPTY = 1 << 32
+
+NOT_WORD = re.compile(r"[\W_]+")
+
+
+# Самая похожая валентинка из индекса
+class Match(NamedTuple):
+    sender_id: int
+    similarity: float
+
+
+def normalize(text: str) -> str:
+    return NOT_WORD.sub(" ", text.casefold()).strip()
+
+
+# Шинглы - пересекающиеся подстроки по size символов. Небольшие правки текста
+# меняют только несколько шинглов, поэтому доля общих шинглов остается высокой.
+# hash() строки случаен между запусками, но индекс все равно строится заново
+def shingles(text: str, size: int = 5) -> set[int]:
+    return {
+        hash(text[i : i + size]) & 0xFFFFFFFF
+        for i in range(max(1, len(text) - size + 1))
+    }
+
+
+# Индекс похожих текстов: MinHash сигнатура + LSH по полосам сигнатуры.
+# Поиск смотрит только на тексты, совпавшие хотя бы в одной полосе, поэтому время
+# не зависит от размера индекса. Старые тексты вытесняются после max_size.
+# Сигнатура считается за один проход по шинглам (one permutation hashing): хеш
+# попадает в одну из num_perm корзин, в корзине остается минимум. Классический
+# MinHash с num_perm перестановками на чистом питоне в десятки раз медленнее
+class SpamIndex:
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        min_length: int = 30,
+        num_perm: int = 64,
+        bands: int = 16,
+        max_size: int = 200_000,
+    ) -> None:
+        assert num_perm % bands == 0
+        self.threshold = threshold
+        self.min_length = min_length
+        self.bands = bands
+        self.num_perm = num_perm
+        self.rows = num_perm // bands
+        self.max_size = max_size
+
+        self._buckets: defaultdict[tuple, set[int]] = defaultdict(set)
+        self._docs: dict[int, tuple[tuple, int]] = {}
+        self._order: deque[int] = deque()
+        self._next_id = 0
+
+        self.flagged = 0
+        self.rejected = 0
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    # text уже нормализован
+    def signature(self, text: str) -> tuple:
+        num_perm = self.num_perm
+        signature = [EMPTY] * num_perm
+        for h in shingles(text):
+            bin, value = h % num_perm, h // num_perm
+            if value < signature[bin]:
+                signature[bin] = value
+
+        # Пустые корзины у коротких текстов заполняем из следующей непустой по кругу,
+        # со сдвигом, чтобы заимствованные значения не совпадали с настоящими
+        for i in range(num_perm):
+            if signature[i] != EMPTY:
+                continue
+            for step in range(1, num_perm):
+                value = signature[(i + step) % num_perm]
+                if value < EMPTY:
+                    signature[i] = value + step * EMPTY * 2
+                    break
+        return tuple(signature)
+
+    def _band_keys(self, signature: tuple) -> list[tuple]:
+        return [
+            (band, signature[band * self.rows : (band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+
+    def find(self, text: str) -> Match | None:
+        normalized = normalize(text)
+        # Короткие тексты ("люблю тебя") совпадают у разных людей, их не проверяем
+        if len(normalized) < self.min_length:
+            return None
+        return self._find(self.signature(normalized))
+
+    def _find(self, signature: tuple) -> Match | None:
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+
+        best = None
+        for doc_id in candidates:
+            other, sender_id = self._docs[doc_id]
+            # Доля совпавших позиций сигнатуры - оценка коэффициента Жаккара
+            similarity = sum(x == y for x, y in zip(signature, other)) / len(signature)
+            if similarity >= self.threshold and (best is None or similarity > best.similarity):
+                best = Match(sender_id, similarity)
+        return best
+
+    def add(self, text: str, sender_id: int) -> None:
+        normalized = normalize(text)
+        if len(normalized) >= self.min_length:
+            self._add(self.signature(normalized), sender_id)
+
+    def _add(self, signature: tuple, sender_id: int) -> None:
+        doc_id = self._next_id
+        self._next_id += 1
+        self._docs[doc_id] = (signature, sender_id)
+        self._order.append(doc_id)
+        for key in self._band_keys(signature):
+            self._buckets[key].add(doc_id)
+
+        while len(self._order) > self.max_size:
+            self._remove(self._order.popleft())
+
+    def _remove(self, doc_id: int) -> None:
+        signature, _ = self._docs.pop(doc_id)
+        for key in self._band_keys(signature):
+            bucket = self._buckets[key]
+            bucket.discard(doc_id)
+            if not bucket:
+                del self._buckets[key]
+
+    # Последние max_size валентинок арендатора за текущий сезон, от старых к новым
+    async def warm(self, session: AsyncSession, tenant: str) -> int:
+        latest = (
+            select(Valentine.id, Valentine.text, User.user_id)
+            .join(User, User.id == Valentine.sender)
+            .where(Valentine.tenant == tenant, in_current_season(Valentine.date))
+            .order_by(Valentine.id.desc())
+            .limit(self.max_size)
+            .subquery()
+        )
+        rows = await session.stream(
+            select(latest.c.text, latest.c.user_id).order_by(latest.c.id),
+            execution_options={"yield_per": 1000},
+        )
+        count = 0
+        async for text, sender_id in rows:
+            if text:
+                self.add(text, sender_id)
+                count += 1
+        return count
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._docs),
+            "buckets": len(self._buckets),
+            "flagged": self.flagged,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,94 @@
+import datetime
+import os
+import tomllib
+
+from cooldown import CooldownEngine
+from flood import FloodNotices
+from outbox import Outbox
+from spam import SpamIndex
+from user_cache import UserCache
+from write_behind import ValentineWriteBuffer
+
+# Ключ арендатора в application.bot_data
+TENANT = "tenant"
+
+CHANNEL_URL = "https://t.me/bk_valentines"
+
+
+# Арендатор - бот одной школы: свой токен, админ группа, канал и кулдаун, свои
+# кэш пользователей, кулдауны, индекс похожих валентинок, уведомления о флуде и
+# очередь отправки. Пул соединений с базой, event loop и защита от флуда общие для
+# всех арендаторов процесса
+class Tenant:
+    def __init__(
+        self,
+        name: str,
+        token: str,
+        admin_group: int | str | None,
+        channel_id: int | str | None,
+        cooldown: float = 20,
+        digest: bool = False,
+        channel_url: str = CHANNEL_URL,
+    ) -> None:
+        self.name = name
+        self.token = token
+        self.admin_group = str(admin_group) if admin_group is not None else None
+        self.channel_id = str(channel_id) if channel_id is not None else None
+        self.digest = digest
+        self.channel_url = channel_url
+
+        # Кулдаун в минутах
+        self.cooldowns = CooldownEngine(datetime.timedelta(minutes=cooldown))
+        self.user_cache = UserCache(
+            maxsize=int(os.environ.get("USER_CACHE_SIZE", 10_000)),
+            ttl=float(os.environ.get("USER_CACHE_TTL", 300)),
+        )
+        self.spam_index = SpamIndex(threshold=float(os.environ.get("SPAM_THRESHOLD", 0.8)))
+        # Уведомления о мьютах за флуд в админ группу этого бота
+        self.flood_notices = FloodNotices(
+            interval=float(os.environ.get("FLOOD_NOTICE_INTERVAL", 300))
+        )
+        # Создаются вместе с Application в main.build_application
+        self.outbox: Outbox | None = None
+        self.write_buffer: ValentineWriteBuffer | None = None
+
+    def __repr__(self) -> str:
+        return f"Tenant(name={self.name!r}, admin_group={self.admin_group!r}, channel_id={self.channel_id!r})"
+
+
+# Арендаторы из TOML файла, по таблице [[tenant]] на бота:
+#
+#   [[tenant]]
+#   name = "bilimkana"
+#   token_env = "BILIMKANA_TOKEN"  # или token = "..." прямо в файле
+#   admin_group = -1001234567890
+#   channel_id = -1009876543210
+#   channel_url = "https://t.me/bk_valentines"
+#   cooldown = 20
+#   digest = false
+def load_tenants(path: str) -> list[Tenant]:
+    with open(path, "rb") as file:
+        config = tomllib.load(file)
+
+    tenants = []
+    for entry in config.get("tenant", []):
+        name = entry["name"]
+        token = entry.get("token") or os.environ.get(entry.get("token_env", ""))
+        if not token:
+            raise ValueError(f"Tenant {name!r} has no token")
+        tenants.append(
+            Tenant(
+                name,
+                token,
+                entry["admin_group"],
+                entry["channel_id"],
+                cooldown=entry.get("cooldown", 20),
+                digest=entry.get("digest", False),
+                channel_url=entry.get("channel_url", CHANNEL_URL),
+            )
+        )
+
+    names = [tenant.name for tenant in tenants]
+    if not names or len(set(names)) != len(names):
+        raise ValueError(f"Tenant names must be unique and non-empty: {names}")
+    return tenants
@@ -0,0 +1,28 @@
+import time
+
+from flood import FloodGuard, FloodNotices
+
+
+def test_guard_mutes_after_burst():
+    guard = FloodGuard(rate=0.001, burst=3, mute=60)
+    assert all(guard.allow(1) for _ in range(3))
+    assert not guard.allow(1)
+    assert not guard.allow(1)
+    assert guard.mutes == 1
+    assert guard.muted_for(1) > 59
+    assert guard.allow(2)
+
+
+def test_notices_are_rate_limited(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    notices = FloodNotices(interval=300)
+
+    assert notices.record() == 1
+    assert notices.record() == 0
+    assert notices.record() == 0
+
+    now += 300
+    # Следующее уведомление сообщает и о пропущенных мьютах
+    assert notices.record() == 3
+    assert notices.sent == 2
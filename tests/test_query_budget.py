@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import datetime
+import os
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+import repository
+from repository import PendingValentine
+
+# Бюджет запросов горячего пути: в Postgres регистрация (contact_handler) и запись
+# валентинки (confirmation) - по одному запросу к базе. В SQLite CTE с RETURNING
+# нет, там запись валентинки - несколько запросов, бюджет фиксирует их число.
+# Сценарий бота гоняется через loadtest на TEST_DB_URL (postgresql://..., база
+# очищается) или на временном SQLite файле
+BUDGETS = {
+    "postgresql": {},
+    "sqlite": {"confirmation": 7},
+}
+DEFAULT_BUDGET = 1
+
+
+class RecordingSession:
+    def __init__(self, row: tuple = ()) -> None:
+        self.bind = SimpleNamespace(dialect=postgresql.dialect())
+        self.statements = []
+        self.row = row
+
+    async def _record(self, statement, *args, **kwargs):
+        # Запрос должен собираться для Postgres
+        statement.compile(dialect=self.bind.dialect)
+        self.statements.append(statement)
+        return SimpleNamespace(first=lambda: self.row, all=lambda: [])
+
+    execute = scalars = _record
+
+    async def commit(self) -> None:
+        pass
+
+
+def valentine(index: int, **kwargs) -> PendingValentine:
+    return PendingValentine(
+        telegram_id=index,
+        recipient="@bob Боб",
+        text=f"text {index}",
+        date=datetime.datetime(2026, 2, 14, 10, index),
+        anonymous=bool(index % 2),
+        channel_id=-100,
+        channel_text="channel",
+        admin_group=-200,
+        admin_text="admin",
+        **kwargs,
+    )
+
+
+def test_register_user_is_one_statement_on_postgres():
+    session = RecordingSession(row=(1, 42, False, None, True))
+    user, created = asyncio.run(
+        repository.register_user(session, "default", 42, "Name", "name", "996")
+    )
+    assert len(session.statements) == 1
+    assert created and user.user_id == 42
+
+
+def test_add_valentines_is_one_statement_on_postgres():
+    session = RecordingSession()
+    valentines = [
+        valentine(1),
+        valentine(2, release_at=datetime.datetime(2026, 2, 14)),
+        valentine(3, media_type="sticker", file_id="F", file_unique_id="U"),
+    ]
+    asyncio.run(
+        repository.add_valentines(session, SimpleNamespace(tenant="default"), valentines)
+    )
+    assert len(session.statements) == 1
+
+
+def test_handlers_stay_within_query_budget(tmp_path, monkeypatch):
+    monkeypatch.setenv(
+        "DB_URL", os.environ.get("TEST_DB_URL") or f"sqlite:///{tmp_path / 'budget.db'}"
+    )
+    loadtest = pytest.importorskip("loadtest.run")
+
+    result = asyncio.run(
+        loadtest.main(
+            argparse.Namespace(
+                users=5,
+                concurrency=5,
+                timeout=30,
+                seed=0,
+                chat_limit=20,
+                retry_after_probability=0.0,
+            )
+        )
+    )
+    assert result["completed"] == 5
+
+    import db_sqlalchemy
+
+    budgets = BUDGETS[db_sqlalchemy.get_async_engine().dialect.name]
+    over = {
+        step: stats["queries_per_update"]
+        for step, stats in result["handlers"].items()
+        if stats["queries_per_update"] > budgets.get(step, DEFAULT_BUDGET) + 0.01
+    }
+    assert not over
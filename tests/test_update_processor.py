@@ -0,0 +1,117 @@
+import asyncio
+import datetime
+
+from telegram import Chat, Message, Update, User
+
+from update_processor import PerUserUpdateProcessor
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    user = User(user_id, "Test", False)
+    return Update(
+        update_id,
+        message=Message(
+            update_id,
+            datetime.datetime.now(datetime.timezone.utc),
+            Chat(user_id, Chat.PRIVATE),
+            from_user=user,
+            text="hi",
+        ),
+    )
+
+
+def test_busy_user_does_not_block_others():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2)
+        release = asyncio.Event()
+        order = []
+
+        async def slow(index):
+            await release.wait()
+            order.append((1, index))
+
+        async def fast():
+            order.append((2, 0))
+
+        # Очередь пользователя 1 длиннее числа слотов
+        busy = [
+            asyncio.create_task(processor.process_update(make_update(i, 1), slow(i)))
+            for i in range(5)
+        ]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(
+            processor.process_update(make_update(100, 2), fast()), timeout=1
+        )
+        assert order == [(2, 0)]
+
+        release.set()
+        await asyncio.gather(*busy)
+        assert order[1:] == [(1, i) for i in range(5)]
+
+    asyncio.run(scenario())
+
+
+def test_same_user_updates_are_sequential():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=4)
+        running = 0
+        peak = 0
+
+        async def handler():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(
+            *(processor.process_update(make_update(i, 1), handler()) for i in range(4))
+        )
+        assert peak == 1
+        assert not processor._queues
+
+    asyncio.run(scenario())
+
+
+def test_concurrency_limit_across_users():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2)
+        running = 0
+        peak = 0
+
+        async def handler():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(
+            *(processor.process_update(make_update(i, i), handler()) for i in range(6))
+        )
+        assert peak == 2
+        assert processor.max_concurrent_updates == 2
+
+    asyncio.run(scenario())
+
+
+def test_queue_survives_failed_update():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2)
+        done = []
+
+        async def failing():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("handler failed")
+
+        async def handler():
+            done.append(1)
+
+        await asyncio.gather(
+            processor.process_update(make_update(1, 1), failing()),
+            processor.process_update(make_update(2, 1), handler()),
+        )
+        assert done == [1]
+        assert not processor._queues
+
+    asyncio.run(scenario())
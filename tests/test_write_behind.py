@@ -0,0 +1,70 @@
+import asyncio
+import datetime
+
+from repository import PendingValentine
+from write_behind import ValentineWriteBuffer
+
+
+class FakeOutbox:
+    def notify(self) -> None:
+        pass
+
+
+def valentine(index: int) -> PendingValentine:
+    return PendingValentine(
+        telegram_id=index,
+        recipient="@bob",
+        text=f"text {index}",
+        date=datetime.datetime(2026, 2, 14, 10, index),
+        anonymous=True,
+        channel_id=-100,
+        channel_text="channel",
+        admin_group=-200,
+        admin_text="admin",
+        release_at=datetime.datetime(2026, 2, 14, 0, 0),
+    )
+
+
+class FlakyBuffer(ValentineWriteBuffer):
+    def __init__(self, failures: int, **kwargs) -> None:
+        super().__init__(FakeOutbox(), **kwargs)
+        self.failures = failures
+        self.written = []
+
+    async def _write(self, rows):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("database is down")
+        self.written += rows
+
+
+def test_drain_retries_until_written():
+    async def scenario():
+        buffer = FlakyBuffer(failures=2, max_rows=100, max_delay=10)
+        for index in range(3):
+            await buffer.add(valentine(index))
+        await buffer.drain(timeout=5)
+        assert len(buffer) == 0
+        assert [row.telegram_id for row in buffer.written] == [0, 1, 2]
+
+    asyncio.run(scenario())
+
+
+def test_drain_dumps_rows_and_restore_writes_them(tmp_path):
+    dump_path = str(tmp_path / "write_behind.jsonl")
+
+    async def scenario():
+        buffer = FlakyBuffer(failures=1000, max_rows=100, max_delay=10, dump_path=dump_path)
+        for index in range(3):
+            await buffer.add(valentine(index))
+        await buffer.drain(timeout=0.1)
+        assert len(buffer) == 0
+        assert not buffer.written
+
+        restarted = FlakyBuffer(failures=0, dump_path=dump_path)
+        assert await restarted.restore() == 3
+        assert restarted.written == [valentine(index) for index in range(3)]
+        assert await restarted.restore() == 0
+
+    asyncio.run(scenario())
+    assert not (tmp_path / "write_behind.jsonl").exists()
@@ -0,0 +1,60 @@
+import logging
+from collections import deque
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+# Параллельная обработка апдейтов с сохранением порядка для одного пользователя.
+# Апдейты разных пользователей обрабатываются одновременно (до max_concurrent_updates),
+# а апдейты одного пользователя идут строго друг за другом, чтобы состояния
+# ConversationHandler не гонялись между собой
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(max_concurrent_updates)
+        # Очереди пользователей, у которых апдейт сейчас в обработке
+        self._queues: dict[int, deque[Awaitable[Any]]] = {}
+
+    @staticmethod
+    def _key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    # Вызывается под семафором max_concurrent_updates. Если у пользователя уже идет
+    # обработка, апдейт встает в его очередь и слот сразу освобождается: очередь
+    # одного занятого пользователя занимает один слот, а не все, и не задерживает
+    # остальных. Ту очередь по порядку разбирает уже идущая обработка
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._key(update)
+        if key is None:
+            await coroutine
+            return
+
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+
+        queue = self._queues[key] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue.popleft()
+                except Exception as e:
+                    logger.warning(e)
+        finally:
+            del self._queues[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
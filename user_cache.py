@@ -0,0 +1,61 @@
+import datetime
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+
+# Компактная неизменяемая запись о пользователе для горячего пути хендлеров
+class CachedUser(NamedTuple):
+    id: int
+    user_id: int
+    blocked: bool
+    last_valentine_at: Optional[datetime.datetime]
+
+
+# Кэш пользователей по Telegram user_id с вытеснением по TTL и LRU
+class UserCache:
+    def __init__(self, maxsize: int = 10_000, ttl: float = 300.0) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[int, tuple[float, CachedUser]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int) -> Optional[CachedUser]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user: CachedUser) -> None:
+        self._entries[user.user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user.user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    # Обновляет поля записи, если она есть в кэше, не продлевая TTL
+    def update(self, user_id: int, **fields) -> None:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries[user_id] = (entry[0], entry[1]._replace(**fields))
+
+    def invalidate(self, user_id: int) -> None:
+        self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,72 @@
+import hmac
+import json
+import logging
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+from telegram.ext import Application
+
+from db_sqlalchemy import DEFAULT_TENANT
+
+logger = logging.getLogger(__name__)
+
+
+# Бот из env переменных остается на старом пути, чтобы не менять webhook при переходе
+def webhook_path(tenant: str) -> str:
+    return "webhook" if tenant == DEFAULT_TENANT else f"webhook/{tenant}"
+
+
+class _UpdateHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_application: Application, secret_token: str | None) -> None:
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+
+    async def post(self) -> None:
+        # Сравнение за постоянное время, чтобы секрет нельзя было подобрать по задержке ответа
+        if self.secret_token and not hmac.compare_digest(
+            self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(),
+            self.secret_token.encode(),
+        ):
+            raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_application.bot)
+        except Exception as e:
+            logger.warning(e)
+            raise tornado.web.HTTPError(400)
+        if update:
+            await self.bot_application.update_queue.put(update)
+
+
+# Один HTTP сервер на все боты процесса: апдейты бота приходят на его путь и
+# попадают в update_queue его Application. Updater из PTB поднимал бы по порту на бота
+async def start_webhooks(
+    applications: dict[str, Application],
+    port: int,
+    url: str,
+    secret_token: str | None = None,
+) -> HTTPServer:
+    server = HTTPServer(
+        tornado.web.Application(
+            [
+                (
+                    f"/{webhook_path(tenant)}",
+                    _UpdateHandler,
+                    {"bot_application": application, "secret_token": secret_token},
+                )
+                for tenant, application in applications.items()
+            ]
+        )
+    )
+    server.listen(port, "0.0.0.0")
+
+    for tenant, application in applications.items():
+        await application.bot.set_webhook(
+            url=f"{url.rstrip('/')}/{webhook_path(tenant)}", secret_token=secret_token
+        )
+    return server
+
+
+async def stop_webhooks(server: HTTPServer) -> None:
+    server.stop()
+    await server.close_all_connections()
@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+
+from db_sqlalchemy import async_session
+from outbox import Outbox
+from repository import PendingValentine, add_valentines
+
+logger = logging.getLogger(__name__)
+
+
+# Буфер отложенной записи валентинок. Копит строки и сбрасывает их одной транзакцией
+# каждые max_rows строк или max_delay секунд. Если буфер переполнен (база не успевает),
+# новые валентинки пишутся синхронно. На остановке бота drain() дописывает остаток,
+# а то, что не удалось записать, сохраняет в dump_path до следующего старта (restore)
+class ValentineWriteBuffer:
+    def __init__(
+        self,
+        outbox: Outbox,
+        max_rows: int = 100,
+        max_delay: float = 0.05,
+        max_pending: int = 5000,
+        dump_path: str | None = None,
+    ) -> None:
+        self.outbox = outbox
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.dump_path = dump_path
+
+        self.flushes = 0
+        self.sync_writes = 0
+        self._rows: list[PendingValentine] = []
+        self._timer: asyncio.TimerHandle | None = None
+        # Ссылка на фоновый flush из таймера, иначе задачу может собрать сборщик мусора
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    async def add(self, valentine: PendingValentine) -> None:
+        if len(self._rows) >= self.max_pending:
+            self.sync_writes += 1
+            await self._write([valentine])
+            return
+
+        self._rows.append(valentine)
+        if len(self._rows) >= self.max_rows:
+            await self.flush()
+        elif self._timer is None:
+            self._schedule(self.max_delay)
+
+    def _schedule(self, delay: float) -> None:
+        self._timer = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self) -> None:
+        self._timer = None
+        self._task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        async with self._lock:
+            rows, self._rows = self._rows[: self.max_pending], self._rows[self.max_pending :]
+            if not rows:
+                return
+            try:
+                await self._write(rows)
+                self.flushes += 1
+            except Exception as e:
+                # Возвращаем строки в начало буфера, следующий flush попробует еще раз
+                logger.warning(f"Write-behind flush of {len(rows)} valentines failed: {e}")
+                self._rows = rows + self._rows
+                if self._timer is None:
+                    self._schedule(1)
+
+    # Остановка бота: повторяет flush, пока буфер не опустеет или не выйдет timeout.
+    # Пользователям уже ответили, что валентинка принята, поэтому остаток не
+    # выбрасывается, а сохраняется на диск
+    async def drain(self, timeout: float = 10) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = 0.5
+        while True:
+            if self._task:
+                await asyncio.wait([self._task])
+            await self.flush()
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._rows or loop.time() + delay > deadline:
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
+        if self._rows:
+            rows, self._rows = self._rows, []
+            self._dump(rows)
+
+    def _dump(self, rows: list[PendingValentine]) -> None:
+        lines = "".join(
+            json.dumps(row._asdict(), ensure_ascii=False, default=datetime.datetime.isoformat)
+            + "\n"
+            for row in rows
+        )
+        try:
+            if not self.dump_path:
+                raise RuntimeError("dump_path is not set")
+            with open(self.dump_path, "a", encoding="utf-8") as file:
+                file.write(lines)
+                file.flush()
+                os.fsync(file.fileno())
+        except Exception as e:
+            # Последняя возможность не потерять валентинки - сами строки в логе
+            logger.error(f"Could not save {len(rows)} unwritten valentines: {e}\n{lines}")
+            return
+        logger.error(
+            f"Database unavailable at shutdown, {len(rows)} valentines saved to {self.dump_path}"
+        )
+
+    # Старт бота: дописывает валентинки, сохраненные на диск при прошлой остановке
+    async def restore(self) -> int:
+        if not self.dump_path or not os.path.exists(self.dump_path):
+            return 0
+        with open(self.dump_path, encoding="utf-8") as file:
+            rows = [_load(line) for line in file if line.strip()]
+        if rows:
+            await self._write(rows)
+        os.remove(self.dump_path)
+        logger.info(f"Restored {len(rows)} valentines from {self.dump_path}")
+        return len(rows)
+
+    async def _write(self, rows: list[PendingValentine]) -> None:
+        async with async_session() as session:
+            await add_valentines(session, self.outbox, rows)
+            await session.commit()
+        self.outbox.notify()
+
+
+def _load(line: str) -> PendingValentine:
+    row = json.loads(line)
+    for field in ("date", "release_at"):
+        if row[field]:
+            row[field] = datetime.datetime.fromisoformat(row[field])
+    return PendingValentine(**row)